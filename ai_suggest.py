@@ -0,0 +1,105 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict, deque
+from prompt_toolkit.auto_suggest import AutoSuggest, Suggestion
+
+DEBOUNCE_SECONDS = 0.4
+BUDGET_PER_MINUTE = 6
+MIN_CHARS = 2
+MAX_CACHED = 256
+# How often a pending request checks whether the user kept typing
+POLL_SECONDS = 0.05
+
+
+# Inline ghost-text suggestions from the LLM. Cached suggestions and history
+# are served synchronously; otherwise, once typing pauses for the debounce
+# delay, suggest(text, context, cancelled) runs in a worker thread. The next
+# keystroke sets `cancelled` and abandons the request. Results are cached by
+# the text they were made for and reused for any longer text they still
+# extend, and at most budget_per_minute requests are sent.
+class AISuggest(AutoSuggest):
+    def __init__(self, suggest, context=None, fallback=None, debounce=DEBOUNCE_SECONDS,
+                 budget_per_minute=BUDGET_PER_MINUTE, min_chars=MIN_CHARS, max_cached=MAX_CACHED):
+        self.suggest = suggest
+        # context() is called on the UI thread; its result is handed to suggest()
+        self.context = context
+        self.fallback = fallback
+        self.debounce = debounce
+        self.budget_per_minute = budget_per_minute
+        self.min_chars = min_chars
+        self.max_cached = max_cached
+        self.cache = OrderedDict()
+        self.sent = deque()
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "cancelled": 0, "throttled": 0, "cache_hits": 0}
+
+    def get_suggestion(self, buffer, document):
+        completion = self._cached(document.text)
+        if completion:
+            self.stats["cache_hits"] += 1
+            return Suggestion(completion)
+        if self.fallback is not None:
+            return self.fallback.get_suggestion(buffer, document)
+        return None
+
+    async def get_suggestion_async(self, buffer, document):
+        suggestion = self.get_suggestion(buffer, document)
+        if suggestion is not None or not self._wanted(document):
+            return suggestion
+
+        await asyncio.sleep(self.debounce)
+        if buffer.document != document or not self._take_budget():
+            return None
+
+        text = document.text
+        context = self.context() if self.context is not None else None
+        cancelled = threading.Event()
+        future = asyncio.get_running_loop().run_in_executor(None, self._fetch, text, context, cancelled)
+        while not future.done():
+            await asyncio.wait({future}, timeout=POLL_SECONDS)
+            if buffer.document != document:
+                cancelled.set()
+                self.stats["cancelled"] += 1
+                return None
+        completion = self._cached(text)
+        return Suggestion(completion) if completion else None
+
+    def _wanted(self, document):
+        text = document.text
+        return len(text.strip()) >= self.min_chars and "\n" not in text and document.is_cursor_at_the_end
+
+    def _take_budget(self):
+        now = time.monotonic()
+        with self.lock:
+            while self.sent and now - self.sent[0] > 60:
+                self.sent.popleft()
+            if len(self.sent) >= self.budget_per_minute:
+                self.stats["throttled"] += 1
+                return False
+            self.sent.append(now)
+            self.stats["requests"] += 1
+            return True
+
+    def _fetch(self, text, context, cancelled):
+        try:
+            command = self.suggest(text, context, cancelled)
+        except Exception:
+            return
+        if not command or cancelled.is_set() or not command.startswith(text) or len(command) <= len(text):
+            return
+        with self.lock:
+            self.cache[text] = command
+            self.cache.move_to_end(text)
+            while len(self.cache) > self.max_cached:
+                self.cache.popitem(last=False)
+
+    def _cached(self, text):
+        # The longest cached prefix of text whose suggestion still extends it
+        with self.lock:
+            for end in range(len(text), self.min_chars - 1, -1):
+                command = self.cache.get(text[:end])
+                if command is not None and command.startswith(text) and len(command) > len(text):
+                    self.cache.move_to_end(text[:end])
+                    return command[len(text):]
+        return None
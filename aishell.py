@@ -1,58 +1,132 @@
 # aishell.py
+import atexit
+import copy
 import os
 import getpass
 import socket
-import glob
-import stat
+import sqlite3
+import re
 import sys
 import platform
 import shutil
 import signal
+import subprocess
 import termios
 import json
 import html
+import threading
+import time
 import tty
 import traceback
 from prompt_toolkit import PromptSession, print_formatted_text, HTML
 from prompt_toolkit.key_binding import KeyBindings
-from prompt_toolkit.history import FileHistory
+from prompt_toolkit.filters import Condition
+from prompt_toolkit.history import FileHistory, ThreadedHistory
 from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
-from prompt_toolkit.lexers import PygmentsLexer
-from prompt_toolkit.completion import Completer, Completion, PathCompleter, CompleteEvent
+from prompt_toolkit.lexers import DynamicLexer, PygmentsLexer
+from prompt_toolkit.completion import Completer, Completion, DynamicCompleter
 from prompt_toolkit.formatted_text import FormattedText
 from prompt_toolkit.styles import Style
-from pygments.lexers.shell import BashLexer
-from llm_interface import LLMInterface
 from command_executor import CommandExecutor
-from context_manager import ContextManager
+from command_batch import CommandBatch, MAX_WORKERS
+from bash_session import BashSession, BashSessionError
+from jobs import JobManager
+from scheduler import Scheduler, MAX_LLM_CALLS, MAX_PROCESSES
+from pty_executor import wants_pty
+from context_manager import ContextManager, RETRIEVAL_CHUNKS
+from llm_backends import backend_settings
+from session_store import SessionStore, DEFAULT_SESSION_DB
+from history_store import HistoryStore, StoreHistory, StoreAutoSuggest, HistorySearchCompleter, DEFAULT_HISTORY_DB, LEGACY_HISTORY_FILE
+from response_cache import ResponseCache, DEFAULT_CACHE_DB, DEFAULT_TTL
+from tracer import Tracer
 from user_interface import UserInterface
 from terminal_controller import TerminalController
+from completion_index import DirectoryCache, PathIndex, entry_kind
+from ai_suggest import AISuggest, BUDGET_PER_MINUTE
 
 class BashLikeCompleter(Completer):
-    def __init__(self):
-        self.path_completer = PathCompleter(expanduser=True)
-    
+    # Command names come from a PATH index and paths from mtime-validated
+    # directory listings. PromptSession runs this in a worker thread
+    # (complete_in_thread); the Tab binding calls complete(block=False) so the
+    # UI thread never waits on a directory scan.
+    def __init__(self, directory_cache=None, path_index=None):
+        self.directory_cache = directory_cache or DirectoryCache()
+        self.path_index = path_index or PathIndex(self.directory_cache)
+
     def get_completions(self, document, complete_event):
-        text = document.text_before_cursor
-        if text.startswith('./'):
-            # Complete only executable files
-            path = text[2:]
-            dirname = os.path.dirname(path) or '.'
-            basename = os.path.basename(path)
-            matches = glob.glob(os.path.join(dirname, basename) + '*')
-            for match in matches:
-                if os.path.isfile(match) and os.access(match, os.X_OK):
-                    yield Completion(match[len(path):], start_position=0)
-        else:
-            # General path completion
-            yield from self.path_completer.get_completions(document, complete_event)
+        yield from self.complete(document.text_before_cursor) or ()
+
+    def complete(self, text, block=True):
+        # Returns None when block is False and a directory still has to be scanned
+        word = re.search(r'\S*$', text).group()
+        before = text[:len(text) - len(word)].rstrip()
+        if word and '/' not in word and (not before or before[-1] in '|;&('):
+            return [Completion(name[len(word):], start_position=0, display=name) for name in self.path_index.matches(word)]
+
+        path = os.path.expanduser(word)
+        dirname, basename = os.path.split(path)
+        entries = self.directory_cache.listing(dirname or '.', block=block)
+        if entries is None:
+            return None if not block and os.path.isdir(dirname or '.') else []
+        # ./prog completes only executables (and directories on the way to them)
+        executables_only = word.startswith('./')
+        completions = []
+        for name in entries:
+            if not name.startswith(basename) or (name.startswith('.') and not basename.startswith('.')):
+                continue
+            # Only the matches are stat()ed, so permissions are always current
+            is_dir, is_executable = entry_kind(os.path.join(dirname, name))
+            if executables_only and not (is_dir or is_executable):
+                continue
+            suffix = '/' if is_dir else ''
+            completions.append(Completion(name[len(basename):] + suffix, start_position=0, display=name + suffix))
+        return completions
+
+
+# Recent session context sent with each inline suggestion request
+SUGGEST_CONTEXT_TOKENS = 1000
+# Lines of a finished AI job's output recorded in the session context
+JOB_CONTEXT_LINES = 20
+# How often `fg` checks a job for new output
+JOB_FOLLOW_INTERVAL = 0.1
 
 
 class AIShell:
     def __init__(self):
-        self.llm_interface = LLMInterface()
-        self.command_executor = CommandExecutor()
-        self.context_manager = ContextManager()
+        self.stream_llm = os.getenv("AISHELL_STREAM", "1") != "0"
+        self.tracer = self.open_tracer()
+        atexit.register(self.tracer.close)
+        # The LLM stack (openai, httpx, pydantic) is imported and built on first
+        # use, or by preload() once the prompt is up
+        self._llm_interface = None
+        self._llm_lock = threading.Lock()
+        # Background jobs; LLM calls and job processes share the scheduler's slots
+        self.scheduler = Scheduler(
+            max_llm_calls=int(os.getenv("AISHELL_MAX_LLM_CALLS", MAX_LLM_CALLS)),
+            max_processes=int(os.getenv("AISHELL_MAX_JOB_PROCESSES", MAX_PROCESSES))
+        )
+        self.jobs = JobManager()
+        atexit.register(self.jobs.stop_all)
+        # Set on the copy of the shell that runs a background AI job
+        self.job = None
+        self.following_job = None
+        self.bash_lexer = None
+        self.command_executor = CommandExecutor(
+            stream_output=True,
+            max_capture_bytes=int(os.getenv("AISHELL_SPILL_THRESHOLD", 64 * 1024)),
+            spill_output=True,
+            persistent_shell=os.getenv("AISHELL_PERSISTENT_SHELL", "1") != "0",
+            pty_mode=os.getenv("AISHELL_PTY", "auto")
+        )
+        atexit.register(self.command_executor.close)
+        self.context_manager = ContextManager(
+            model=self.configured_model(),
+            session_store=self.open_session_store(),
+            summarizer=lambda messages: self.llm_interface.summarize(messages),
+            normalize_output=os.getenv("AISHELL_NORMALIZE_OUTPUT", "1") != "0",
+            retrieval_chunks=int(os.getenv("AISHELL_RETRIEVAL_CHUNKS", RETRIEVAL_CHUNKS))
+        )
+        atexit.register(self.context_manager.close)
         self.user_interface = UserInterface()
         self.terminal_controller = TerminalController()
         self.running = True
@@ -60,6 +134,7 @@ class AIShell:
         self.interactive_mode = True
         self.execution_limit = None
         self.execution_count = 0
+        self.batch_workers = int(os.getenv("AISHELL_BATCH_WORKERS", MAX_WORKERS))
         self.debug_mode = False
         self.interrupt_counter = 0
         self.version = 0.1
@@ -67,19 +142,119 @@ class AIShell:
 
         self.last_dir = os.getcwd()
         self.kb = KeyBindings()
+        self.completer = BashLikeCompleter()
+        # Ctrl-R swaps the completer for a search of the whole history
+        self.history_store = self.open_history_store()
+        self.history_search = False
+        if self.history_store is not None:
+            atexit.register(self.history_store.close)
+            self.history_completer = HistorySearchCompleter(self.history_store)
         self.setup_key_bindings()
         
         self.session = PromptSession(
-            history=FileHistory(os.path.expanduser('~/.aishell_history')),
-            auto_suggest=AutoSuggestFromHistory(),
-            lexer=PygmentsLexer(BashLexer),
+            history=self.make_history(),
+            auto_suggest=self.make_auto_suggest(),
+            lexer=DynamicLexer(lambda: self.bash_lexer),
             key_bindings=self.kb,
-            completer=BashLikeCompleter()
+            completer=DynamicCompleter(lambda: self.history_completer if self.history_search else self.completer),
+            complete_in_thread=True
         )
 
         # Handle Ctrl-C globally to exit the app
         signal.signal(signal.SIGINT, self.handle_interrupt)
 
+    def open_session_store(self):
+        path = os.getenv("AISHELL_SESSION_DB", DEFAULT_SESSION_DB)
+        if not path:
+            return None
+        try:
+            return SessionStore(path)
+        except (sqlite3.Error, OSError) as e:
+            print(f"Session log disabled, could not open {path}: {e}", file=sys.stderr)
+            return None
+
+    def open_history_store(self):
+        path = os.getenv("AISHELL_HISTORY_DB", DEFAULT_HISTORY_DB)
+        if not path:
+            return None
+        try:
+            return HistoryStore(path)
+        except (sqlite3.Error, OSError) as e:
+            print(f"History database disabled, could not open {path}: {e}", file=sys.stderr)
+            return None
+
+    def make_history(self):
+        if self.history_store is None:
+            return FileHistory(os.path.expanduser(LEGACY_HISTORY_FILE))
+        # Loaded (and the old history file imported, the first time) off the UI thread
+        return ThreadedHistory(StoreHistory(self.history_store))
+
+    @property
+    def llm_interface(self):
+        return self._llm_interface or self.load_llm_interface()
+
+    def load_llm_interface(self):
+        with self._llm_lock:
+            if self._llm_interface is None:
+                from llm_interface import LLMInterface
+                llm_interface = LLMInterface(debug_mode=self.debug_mode, stream=self.stream_llm, cache=self.open_response_cache(), tracer=self.tracer, scheduler=self.scheduler)
+                llm_interface.cache_replay = os.getenv("AISHELL_CACHE_REPLAY", "0") == "1"
+                if os.getenv("AISHELL_PRECONNECT", "1") != "0":
+                    llm_interface.preconnect()
+                self._llm_interface = llm_interface
+            return self._llm_interface
+
+    def preload(self):
+        # Runs in the background after startup: syntax highlighting and the PATH
+        # index first, then the LLM stack, so the first Ctrl-E does not pay for
+        # the imports
+        from pygments.lexers.shell import BashLexer
+        self.bash_lexer = PygmentsLexer(BashLexer)
+        self.completer.path_index.refresh()
+        if os.getenv("AISHELL_PRELOAD_LLM", "1") != "0":
+            try:
+                self.load_llm_interface()
+            except ValueError:
+                pass  # a bad AISHELL_LLM_BACKEND, reported at startup
+
+    def make_auto_suggest(self):
+        history = StoreAutoSuggest(self.history_store) if self.history_store is not None else AutoSuggestFromHistory()
+        if os.getenv("AISHELL_AI_SUGGEST", "0") != "1":
+            return history
+        return AISuggest(
+            lambda text, context, cancelled: self.llm_interface.suggest_command(text, context, cancelled),
+            context=lambda: self.context_manager.recent_context(SUGGEST_CONTEXT_TOKENS),
+            fallback=history,
+            budget_per_minute=int(os.getenv("AISHELL_AI_SUGGEST_BUDGET", BUDGET_PER_MINUTE))
+        )
+
+    def configured_model(self):
+        # Name of the main model, which sizes the context budget
+        try:
+            return backend_settings("large")["model"]
+        except ValueError as e:
+            print(f"LLM backend not configured: {e}", file=sys.stderr)
+            return None
+
+    def open_tracer(self):
+        # Per-phase timings are always kept for Ctrl-E t; AISHELL_TRACE also writes them to a JSONL file
+        path = os.getenv("AISHELL_TRACE")
+        try:
+            return Tracer(path)
+        except OSError as e:
+            print(f"Trace file disabled, could not open {path}: {e}", file=sys.stderr)
+            return Tracer()
+
+    def open_response_cache(self):
+        path = os.getenv("AISHELL_CACHE_DB", DEFAULT_CACHE_DB)
+        if not path:
+            return None
+        try:
+            return ResponseCache(path, ttl=float(os.getenv("AISHELL_CACHE_TTL", DEFAULT_TTL)))
+        except (sqlite3.Error, OSError) as e:
+            print(f"Response cache disabled, could not open {path}: {e}", file=sys.stderr)
+            return None
+
     def setup_key_bindings(self):
         @self.kb.add('c-e')
         def _(event):
@@ -97,11 +272,11 @@ class AIShell:
         @self.kb.add('tab')
         def _(event):
             buff = event.current_buffer
-            completer = buff.completer
-            document = buff.document
-
-            completions = list(completer.get_completions(document, complete_event=CompleteEvent()))
-            if len(completions) == 1:
+            completions = self.completer.complete(buff.document.text_before_cursor, block=False)
+            if completions is None:
+                # Directory not scanned yet: let the threaded completer do it
+                buff.start_completion(select_first=False)
+            elif len(completions) == 1:
                 buff.insert_text(completions[0].text)
             elif len(completions) > 1:
                 if event.is_repeat:
@@ -115,6 +290,17 @@ class AIShell:
             else:
                 buff.insert_text('\t')
 
+        @self.kb.add('c-r', filter=Condition(lambda: self.history_store is not None))
+        def _(event):
+            # Toggles searching all of history: the completion menu lists the
+            # newest commands containing every word typed
+            buffer = event.current_buffer
+            self.history_search = not self.history_search
+            if self.history_search:
+                buffer.start_completion(select_first=False)
+            else:
+                buffer.cancel_completion()
+
         @self.kb.add('c-d')  # Custom handling for Ctrl-D
         def _(event):
             buffer = event.current_buffer
@@ -138,11 +324,14 @@ class AIShell:
     def toggle_debug_mode(self):
         self.debug_mode = not self.debug_mode
         print(f"Debug mode {'enabled' if self.debug_mode else 'disabled'}.")
-        # Re-instantiate LLMInterface with the new debug mode
-        self.llm_interface = LLMInterface(debug_mode=self.debug_mode)
+        # Flip the flag in place so the pooled client and its connections are kept
+        if self._llm_interface is not None:
+            self._llm_interface.debug_mode = self.debug_mode
 
     def print_debug(self, message):
-        if self.debug_mode:
+        if self.debug_mode and self.job is not None:
+            print(message)
+        elif self.debug_mode:
             style = Style.from_dict({
                 'debug': '#FFFF00 bold',
             })
@@ -157,6 +346,7 @@ class AIShell:
         return f"{version_str} {user}@{host}:{cwd}$ "
 
     def run(self):
+        threading.Thread(target=self.preload, name="aishell-preload", daemon=True).start()
         while self.running:
             try:
                 if self.ctrl_e_active:
@@ -167,6 +357,8 @@ class AIShell:
                     self.process_ctrl_e_command(command)
                     self.ctrl_e_active = False
                 else:
+                    self.report_jobs()
+                    self.history_search = False
                     command = self.session.prompt(f"{os.getcwd()}$ ")
                     if command is not None:
                         self.execute_command(command)
@@ -207,6 +399,16 @@ class AIShell:
             self.handle_ctrl_e_i()
         elif command == 'd':
             self.toggle_debug_mode()
+        elif command == 'c':
+            self.handle_ctrl_e_c()
+        elif command == 't':
+            self.handle_ctrl_e_t()
+        elif command == 'j':
+            self.handle_ctrl_e_j()
+        elif command == 'f':
+            self.handle_ctrl_e_f()
+        elif command == 'k':
+            self.handle_ctrl_e_k()
         elif command in ['h', '?']:
             self.print_ctrl_e_help()
         else:
@@ -219,21 +421,51 @@ class AIShell:
             self.running = False
             return "", "", 0
 
+        stripped = command.rstrip()
+        if self.job is None and stripped.endswith("&") and not stripped.endswith(("&&", "\\&", "|&")):
+            self.start_command_job(stripped[:-1].rstrip())
+            return "", "", 0
+
         self.interrupt_counter = 0
 
         try:
-            stdout, stderr = self.command_executor.execute(command)
-            return_code = self.command_executor.last_return_code  # Assuming we add this attribute to CommandExecutor
+            with self.tracer.span("execute") as trace:
+                stdout, stderr = self.command_executor.execute(command)
+                return_code = self.command_executor.last_return_code  # Assuming we add this attribute to CommandExecutor
+                trace["return_code"] = return_code
+                for name, output, capture in zip(("stdout", "stderr"), (stdout, stderr), self.command_executor.last_captures):
+                    trace[f"{name}_bytes"] = capture.total_bytes if capture is not None else len(output.encode())
 
-            if stdout:
-                print(stdout, end='')
-            if stderr:
-                print(stderr, file=sys.stderr, end='')
+            # Streaming mode has already relayed the output as it arrived
+            if not self.command_executor.stream_output:
+                if stdout:
+                    print(stdout, end='')
+                if stderr:
+                    print(stderr, file=sys.stderr, end='')
 
-            self.context_manager.add_command(command, stdout, stderr, from_llm=from_llm)
+            stdout_capture, stderr_capture = self.command_executor.last_captures
+            with self.tracer.span("normalize") as trace:
+                saved = self.context_manager.add_command(
+                    command, stdout, stderr, from_llm=from_llm,
+                    stdout_capture=stdout_capture, stderr_capture=stderr_capture
+                )
+                trace["saved_bytes"] = saved
+            if saved:
+                self.print_debug(f"Output normalization kept {saved} bytes out of the context")
             
-            # Update the current working directory only for simple cd commands
-            if command.strip().startswith("cd ") and " && " not in command and ";" not in command:
+            cwd = self.command_executor.last_cwd
+            if self.job is not None:
+                pass  # a background job's shell keeps its own directory
+            elif cwd is not None:
+                # The persistent shell reports where the command left it
+                if cwd != os.getcwd():
+                    try:
+                        self.last_dir = os.getcwd()
+                        os.chdir(cwd)
+                    except OSError as e:
+                        print(f"Could not follow the shell to {cwd}: {e}", file=sys.stderr)
+            # Without it, follow only simple cd commands
+            elif command.strip().startswith("cd ") and " && " not in command and ";" not in command:
                 new_dir = command.strip()[3:].strip()
                 try:
                     if new_dir == "-":
@@ -257,7 +489,8 @@ class AIShell:
         self.session.message = lambda: f"{os.getcwd()}$ "
 
     def exit_raw_mode(self):
-        termios.tcsetattr(sys.stdin, termios.TCSADRAIN, self.terminal_controller.old_settings)
+        if self.terminal_controller.old_settings is not None:
+            termios.tcsetattr(sys.stdin, termios.TCSADRAIN, self.terminal_controller.old_settings)
         sys.stdout.write('\r\n')  # Add carriage return and newline
         sys.stdout.flush()
 
@@ -271,9 +504,35 @@ class AIShell:
         # Restore terminal settings for normal input
         self.exit_raw_mode()
         question = input("Enter question: ")
-        context = self.context_manager.get_context(for_question=True)
-        answer = self.llm_interface.answer_question(question, context)
-        print(f"Answer: {answer}")
+        with self.tracer.span("question_context") as trace:
+            context = self.context_manager.get_context(for_question=True, question=question)
+            trace["messages"] = len(context)
+            retrieval = self.context_manager.last_retrieval
+            if retrieval is not None:
+                trace.update(retrieval)
+        if retrieval is not None:
+            self.print_debug(
+                f"Question context: {retrieval['chunks']} matching chunks of {retrieval['indexed']} indexed, "
+                f"{retrieval['recent']} recent messages"
+            )
+        streamed = []
+
+        def print_delta(delta):
+            if not streamed:
+                print("Answer: ", end='', flush=True)
+            streamed.append(delta)
+            print(delta, end='', flush=True)
+
+        answer = self.llm_interface.answer_question(
+            question, context,
+            read_output=self.context_manager.read_spilled_output,
+            on_delta=print_delta
+        )
+        if streamed:
+            print()
+        if answer.strip() != "".join(streamed).strip():
+            # Nothing was streamed, or the stream broke off and answer holds the error
+            print(f"Answer: {answer}")
 
     def handle_ctrl_e_l(self):
         # Restore terminal settings for normal input
@@ -292,6 +551,68 @@ class AIShell:
         print(f"Interactive mode {'enabled' if self.interactive_mode else 'disabled'}.")
 
 
+    def handle_ctrl_e_c(self):
+        cache = self.llm_interface.cache
+        if cache is None:
+            print("Response cache is disabled (AISHELL_CACHE_DB is empty or could not be opened).")
+        else:
+            self.llm_interface.cache_replay = not self.llm_interface.cache_replay
+            print(f"Cached response replay {'enabled' if self.llm_interface.cache_replay else 'disabled'}.")
+            stats = cache.stats()
+            print(
+                f"Cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%} hit rate), "
+                f"{stats['invalidations']} invalidated, {stats['stores']} stored this session, {stats['entries']} entries on disk"
+            )
+
+        prompt = self.llm_interface.prompt_stats.summary()
+        print(
+            f"Prompts: {prompt['requests']} requests, ~{prompt['prompt_tokens']} tokens, "
+            f"~{prompt['prefix_tokens']} ({prompt['prefix_ratio']:.0%}) repeated from the previous request"
+        )
+        unreported = (
+            f"{prompt['unreported']} streamed requests ended without a usage report "
+            f"(command streams stop as soon as the command is complete)"
+        )
+        if prompt['server_prompt_tokens']:
+            print(
+                f"Provider prompt cache: {prompt['server_cached_tokens']} of {prompt['server_prompt_tokens']} "
+                f"prompt tokens cached ({prompt['server_cached_ratio']:.0%})"
+                + (f"; {unreported}" if prompt['unreported'] else "")
+            )
+        elif prompt['unreported']:
+            print(f"Provider prompt cache: unavailable, {unreported}")
+
+        requests = self.llm_interface.request_stats
+        latency = self.llm_interface.latency.summary()
+        if latency['count']:
+            print(
+                f"LLM latency: p50 {latency['p50']:.2f}s, p95 {latency['p95']:.2f}s over {latency['count']} requests; "
+                f"{requests['hedged']} hedged ({requests['hedge_wins']} won by the hedge), {requests['timeouts']} timed out"
+            )
+        if requests['parse_retries'] or requests['parse_failures']:
+            print(f"Unparseable command responses: {requests['parse_retries']} retried, {requests['parse_failures']} given up")
+        if requests['background_failures']:
+            print(f"Background LLM requests (context summaries) failed: {requests['background_failures']}")
+        routing = self.llm_interface.router.summary()
+        if self.llm_interface.router.enabled:
+            for tier, stats in routing['tiers'].items():
+                latency = stats['latency']
+                line = f"Model {tier} ({stats['backend']}): {stats['requests']} requests, {stats['commands']} commands"
+                if stats['success_rate'] is not None:
+                    line += f", {stats['succeeded']} of {stats['succeeded'] + stats['failed']} ran successfully ({stats['success_rate']:.0%})"
+                line += f", {stats['errors']} errors, {stats['parse_failures']} unparseable"
+                if latency['count']:
+                    line += f"; p50 {latency['p50']:.2f}s, p95 {latency['p95']:.2f}s"
+                print(line)
+            escalations = ", ".join(f"{reason} {count}" for reason, count in sorted(routing['escalations'].items()))
+            print(f"Escalated to the large model: {escalations or 'never'}")
+        normalized = self.context_manager.normalize_stats
+        if normalized['raw_bytes']:
+            print(
+                f"Output normalization: {normalized['saved_bytes']} of {normalized['raw_bytes']} bytes "
+                f"({normalized['saved_bytes'] / normalized['raw_bytes']:.0%}) kept out of the context over {normalized['outputs']} outputs"
+            )
+
     def print_ctrl_e_help(self):
         help_text = (
             "Ctrl-E Commands:\n"
@@ -301,6 +622,11 @@ class AIShell:
             "l: Set a limit (max number of actions without confirmation)\n"
             "i: Toggle interactive mode (commands with sudo ALWAYS require confirmation)\n"
             "d: Toggle debug mode\n"
+            "c: Toggle replay of cached LLM responses and show cache, prompt-prefix and model routing stats\n"
+            "t: Show per-phase timings (p50/p95) for this session\n"
+            "j: List background jobs (end an instruction or command with & to start one)\n"
+            "f: Bring a background job to the foreground (answer its prompts; Ctrl-C detaches)\n"
+            "k: Stop a background job\n"
             "h or ?: Display this help message\n\n"
             "Press Enter or any other key to exit Ctrl-E mode\n"
         )
@@ -319,6 +645,10 @@ class AIShell:
             print("No instruction provided. Returning to interactive shell.")
             return  # Do nothing, just return to the interactive shell
 
+        if instruction.endswith("&"):
+            self.start_ai_job(instruction[:-1].strip())
+            return
+
         self.process_instruction(instruction)
 
 
@@ -333,24 +663,31 @@ class AIShell:
 
     def process_instruction(self, instruction):
         system_info = self.get_system_info()
-        system_info_str = "System Information:\n" + "\n".join([f"{k}: {v}" for k, v in system_info.items()])
-        context = self.context_manager.get_context()
+        system_info_str = "\n".join([f"{k}: {v}" for k, v in system_info.items()])
+        context = self.build_context()
 
         continue_execution = True
+        # Generations so far, and why the next one needs the large model
+        step = 0
+        escalate = None
         
         while continue_execution and self.running:
             try:
-                self.print_debug(f"Sending instruction to LLM: {instruction}")
-                self.print_debug(f"Context: {json.dumps(context, indent=2)}")
+                if self.debug_mode:
+                    self.print_debug(f"Sending instruction to LLM: {instruction} ({len(context)} context messages)")
 
-                bash_command, error = self.llm_interface.generate_command(
+                bash_command, error, tier, cached = self.llm_interface.generate_routed_command(
                     instruction=instruction, 
                     context=context, 
                     interactive_mode=self.interactive_mode, 
                     remaining_commands=self.execution_limit - self.execution_count if self.execution_limit else "unlimited",
                     limit=self.execution_limit or "unlimited",
-                    system_info=system_info_str
+                    system_info=system_info_str,
+                    step=step,
+                    escalate=escalate
                 )
+                step += 1
+                escalate = None
                 
                 if error:
                     print(f"Error generating command: {error}")
@@ -364,6 +701,19 @@ class AIShell:
                             print(f"AI Assistant note: {command_data['savecontext']}")
                             context.append({"role": "assistant", "content": command_data['savecontext']})
                             continue
+                        if isinstance(command_data.get('commands'), list):
+                            batch = CommandBatch(command_data['commands'])
+                            if not batch:
+                                print("Error: the command batch is empty")
+                                return
+                            if not self.run_batch(batch, cached):
+                                return
+                            self.llm_interface.record_outcome(tier, not batch.failed)
+                            if batch.failed:
+                                escalate = "failed_command"
+                            continue_execution = command_data.get('continue', False) or bool(batch.failed)
+                            context = self.build_context()
+                            continue
                         bash_command = command_data.get('bash')
                         if not bash_command:
                             print("Error: 'bash' key not found in command data")
@@ -373,7 +723,13 @@ class AIShell:
                         print(f"Error parsing command JSON: {bash_command}")
                         return
 
-                    if self.interactive_mode or bash_command.startswith('sudo') or 'sudo ' in bash_command:
+                    if cached:
+                        # Replayed commands are always confirmed, whatever the mode
+                        print(f"Cached command: {bash_command}")
+                        if not self.user_interface.confirm_execution():
+                            print("Command execution cancelled.")
+                            return
+                    elif self.interactive_mode or bash_command.startswith('sudo') or 'sudo ' in bash_command:
                         print(f"Generated command: {bash_command}")
                         if not self.user_interface.confirm_execution():
                             print("Command execution cancelled.")
@@ -386,6 +742,7 @@ class AIShell:
                         if not self.running:
                             return  # Exit if the 'exit' command was executed
                         self.execution_count += 1
+                        self.llm_interface.record_outcome(tier, return_code == 0)
                         
                         if return_code != 0:
                             print(f"Command failed with return code {return_code}")
@@ -394,10 +751,11 @@ class AIShell:
                             
                             correction_instruction = f"Automated interpreter message: The previous command '{bash_command}' failed with return code {return_code}. stdout: {stdout}, stderr: {stderr}. Please provide a corrected command or explain why it failed and suggest an alternative approach (with an echo)"
                             context.append({"role": "user", "content": correction_instruction})
+                            escalate = "failed_command"
                             continue_execution = True
                             continue
                         
-                        context = self.context_manager.get_context()
+                        context = self.build_context()
                         
                         if bash_command.startswith("echo ") and "reason to stop" in bash_command:
                             print(f"\nAI Assistant stopped execution: {stdout.strip()}")
@@ -416,7 +774,244 @@ class AIShell:
                 return
 
 
+    def run_batch(self, batch, cached=False):
+        # Returns False when the batch was cancelled or the limit was reached
+        remaining = None if self.execution_limit is None else self.execution_limit - self.execution_count
+        if remaining is not None and remaining <= 0:
+            print("Execution limit reached. Use 'Ctrl-E l' to set a new limit.")
+            return False
+
+        confirm = (
+            cached
+            or self.interactive_mode
+            or any(entry["bash"].startswith('sudo') or 'sudo ' in entry["bash"] for entry in batch.entries)
+        )
+        label = "Cached" if cached else "Generated"
+        if confirm:
+            print(f"{label} batch of {len(batch)} commands:")
+        else:
+            self.print_green(f"Executing batch of {len(batch)} commands:")
+        for entry in batch.entries:
+            after = f" (after {', '.join(entry['after'])})" if entry["after"] else ""
+            print(f"  [{entry['id']}] {entry['bash']}{after}")
+        if confirm and not self.user_interface.confirm_execution():
+            print("Command execution cancelled.")
+            return False
+
+        # Pool commands start from the persistent shell's directory and exports
+        cwd, env = self.command_executor.session_state()
+
+        def run_foreground(command):
+            stdout, stderr = self.command_executor.execute(command)
+            return stdout, stderr, self.command_executor.last_return_code, self.command_executor.last_captures
+
+        def on_start(entry):
+            # Terminal commands stream their output; the others print on completion
+            if entry["foreground"]:
+                self.print_green(f"[{entry['id']}] {entry['bash']}")
+
+        def on_done(entry):
+            if entry["status"] == "skipped":
+                print(f"[{entry['id']}] skipped: {entry['reason']}")
+                return
+            if not entry["foreground"]:
+                self.print_green(f"[{entry['id']}] {entry['bash']}")
+                if entry["stdout"]:
+                    print(entry["stdout"], end='' if entry["stdout"].endswith("\n") else "\n")
+                if entry["stderr"]:
+                    print(entry["stderr"], file=sys.stderr, end='' if entry["stderr"].endswith("\n") else "\n")
+            if entry["return_code"] != 0:
+                print(f"[{entry['id']}] failed with return code {entry['return_code']}")
+
+        self.interrupt_counter = 0
+        with self.tracer.span("batch", commands=len(batch)) as trace:
+            batch.run(
+                lambda command: self.command_executor.run_captured(command, cwd=cwd, env=env),
+                run_foreground,
+                needs_foreground=wants_pty,
+                max_workers=self.batch_workers,
+                budget=remaining,
+                on_start=on_start,
+                on_done=on_done
+            )
+            trace["executed"] = batch.executed
+            trace["failed"] = len(batch.failed)
+        self.execution_count += batch.executed
+        self.context_manager.add_batch(batch.entries)
+        if any(entry.get("reason") == "execution limit reached" for entry in batch.entries):
+            print("Execution limit reached. Use 'Ctrl-E l' to set a new limit.")
+            return False
+        return True
+
+    def build_context(self):
+        with self.tracer.span("context") as trace:
+            context = self.context_manager.get_context()
+            trace["messages"] = len(context)
+        return context
+
+    def handle_ctrl_e_t(self):
+        summary = self.tracer.summary()
+        if not summary:
+            print("No timings recorded yet.")
+            return
+        print(f"{'phase':<15} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+        for phase, stats in summary.items():
+            print(f"{phase:<15} {stats['count']:>6} {stats['p50'] * 1000:>9.1f} {stats['p95'] * 1000:>9.1f} {stats['max'] * 1000:>9.1f}")
+        if self.tracer.path:
+            self.tracer.flush()
+            print(f"Trace: {self.tracer.path}")
+
+    def job_executor(self):
+        # A background job's own bash session, started from the foreground
+        # shell's directory and exports, without terminal input and with its
+        # processes counted against the scheduler
+        executor = CommandExecutor(
+            stream_output=True,
+            max_capture_bytes=self.command_executor.max_capture_bytes,
+            spill_output=True,
+            persistent_shell=self.command_executor.persistent_shell,
+            pty_mode="never",
+            stdin=subprocess.DEVNULL,
+            scheduler=self.scheduler
+        )
+        if executor.persistent_shell:
+            cwd, env = self.command_executor.session_state()
+            try:
+                executor.session = BashSession(cwd=cwd, env=env, stdin=subprocess.DEVNULL)
+            except BashSessionError:
+                executor.persistent_shell = False
+        return executor
+
+    def start_command_job(self, command):
+        executor = self.job_executor()
+
+        def run(job):
+            job.on_cancel = executor.stop_current_command
+            try:
+                job.output = executor.execute(command)
+                return executor.last_return_code
+            finally:
+                executor.close()
+
+        job = self.jobs.start("command", command, run)
+        print(f"[{job.id}] {command}")
+
+    def start_ai_job(self, instruction):
+        # A copy of this shell with the job's own executor, context view,
+        # execution count and prompts; modes and limits are those at start.
+        # Copied and forked here: the context store is only safe to read on
+        # this thread, and the LLM interface is loaded first so the job
+        # shares it rather than building its own
+        llm_interface = self.llm_interface
+        agent = copy.copy(self)
+        agent.context_manager = self.context_manager.fork(
+            summarizer=lambda messages: llm_interface.summarize(messages)
+        )
+        agent.execution_count = 0
+
+        def run(job):
+            agent.job = job
+            agent.command_executor = self.job_executor()
+            agent.user_interface = job
+
+            def cancel():
+                agent.running = False
+                agent.command_executor.stop_current_command()
+
+            job.on_cancel = cancel
+            try:
+                agent.process_instruction(instruction)
+            finally:
+                agent.command_executor.close()
+                agent.context_manager.close()
+            return 0
+
+        job = self.jobs.start("ai", instruction, run)
+        print(f"[{job.id}] {instruction} (Ctrl-E j lists jobs, Ctrl-E f follows one)")
+
+    def report_jobs(self):
+        # Before each prompt: announce jobs that finished or are waiting for
+        # an answer, and record what finished jobs did in the session context
+        for job in self.jobs.notices():
+            if job.finished is None:
+                print(f"{job.describe()} (Ctrl-E f to answer)")
+                continue
+            print(job.describe())
+            if job.kind == "command":
+                stdout, stderr = job.output or ("", "")
+                self.context_manager.add_command(job.title, stdout, stderr)
+            else:
+                self.context_manager.add_message("assistant", json.dumps({
+                    "background_job": job.title,
+                    "status": job.status,
+                    "output_tail": job.log.tail(JOB_CONTEXT_LINES),
+                }))
+
+    def pick_job(self):
+        default = self.jobs.get()
+        if default is None:
+            print("No background jobs.")
+            return None
+        if len(self.jobs.list()) > 1:
+            answer = input(f"Job number [{default.id}]: ").strip()
+            if answer:
+                job = self.jobs.get(int(answer)) if answer.isdigit() else None
+                if job is None:
+                    print(f"No job {answer}.")
+                return job
+        return default
+
+    def handle_ctrl_e_j(self):
+        jobs = self.jobs.list()
+        if not jobs:
+            print("No background jobs.")
+        for job in jobs:
+            print(job.describe())
+        print(self.scheduler.describe())
+
+    def handle_ctrl_e_f(self):
+        job = self.pick_job()
+        if job is None:
+            return
+        print(f"{job.describe()} (Ctrl-C detaches)")
+        self.following_job = job
+        try:
+            while self.following_job is job:
+                dropped, text = job.log.read_new()
+                if dropped:
+                    print(f"[... {dropped} bytes of output not shown ...]")
+                if text:
+                    print(text, end='', flush=True)
+                if job.question is not None:
+                    # Whatever the job printed before asking belongs above the question
+                    _, text = job.log.read_new()
+                    print(text, end='', flush=True)
+                    job.reply(input(job.question))
+                elif job.finished is not None:
+                    break
+                else:
+                    time.sleep(JOB_FOLLOW_INTERVAL)
+        finally:
+            self.following_job = None
+        if job.finished is None:
+            print(f"\n[{job.id}] continues in the background")
+        else:
+            print(job.describe())
+
+    def handle_ctrl_e_k(self):
+        job = self.pick_job()
+        if job is None:
+            return
+        if job.finished is not None:
+            print(f"{job.describe()} has already finished")
+            return
+        job.cancel()
+        print(f"Stopping [{job.id}] {job.title}")
+
     def print_green(self, text):
+        if self.job is not None:
+            print(text)  # into the job's log, without terminal styling
+            return
         style = Style.from_dict({
             'green': '#00ff00 bold',
         })
@@ -424,6 +1019,10 @@ class AIShell:
 
 
     def handle_interrupt(self, signum, frame):
+        if self.following_job is not None:
+            # Detach from `fg`; the job keeps running
+            self.following_job = None
+            return
         # Check if there is a running command
         if self.current_process:
             # Stop the running command (call to stop_current_command from CommandExecutor)
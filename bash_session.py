@@ -0,0 +1,190 @@
+import os
+import secrets
+import selectors
+import shutil
+import signal
+import subprocess
+
+CHUNK_SIZE = 64 * 1024
+
+# Reads NUL-terminated commands from a pipe and evals them in this one shell,
+# so cd, exports, aliases and functions carry over between commands. After
+# each command a marker goes to stdout and stderr (everything before it
+# belongs to the command) and "status\0cwd\0" goes to the status pipe. The
+# command pipes are closed for the command itself; stdin stays the terminal.
+# SIGINT interrupts the running command but not the loop. Commands are
+# eval'd in a function so a stray break or continue cannot leave the loop
+# (a plain declare in them is local to it; declare -g is not). The marker
+# is not left in the environment commands see.
+DRIVER = r"""
+trap ':' INT
+shopt -s expand_aliases
+__aishell_mark=$__AISHELL_MARK
+unset __AISHELL_MARK
+__aishell_run() { eval "$1"; }
+while :; do
+    IFS= read -r -d '' __aishell_command <&{command_fd}
+    __aishell_status=$?
+    if [ $__aishell_status -gt 128 ]; then continue; fi
+    if [ $__aishell_status -ne 0 ]; then break; fi
+    __aishell_run "$__aishell_command" {command_fd}<&- {status_fd}>&-
+    __aishell_status=$?
+    printf '\0%s\0' "$__aishell_mark"
+    printf '\0%s\0' "$__aishell_mark" >&2
+    printf '%d\0%s\0' "$__aishell_status" "$PWD" >&{status_fd}
+done
+"""
+
+
+class BashSessionError(Exception):
+    pass
+
+
+# A long-lived bash coprocess that runs commands one at a time. run() streams
+# the command's stdout/stderr to callbacks and returns its exit code and the
+# shell's working directory afterwards. If the shell dies (the command ran
+# `exit`, or exec'd something) the next run() starts a fresh one. Output a
+# background job wrote after a command's marker is kept per stream and
+# handed to the next command's callbacks.
+class BashSession:
+    def __init__(self, shell=None, cwd=None, env=None, stdin=None):
+        self.shell = shell or shutil.which("bash")
+        if self.shell is None:
+            raise BashSessionError("bash not found")
+        self.cwd = cwd
+        self.env = env
+        # None keeps the terminal; background jobs pass subprocess.DEVNULL
+        self.stdin = stdin
+        self.process = None
+        self.commands = 0
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        command_read, self.command_write = os.pipe()
+        self.status_read, status_write = os.pipe()
+        mark = secrets.token_hex(16)
+        self.marker = f"\0{mark}\0".encode()
+        env = dict(self.env if self.env is not None else os.environ, __AISHELL_MARK=mark)
+        script = DRIVER.replace("{command_fd}", str(command_read)).replace("{status_fd}", str(status_write))
+        try:
+            self.process = subprocess.Popen(
+                [self.shell, "--noprofile", "--norc", "-c", script],
+                stdin=self.stdin,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                pass_fds=(command_read, status_write),
+                cwd=self.cwd or os.getcwd(),
+                env=env
+            )
+        finally:
+            os.close(command_read)
+            os.close(status_write)
+        self.leftovers = {self.process.stdout: bytearray(), self.process.stderr: bytearray()}
+        self.commands = 0
+
+    def run(self, command, on_stdout=None, on_stderr=None):
+        # Returns (exit code, cwd); cwd is None if the shell exited
+        if not self.alive:
+            self.close()
+            self.start()
+        try:
+            os.write(self.command_write, command.replace("\0", "").encode() + b"\0")
+        except BrokenPipeError:
+            return self._exited()
+        self.commands += 1
+
+        outputs = {
+            self.process.stdout: [self.leftovers[self.process.stdout], on_stdout, False],
+            self.process.stderr: [self.leftovers[self.process.stderr], on_stderr, False],
+        }
+        status = bytearray()
+        with selectors.DefaultSelector() as selector:
+            for pipe in outputs:
+                selector.register(pipe, selectors.EVENT_READ)
+            selector.register(self.status_read, selectors.EVENT_READ)
+            while selector.get_map():
+                for key, _ in selector.select():
+                    chunk = os.read(key.fd, CHUNK_SIZE)
+                    if not chunk:
+                        # EOF: the shell itself has exited
+                        for pending, callback, _ in outputs.values():
+                            if pending and callback:
+                                callback(bytes(pending))
+                        return self._exited()
+                    if key.fileobj == self.status_read:
+                        status += chunk
+                        if status.count(b"\0") >= 2:
+                            selector.unregister(key.fileobj)
+                        continue
+                    state = outputs[key.fileobj]
+                    state[0] += chunk
+                    if self._drain(state):
+                        selector.unregister(key.fileobj)
+
+        for pipe, state in outputs.items():
+            self.leftovers[pipe] = state[0]
+        code, cwd = bytes(status).split(b"\0")[:2]
+        self.cwd = os.fsdecode(cwd)
+        return int(code), self.cwd
+
+    def _drain(self, state):
+        # Hands everything before the marker to the callback; keeps back a
+        # possible partial marker at the end. Returns True once it was seen.
+        pending, callback, _ = state
+        index = pending.find(self.marker)
+        if index >= 0:
+            data, rest = bytes(pending[:index]), pending[index + len(self.marker):]
+            state[2] = True
+        else:
+            split = max(0, len(pending) - len(self.marker) + 1)
+            data, rest = bytes(pending[:split]), pending[split:]
+        if data and callback:
+            callback(data)
+        # Output after the marker came from a background job; run() keeps it
+        # for the next command
+        state[0] = bytearray(rest)
+        return state[2]
+
+    def _exited(self):
+        code = self.process.wait()
+        self.close()
+        return (128 - code if code < 0 else code), None
+
+    def interrupt(self):
+        # SIGINT the running command (the shell's children) but not the shell
+        if not self.alive:
+            return
+        try:
+            with open(f"/proc/{self.process.pid}/task/{self.process.pid}/children") as f:
+                children = [int(pid) for pid in f.read().split()]
+        except OSError:
+            # No /proc: the only way to stop the command is to restart the shell
+            self.close()
+            return
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGINT)
+            except ProcessLookupError:
+                pass
+
+    def close(self):
+        if self.process is None:
+            return
+        for fd in (self.command_write, self.status_read):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
+        self.process = None
@@ -0,0 +1,98 @@
+# Microbenchmark for ContextManager add/prune/get_context at 10k+ messages.
+#
+# Compares the ContextStore-backed ContextManager against the previous
+# deque + len(str(message)) implementation, kept inline below for reference.
+#
+#   python benchmarks/bench_context_store.py [--messages 20000]
+import argparse
+import json
+import os
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_manager import ContextManager
+
+
+class LegacyContextManager:
+    def __init__(self, max_chars):
+        self.context = deque()
+        self.max_chars = max_chars
+        self.char_count = 0
+        self.last_user_instruction = None
+        self.saved_contexts = []
+
+    def add_message(self, role, content):
+        message = {"role": role, "content": content}
+        self.context.append(message)
+        self.char_count += len(str(message))
+        self._prune()
+
+    def add_command(self, input_cmd, stdout, stderr, from_llm=False):
+        content = json.dumps({"input": input_cmd, "stdout": stdout, "stderr": stderr})
+        self.add_message("user", content if not from_llm else "")
+        self.add_message("assistant", content if from_llm else "")
+
+    def get_context(self):
+        relevant_context = []
+        char_count = 0
+        for message in reversed(self.context):
+            if message == self.last_user_instruction:
+                relevant_context.append(message)
+                break
+            if char_count + len(str(message)) <= self.max_chars:
+                relevant_context.append(message)
+                char_count += len(str(message))
+            else:
+                break
+        return list(reversed(relevant_context))
+
+    def _prune(self):
+        while self.char_count > self.max_chars:
+            if len(self.context) > 1 and self.context[0] != self.last_user_instruction and self.context[0] not in self.saved_contexts:
+                removed = self.context.popleft()
+                self.char_count -= len(str(removed))
+            else:
+                break
+
+
+def run(manager, commands):
+    start = time.perf_counter()
+    for i in range(commands):
+        manager.add_command(f"ls -la /var/log/{i}", f"total {i}\n" + "-rw-r--r-- 1 root root 4096 log\n" * 8, "")
+    add_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rounds = 200
+    for i in range(rounds):
+        manager.get_context()
+        manager.add_command(f"echo {i}", f"{i}\n", "")
+    get_elapsed = time.perf_counter() - start
+
+    messages = len(manager.context)
+    return add_elapsed / (commands * 2) * 1e6, get_elapsed / rounds * 1e6, messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000, help="messages to add (two per command)")
+    args = parser.parse_args()
+    commands = args.messages // 2
+    # Small enough that pruning runs for most of the benchmark
+    budget_tokens = args.messages * 30
+
+    implementations = [
+        # Normalization is measured separately (bench_normalizer.py); the legacy manager stores output raw
+        ("ContextStore", ContextManager(max_tokens=budget_tokens, normalize_output=False)),
+        ("legacy deque", LegacyContextManager(max_chars=budget_tokens * 4)),
+    ]
+    print(f"{'implementation':<14} {'add+prune us/msg':>17} {'get+add us/step':>16} {'live msgs':>10}")
+    for name, manager in implementations:
+        add_us, get_us, messages = run(manager, commands)
+        print(f"{name:<14} {add_us:>17.2f} {get_us:>16.1f} {messages:>10}")
+
+
+if __name__ == "__main__":
+    main()
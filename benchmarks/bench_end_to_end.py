@@ -0,0 +1,158 @@
+# End-to-end latency benchmark for AIShell.process_instruction.
+#
+# Drives a headless AIShell against MockLLMServer through a scripted
+# multi-step ("continue": true) scenario with configurable model latency and
+# token rate, and reports where the time goes: time to the first command,
+# per-step overhead (step time minus model time and command time), bytes sent
+# per request, and parse retries, plus the tracer's per-phase p50/p95 with
+# --json. The "batch" row runs the same commands from a single batched
+# response. Nothing leaves the machine.
+#
+#   python benchmarks/bench_end_to_end.py [--steps 5] [--latency 0.2] [--tokens-per-second 200] [--json]
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aishell import AIShell
+from mock_llm_server import MockLLMServer
+
+# Prose the scripted model "thinks" before each command, so the token rate matters
+REASONING = "The previous output looks as expected, so the next step is to continue with the plan. " * 3
+
+
+class BenchShell(AIShell):
+    # Non-interactive AIShell that timestamps every command it runs
+    def __init__(self):
+        super().__init__()
+        self.interactive_mode = False
+        self.command_times = []
+
+    def execute_command(self, command, from_llm=False):
+        started = time.perf_counter()
+        try:
+            return super().execute_command(command, from_llm)
+        finally:
+            self.command_times.append((started, time.perf_counter()))
+
+    def run_batch(self, batch, cached=False):
+        started = time.perf_counter()
+        try:
+            return super().run_batch(batch, cached)
+        finally:
+            self.command_times.append((started, time.perf_counter()))
+
+
+def script(steps, output_lines, bad_responses, batch=False):
+    if batch:
+        commands = [{"id": str(step), "bash": f"seq 1 {output_lines} | sed 's/^/step {step}: /'"} for step in range(steps)]
+        return [f"{REASONING}\n\n{json.dumps({'commands': commands})}"]
+    responses = []
+    for step in range(steps):
+        if step < bad_responses:
+            # Unparseable reply: costs one retry round-trip
+            responses.append("I would run seq next.")
+        command = {"bash": f"seq 1 {output_lines} | sed 's/^/step {step}: /'"}
+        if step < steps - 1:
+            command["continue"] = True
+        responses.append(f"{REASONING}\n\n{json.dumps(command)}")
+    return responses
+
+
+@contextlib.contextmanager
+def scripted_environment(server, stream):
+    overrides = {
+        "AZURE_OPENAI_API_KEY": "bench",
+        "AZURE_OPENAI_ENDPOINT": server.url,
+        "AZURE_OPENAI_DEPLOYMENT_NAME": "mock-deployment",
+        "AISHELL_STREAM": "1" if stream else "0",
+        "AISHELL_CACHE_DB": "",
+        "AISHELL_SESSION_DB": "",
+        "AISHELL_HISTORY_DB": "",
+        "AISHELL_PRECONNECT": "0",
+    }
+    saved = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def run_scenario(steps=5, latency=0.0, tokens_per_second=None, stream=True, output_lines=20, bad_responses=0, batch=False):
+    responses = script(steps, output_lines, bad_responses, batch)
+    with MockLLMServer(responses, delays=[latency] * len(responses), tokens_per_second=tokens_per_second) as server:
+        with scripted_environment(server, stream), contextlib.redirect_stdout(io.StringIO()):
+            shell = BenchShell()
+            started = time.perf_counter()
+            shell.process_instruction("run the scripted scenario")
+            finished = time.perf_counter()
+            shell.context_manager.close()
+        service_times = list(server.service_times)
+        request_bytes = list(server.request_bytes)
+
+    commands = shell.command_times
+    # A step runs from the end of the previous command to the end of its own
+    step_overheads = []
+    step_start = started
+    for command_start, command_end in commands:
+        model_time = sum(end - begin for begin, end in service_times if step_start <= begin < command_start)
+        step_overheads.append((command_end - step_start) - model_time - (command_end - command_start))
+        step_start = command_end
+
+    return {
+        "mode": "batch" if batch else "stream" if stream else "complete",
+        "steps": shell.execution_count,
+        "requests": len(request_bytes),
+        "retries": shell.llm_interface.request_stats["parse_retries"],
+        "total_s": finished - started,
+        "first_command_s": commands[0][0] - started if commands else None,
+        "step_overhead_ms": sum(step_overheads) / len(step_overheads) * 1000 if step_overheads else None,
+        "max_step_overhead_ms": max(step_overheads) * 1000 if step_overheads else None,
+        "bytes_per_request": sum(request_bytes) / len(request_bytes) if request_bytes else 0,
+        "max_request_bytes": max(request_bytes, default=0),
+        "phases_ms": {
+            phase: {"p50": stats["p50"] * 1000, "p95": stats["p95"] * 1000}
+            for phase, stats in shell.tracer.summary().items()
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--steps", type=int, default=5, help="commands in the scripted scenario")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds before the mock model starts answering")
+    parser.add_argument("--tokens-per-second", type=float, default=200, help="mock generation speed (0 for instant)")
+    parser.add_argument("--output-lines", type=int, default=20, help="lines of output per command")
+    parser.add_argument("--bad-responses", type=int, default=1, help="unparseable replies to inject (one retry each)")
+    parser.add_argument("--json", action="store_true", help="print results as JSON lines for tracking")
+    args = parser.parse_args()
+
+    results = [
+        run_scenario(args.steps, args.latency, args.tokens_per_second or None, stream, args.output_lines, args.bad_responses)
+        for stream in (True, False)
+    ]
+    results.append(run_scenario(args.steps, args.latency, args.tokens_per_second or None, True, args.output_lines, 0, batch=True))
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+        return
+    print(f"{'mode':<9} {'steps':>5} {'reqs':>5} {'retries':>7} {'first cmd s':>11} {'overhead ms/step':>16} {'bytes/req':>9} {'total s':>8}")
+    for r in results:
+        print(
+            f"{r['mode']:<9} {r['steps']:>5} {r['requests']:>5} {r['retries']:>7} {r['first_command_s']:>11.3f} "
+            f"{r['step_overhead_ms']:>16.2f} {r['bytes_per_request']:>9.0f} {r['total_s']:>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Per-command overhead of CommandExecutor: a fresh /bin/sh per command versus
+# the persistent bash session. With --throughput N it also relays N MiB of
+# output through pipes and through a pty, reporting MiB/s and the CPU time
+# aishell itself spent (the rest is the command and the kernel's tty layer).
+#
+#   python benchmarks/bench_executor.py [--commands 500] [--throughput 64]
+import argparse
+import io
+import os
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from command_executor import CommandExecutor
+
+
+def run(executor, commands):
+    executor.execute_streaming("true", stdout_stream=io.StringIO(), stderr_stream=io.StringIO())
+    start = time.perf_counter()
+    for i in range(commands):
+        executor.execute_streaming(f"echo {i}", stdout_stream=io.StringIO(), stderr_stream=io.StringIO())
+    return (time.perf_counter() - start) / commands * 1000
+
+
+class NullStream:
+    def __init__(self):
+        self.buffer = open(os.devnull, "wb")
+
+    def write(self, text):
+        pass
+
+    def flush(self):
+        pass
+
+
+def throughput(executor, command, mebibytes):
+    # Returns (MiB/s, CPU seconds of this process)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = usage.ru_utime + usage.ru_stime
+    start = time.perf_counter()
+    if executor.uses_pty(command):
+        executor.execute_pty(command, stdout_stream=NullStream())
+    else:
+        executor.execute_streaming(command, stdout_stream=NullStream(), stderr_stream=NullStream())
+    elapsed = time.perf_counter() - start
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return mebibytes / elapsed, usage.ru_utime + usage.ru_stime - cpu
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", type=int, default=500, help="commands to run per executor")
+    parser.add_argument("--throughput", type=int, default=0, metavar="MIB", help="also relay this much output")
+    args = parser.parse_args()
+    print(f"{'executor':<18} {'ms/command':>10}")
+    for name, persistent in (("new shell", False), ("persistent bash", True)):
+        executor = CommandExecutor(stream_output=True, persistent_shell=persistent)
+        print(f"{name:<18} {run(executor, args.commands):>10.3f}")
+        executor.close()
+
+    if args.throughput:
+        size = args.throughput * 1024 * 1024
+        print(f"\n{'relay':<18} {'output':<10} {'MiB/s':>8} {'cpu s':>7}")
+        for name, mode in (("pipes", "never"), ("pty", "always")):
+            executor = CommandExecutor(stream_output=True, pty_mode=mode)
+            for output, command in (("lines", f"yes | head -c {size}"), ("no lines", f"head -c {size} /dev/zero | tr '\\0' x")):
+                rate, cpu = throughput(executor, command, args.throughput)
+                print(f"{name:<18} {output:<10} {rate:>8.1f} {cpu:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
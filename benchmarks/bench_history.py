@@ -0,0 +1,105 @@
+# Per-keystroke cost of history suggestions and Ctrl-R search on a large
+# HistoryStore, against prompt_toolkit's AutoSuggestFromHistory scanning the
+# same entries in memory. The store is built once in a temp directory (or at
+# --db, kept for later runs).
+#
+#   python benchmarks/bench_history.py [--entries 200000] [--db /tmp/history.db]
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
+from prompt_toolkit.buffer import Buffer
+from prompt_toolkit.document import Document
+from prompt_toolkit.history import InMemoryHistory
+
+from history_store import HistoryStore
+
+COMMANDS = [
+    "git status", "git commit -m", "git checkout", "ls -la", "cd", "docker run --rm", "kubectl get pods -n",
+    "kubectl logs -f", "python", "vim", "grep -rn", "make", "ssh", "cat", "tail -f", "find . -name",
+]
+
+
+def make_entries(count, seed=1):
+    rng = random.Random(seed)
+    words = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9))) for _ in range(20000)]
+    return [f"{rng.choice(COMMANDS)} {rng.choice(words)} {rng.choice(words)}/{i % 977}" for i in range(count)]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2] * 1000, samples[int(len(samples) * 0.99)] * 1000, samples[-1] * 1000
+
+
+def keystrokes(function, typed):
+    # Seconds per call for every prefix of each typed string
+    samples = []
+    for text in typed:
+        for i in range(1, len(text) + 1):
+            started = time.perf_counter()
+            function(text[:i])
+            samples.append(time.perf_counter() - started)
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=200000)
+    parser.add_argument("--db", help="history database to build or reuse (default: a temp file)")
+    parser.add_argument("--baseline", type=int, default=100000, help="entries for the in-memory AutoSuggestFromHistory baseline (0 to skip)")
+    args = parser.parse_args()
+
+    path = args.db or os.path.join(tempfile.mkdtemp(), "history.db")
+    entries = make_entries(args.entries)
+    if not os.path.exists(path):
+        store = HistoryStore(path)
+        started = time.perf_counter()
+        for start in range(0, len(entries), 50000):
+            store.add_many(entries[start:start + 50000])
+        print(f"built {len(store)} entries in {time.perf_counter() - started:.1f}s, {os.path.getsize(path) / 2 ** 20:.0f} MiB")
+        store.close()
+
+    started = time.perf_counter()
+    store = HistoryStore(path)
+    print(f"open: {(time.perf_counter() - started) * 1000:.2f} ms")
+
+    rng = random.Random(2)
+    typed = [rng.choice(entries) for _ in range(50)]
+    queries = [" ".join(rng.sample(command.split(), 2)) for command in typed[:25]] + ["".join(rng.sample("qxzjvk", 4)) for _ in range(25)]
+
+    def suggest(text):
+        store.suggest(text)
+
+    def suggest_cold(text):
+        # Without the previous keystroke's answer to narrow
+        store.last_suggestion = None
+        store.suggest(text)
+
+    def search(text):
+        store.search(text)
+
+    print(f"{'operation':<34} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    rows = [("store suggest (typing)", keystrokes(suggest, typed))]
+    rows.append(("store suggest (no narrowing)", keystrokes(suggest_cold, typed)))
+    rows.append(("store search (typing)", keystrokes(search, queries)))
+    if args.baseline:
+        history = InMemoryHistory()
+        for entry in entries[-args.baseline:]:
+            history.append_string(entry)
+        buffer = Buffer(history=history)
+        auto_suggest = AutoSuggestFromHistory()
+        rows.append((f"AutoSuggestFromHistory ({args.baseline // 1000}k)", keystrokes(lambda text: auto_suggest.get_suggestion(buffer, Document(text)), typed[:5])))
+    for name, samples in rows:
+        p50, p99, worst = percentiles(samples)
+        print(f"{name:<34} {p50:>8.3f} {p99:>8.3f} {worst:>8.3f}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+# Throughput and size reduction of OutputNormalizer on synthetic command
+# output: colored ls listings, pip/curl-style \r progress bars, repeated log
+# lines and plain text that should pass through unchanged.
+#
+#   python benchmarks/bench_normalizer.py [--scale 1]
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from output_normalizer import OutputNormalizer
+
+
+def colored_listing(scale):
+    return "".join(
+        f"-rw-r--r-- 1 user user {i * 37 % 9000:>5} Jan {i % 28 + 1:>2} 12:{i % 60:02} \x1b[01;34mfile_{i}.txt\x1b[0m\n"
+        for i in range(5000 * scale)
+    )
+
+
+def progress_bars(scale):
+    chunks = []
+    for package in range(20 * scale):
+        for percent in range(0, 101, 2):
+            bar = "#" * (percent // 4)
+            chunks.append(f"\r\x1b[2KDownloading pkg{package} |{bar:<25}| {percent}%")
+        chunks.append("\n")
+    return "".join(chunks)
+
+
+def repeated_lines(scale):
+    return "".join("WARNING: retrying connection\n" for _ in range(10000 * scale))
+
+
+def plain_text(scale):
+    words = "the quick brown fox jumps over the lazy dog".split()
+    return "".join(
+        " ".join(words[(i + j) % len(words)] for j in range(i % 7 + 3)) + ("." if i % 3 else ":") + "\n"
+        for i in range(5000 * scale)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=1, help="multiplier for the size of each sample")
+    parser.add_argument("--chunk", type=int, default=64 * 1024, help="feed() chunk size in bytes")
+    args = parser.parse_args()
+
+    samples = [
+        ("ls --color", colored_listing(args.scale)),
+        ("progress bars", progress_bars(args.scale)),
+        ("repeated lines", repeated_lines(args.scale)),
+        ("plain text", plain_text(args.scale)),
+    ]
+    print(f"{'output':<15} {'raw KiB':>9} {'normalized KiB':>15} {'saved':>6} {'MB/s':>7}")
+    for name, text in samples:
+        normalizer = OutputNormalizer()
+        started = time.perf_counter()
+        parts = [normalizer.feed(text[i:i + args.chunk]) for i in range(0, len(text), args.chunk)]
+        parts.append(normalizer.finish())
+        seconds = time.perf_counter() - started
+        raw = len(text.encode())
+        normalized = len("".join(parts).encode())
+        print(f"{name:<15} {raw / 1024:>9.0f} {normalized / 1024:>15.1f} {1 - normalized / raw:>6.0%} {raw / seconds / 1e6:>7.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# Size of the Ctrl-E a context with retrieval (ContextIndex top-k chunks plus
+# the newest turns) against the whole history, on a long synthetic session,
+# and what indexing and searching cost.
+#
+#   python benchmarks/bench_retrieval.py [--commands 2000]
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_manager import ContextManager
+from token_counter import TokenCounter
+
+# (question, text the retrieved context has to contain)
+QUESTIONS = [
+    ("why was permission denied?", "Permission denied"),
+    ("which test failed in the build?", "test_upload FAILED"),
+    ("what port is nginx listening on?", "listen 8080"),
+]
+
+
+def build(manager, commands):
+    started = time.perf_counter()
+    for i in range(commands):
+        if i == commands // 3:
+            manager.add_command("cat /etc/nginx/sites-enabled/default", "server {\n    listen 8080;\n    root /var/www;\n}\n", "")
+        elif i == commands // 2:
+            manager.add_command("pytest -q", "".join(f"test_{j} PASSED\n" for j in range(200)) + "test_upload FAILED: timeout\n", "")
+        elif i == commands * 2 // 3:
+            manager.add_command("cat /root/secret.key", "", "cat: /root/secret.key: Permission denied\n")
+        else:
+            manager.add_command(f"ls -la /srv/app/module{i}", "".join(f"-rw-r--r-- 1 app app {j * 97} Mar 3 part{j}.py\n" for j in range(12)), "")
+    return (time.perf_counter() - started) / commands * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--commands", type=int, default=2000)
+    args = parser.parse_args()
+
+    counter = TokenCounter()
+    print(f"{'context':<10} {'add us/cmd':>11} {'question':<34} {'messages':>9} {'tokens':>8} {'ms':>7}")
+    for name, chunks in (("full", 0), ("retrieval", 8)):
+        # A budget large enough to keep the whole session in memory
+        manager = ContextManager(max_tokens=10 ** 7, token_counter=counter, retrieval_chunks=chunks)
+        add_us = build(manager, args.commands)
+        for question, expected in QUESTIONS:
+            started = time.perf_counter()
+            context = manager.get_context(for_question=True, question=question)
+            elapsed = (time.perf_counter() - started) * 1000
+            tokens = sum(counter.count_message(message) for message in context)
+            print(f"{name:<10} {add_us:>11.0f} {question:<34} {len(context):>9} {tokens:>8} {elapsed:>7.2f}")
+            assert expected in "".join(message["content"] for message in context)
+        manager.close()
+
+
+if __name__ == "__main__":
+    main()
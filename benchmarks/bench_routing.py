@@ -0,0 +1,99 @@
+# Command generation time with tiered model routing. Two local mock servers
+# stand in for a slow large model and a fast small one (different token
+# rates); a scripted workload of instructions, some with continue chains and
+# failed commands, is generated once on the large model only and once routed.
+# --small-bad makes that share of the small model's replies unparseable, to
+# see what escalations cost. Nothing leaves the machine.
+#
+#   python benchmarks/bench_routing.py [--instructions 40] [--large-tps 60] [--small-tps 400] [--small-bad 0.1]
+import argparse
+import contextlib
+import os
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_interface import LLMInterface
+from mock_llm_server import MockLLMServer
+
+RESPONSE = '{"reasoning": "Listing the directory answers the question directly.", "bash": "ls -la /srv/app"}'
+
+
+def workload(instructions, seed=1):
+    # (instruction, [escalation of each step]) with a chain of 1-3 steps, where
+    # a step after a failed command is a correction
+    rng = random.Random(seed)
+    work = []
+    for i in range(instructions):
+        steps = [None]
+        for _ in range(rng.choice((0, 0, 1, 2))):
+            steps.append("failed_command" if rng.random() < 0.3 else None)
+        work.append((f"show what is in app directory {i}", steps))
+    return work
+
+
+@contextlib.contextmanager
+def environment(large, small):
+    overrides = {
+        "AISHELL_LLM_BACKEND": "azure",
+        "AZURE_OPENAI_API_KEY": "bench",
+        "AZURE_OPENAI_ENDPOINT": large.url,
+        "AZURE_OPENAI_DEPLOYMENT_NAME": "large",
+        "AISHELL_SMALL_BACKEND": "local" if small else "",
+        "AISHELL_SMALL_MODEL": "small" if small else "",
+        "AISHELL_LOCAL_LLM_URL": f"{small.url}/v1" if small else "",
+    }
+    saved = {name: os.environ.get(name) for name in overrides}
+    os.environ.update(overrides)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def run(work, large, small):
+    with environment(large, small):
+        llm = LLMInterface(http_client=httpx.Client(), cache=None)
+    started = time.perf_counter()
+    for instruction, steps in work:
+        for step, escalate in enumerate(steps):
+            command, error = llm.generate_command(instruction, [], False, 10, 10, "os: Linux", step=step, escalate=escalate)
+            assert error is None, error
+    seconds = time.perf_counter() - started
+    return seconds, llm.router.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--instructions", type=int, default=40)
+    parser.add_argument("--large-tps", type=float, default=60, help="token rate of the large model")
+    parser.add_argument("--small-tps", type=float, default=400, help="token rate of the small model")
+    parser.add_argument("--small-bad", type=float, default=0.1, help="share of unparseable small-model replies")
+    args = parser.parse_args()
+
+    work = workload(args.instructions)
+    steps = sum(len(chain) for _, chain in work)
+    rng = random.Random(2)
+    small_responses = ["I would list the directory." if rng.random() < args.small_bad else RESPONSE for _ in range(steps)]
+    print(f"{len(work)} instructions, {steps} steps")
+    print(f"{'mode':<12} {'total s':>8} {'s/instr':>8} {'small req':>10} {'large req':>10} {'escalations':<40}")
+    with MockLLMServer(default_response=RESPONSE, tokens_per_second=args.large_tps) as large, \
+            MockLLMServer(responses=small_responses, default_response=RESPONSE, tokens_per_second=args.small_tps) as small:
+        for name, tier in (("large only", None), ("routed", small)):
+            seconds, summary = run(work, large, tier)
+            tiers = summary["tiers"]
+            escalations = ", ".join(f"{reason} {count}" for reason, count in sorted(summary["escalations"].items()))
+            small_requests = tiers["small"]["requests"] if "small" in tiers else 0
+            print(f"{name:<12} {seconds:>8.2f} {seconds / len(work):>8.3f} {small_requests:>10} {tiers['large']['requests']:>10} {escalations:<40}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Startup-time benchmark: how long `import aishell` takes and what it pulls in.
+#
+# Parses `python -X importtime` output for the aishell import, checks that the
+# LLM stack (openai, httpx, pydantic, tiktoken) and the pygments lexers stay
+# out of it, and compares the total against STARTUP_BUDGET_MS, exiting
+# nonzero when over it. The tests only check the deferred modules: a
+# wall-clock budget would fail on loaded machines. With --llm it also times loading the LLM stack afterwards,
+# i.e. what the first Ctrl-E would pay without the background preload.
+#
+#   python benchmarks/bench_startup.py [--runs 5] [--top 10] [--llm]
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Cumulative import time of aishell on a warm disk cache
+STARTUP_BUDGET_MS = float(os.getenv("AISHELL_STARTUP_BUDGET_MS", 500))
+DEFERRED_MODULES = ("openai", "httpx", "pydantic", "tiktoken", "pygments.lexers")
+
+
+def import_profile(module="aishell"):
+    # Returns (cumulative ms for module, {imported module: self ms})
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    modules = {}
+    total_ms = None
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue  # header line
+        name = fields[2].strip()
+        modules[name] = self_us / 1000
+        if name == module:
+            total_ms = cumulative_us / 1000
+    return total_ms, modules
+
+
+def llm_load_ms():
+    code = (
+        "import time, aishell\n"
+        "started = time.perf_counter()\n"
+        "import llm_interface\n"
+        "print((time.perf_counter() - started) * 1000)\n"
+    )
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True)
+    return float(result.stdout.strip())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to time")
+    parser.add_argument("--top", type=int, default=10, help="slowest modules to list")
+    parser.add_argument("--llm", action="store_true", help="also time loading the LLM stack after startup")
+    args = parser.parse_args()
+
+    profiles = [import_profile() for _ in range(args.runs)]
+    totals = [total for total, _ in profiles]
+    modules = profiles[-1][1]
+    median = statistics.median(totals)
+    print(f"import aishell: median {median:.1f} ms, min {min(totals):.1f} ms over {args.runs} runs (budget {STARTUP_BUDGET_MS:.0f} ms)")
+    loaded = [name for name in DEFERRED_MODULES if name in modules]
+    print(f"deferred modules imported at startup: {', '.join(loaded) or 'none'}")
+    print(f"\n{'module':<50} {'self ms':>8}")
+    for name, self_ms in sorted(modules.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{name:<50} {self_ms:>8.2f}")
+    if args.llm:
+        print(f"\nloading the LLM stack afterwards: {llm_load_ms():.1f} ms")
+    if median > STARTUP_BUDGET_MS or loaded:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+MAX_WORKERS = 4
+
+
+# The commands of one batched LLM response ({"commands": [{"id", "bash",
+# "after"}...]}). run() starts each command once every command listed in its
+# "after" has succeeded, running independent ones concurrently in a thread
+# pool; commands that need the terminal (sudo, editors) run one at a time on
+# the calling thread. A command whose dependency failed or was skipped is
+# skipped, as is everything past the execution budget. Callbacks all run on
+# the calling thread, so their output never interleaves.
+class CommandBatch:
+    def __init__(self, items):
+        self.entries = []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or not isinstance(item.get("bash"), str) or not item["bash"].strip():
+                continue
+            after = item.get("after") or []
+            if isinstance(after, str):
+                after = [after]
+            self.entries.append({
+                "id": str(item.get("id") or index + 1),
+                "bash": item["bash"],
+                "after": [str(dependency) for dependency in after],
+                "status": "pending",
+            })
+        ids = {entry["id"] for entry in self.entries}
+        for entry in self.entries:
+            # Dependencies on commands that aren't in the batch are ignored
+            entry["after"] = [dependency for dependency in entry["after"] if dependency in ids and dependency != entry["id"]]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def run(self, run_parallel, run_foreground, needs_foreground=None, max_workers=MAX_WORKERS,
+            budget=None, on_start=None, on_done=None):
+        # run_parallel/run_foreground(command) -> (stdout, stderr, return code, captures)
+        by_id = {entry["id"]: entry for entry in self.entries}
+        pending = list(self.entries)
+        running = {}
+        started = 0
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batch") as pool:
+            while pending or running:
+                progressed = False
+                for entry in list(pending):
+                    statuses = [by_id[dependency]["status"] for dependency in entry["after"]]
+                    if any(status in ("pending", "running") for status in statuses):
+                        continue
+                    pending.remove(entry)
+                    progressed = True
+                    if any(status != "ok" for status in statuses):
+                        self._skip(entry, "a command it depends on failed", on_done)
+                    elif budget is not None and started >= budget:
+                        self._skip(entry, "execution limit reached", on_done)
+                    else:
+                        started += 1
+                        entry["foreground"] = needs_foreground is not None and needs_foreground(entry["bash"])
+                        entry["status"] = "running"
+                        if on_start is not None:
+                            on_start(entry)
+                        if entry["foreground"]:
+                            self._finish(entry, run_foreground(entry["bash"]), on_done)
+                        else:
+                            running[pool.submit(run_parallel, entry["bash"])] = entry
+                if progressed:
+                    continue  # a foreground command may have unblocked others
+                if running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        entry = running.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            result = ("", str(e), 1, (None, None))
+                        self._finish(entry, result, on_done)
+                else:
+                    for entry in pending:
+                        self._skip(entry, "dependency cycle", on_done)
+                    pending = []
+        return self.entries
+
+    def _finish(self, entry, result, on_done):
+        entry["stdout"], entry["stderr"], entry["return_code"], entry["captures"] = result
+        entry["status"] = "ok" if entry["return_code"] == 0 else "failed"
+        if on_done is not None:
+            on_done(entry)
+
+    def _skip(self, entry, reason, on_done):
+        entry["status"] = "skipped"
+        entry["reason"] = reason
+        if on_done is not None:
+            on_done(entry)
+
+    @property
+    def executed(self):
+        return sum(1 for entry in self.entries if entry["status"] in ("ok", "failed"))
+
+    @property
+    def failed(self):
+        return [entry for entry in self.entries if entry["status"] != "ok"]
@@ -1,22 +1,63 @@
+import os
+import selectors
 import subprocess
 import sys
+import threading
+from output_capture import OutputCapture
+from bash_session import BashSession, BashSessionError
+from pty_executor import PtyExecutor, wants_pty
+
+CHUNK_SIZE = 64 * 1024
 
 class CommandExecutor:
-    def __init__(self):
+    def __init__(self, stream_output=False, max_capture_bytes=64 * 1024, spill_output=False, persistent_shell=False, pty_mode="auto",
+                 stdin=None, scheduler=None):
         self.current_process = None
+        # Background jobs run with stdin=subprocess.DEVNULL and a Scheduler
+        # that caps how many of their processes run at once
+        self.stdin = stdin
+        self.scheduler = scheduler
+        # "auto" runs known terminal programs (vim, top, sudo...) on a pty,
+        # "always" every streamed command, "never" none
+        self.pty_mode = pty_mode
+        self.pty = None
+        # Streamed commands run in one long-lived bash when persistent_shell is set
+        self.persistent_shell = persistent_shell
+        self.session = None
+        self.last_cwd = None
         self.last_return_code = 0
+        self.stream_output = stream_output
+        self.max_capture_bytes = max_capture_bytes
+        self.spill_output = spill_output
+        self.last_captures = (None, None)
+        # Processes started by run_captured() from worker threads
+        self.background_processes = set()
+        self.background_lock = threading.Lock()
 
     def execute(self, command):
+        if self.scheduler is not None:
+            with self.scheduler.process_slot():
+                return self._execute(command)
+        return self._execute(command)
+
+    def _execute(self, command):
+        if self.stream_output:
+            if self.uses_pty(command):
+                return self.execute_pty(command)
+            return self.execute_streaming(command)
+
+        self.last_captures = (None, None)
         try:
             self.current_process = subprocess.Popen(
                 command,
                 shell=True,
+                stdin=self.stdin,
                 stdout=subprocess.PIPE,
                 stderr=subprocess.PIPE,
                 text=True,
                 universal_newlines=True
             )
-            
+
             stdout, stderr = self.current_process.communicate()
             self.last_return_code = self.current_process.returncode
 
@@ -28,9 +69,179 @@ class CommandExecutor:
         finally:
             self.current_process = None
 
+    def execute_streaming(self, command, stdout_stream=None, stderr_stream=None):
+        # Relay output to the terminal as it arrives and keep only a bounded copy
+        stdout_stream = stdout_stream or sys.stdout
+        stderr_stream = stderr_stream or sys.stderr
+        stdout_capture = OutputCapture(self.max_capture_bytes, spill=self.spill_output)
+        stderr_capture = OutputCapture(self.max_capture_bytes, spill=self.spill_output)
+        self.last_captures = (stdout_capture, stderr_capture)
+        self.last_cwd = None
+
+        session = self._session()
+        if session is not None:
+            try:
+                self.last_return_code, self.last_cwd = session.run(
+                    command,
+                    lambda chunk: self._collect(stdout_capture, stdout_stream, chunk),
+                    lambda chunk: self._collect(stderr_capture, stderr_stream, chunk)
+                )
+                return stdout_capture.getvalue(), stderr_capture.getvalue()
+            finally:
+                stdout_capture.close()
+                stderr_capture.close()
+
+        try:
+            self.current_process = subprocess.Popen(
+                command,
+                shell=True,
+                stdin=self.stdin,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE
+            )
+
+            with selectors.DefaultSelector() as selector:
+                selector.register(self.current_process.stdout, selectors.EVENT_READ, (stdout_capture, stdout_stream))
+                selector.register(self.current_process.stderr, selectors.EVENT_READ, (stderr_capture, stderr_stream))
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        chunk = os.read(key.fd, CHUNK_SIZE)
+                        if not chunk:
+                            selector.unregister(key.fileobj)
+                            key.fileobj.close()
+                            continue
+                        capture, stream = key.data
+                        self._collect(capture, stream, chunk)
+
+            self.last_return_code = self.current_process.wait()
+            return stdout_capture.getvalue(), stderr_capture.getvalue()
+        finally:
+            stdout_capture.close()
+            stderr_capture.close()
+            self.current_process = None
+
+    def uses_pty(self, command):
+        if self.stdin is not None:
+            return False  # no terminal to attach
+        if self.pty_mode == "always":
+            return True
+        return self.pty_mode == "auto" and wants_pty(command)
+
+    def execute_pty(self, command, stdin_fd=None, stdout_stream=None):
+        # The command runs in its own session on a pty, starting from the
+        # persistent shell's directory and exported environment; stderr is
+        # merged into stdout as on a terminal
+        capture = OutputCapture(self.max_capture_bytes, spill=self.spill_output)
+        self.last_captures = (capture, None)
+        self.last_cwd = None
+        cwd, env = self.session_state()
+        self.pty = PtyExecutor(stdin_fd=stdin_fd, stdout_stream=stdout_stream)
+        try:
+            self.last_return_code = self.pty.run(command, capture.write, cwd=cwd, env=env)
+            # The terminal driver turned every newline into \r\n
+            return capture.getvalue().replace("\r\n", "\n"), ""
+        finally:
+            capture.close()
+            self.pty = None
+
+    def run_captured(self, command, cwd=None, env=None):
+        # Thread-safe: runs the command in its own shell with output captured
+        # (bounded) rather than relayed, so several can run at once. Returns
+        # (stdout, stderr, return code, (stdout capture, stderr capture)).
+        if self.scheduler is not None:
+            with self.scheduler.process_slot():
+                return self._run_captured(command, cwd, env)
+        return self._run_captured(command, cwd, env)
+
+    def _run_captured(self, command, cwd, env):
+        stdout_capture = OutputCapture(self.max_capture_bytes, spill=self.spill_output)
+        stderr_capture = OutputCapture(self.max_capture_bytes, spill=self.spill_output)
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=cwd,
+            env=env
+        )
+        with self.background_lock:
+            self.background_processes.add(process)
+        try:
+            with selectors.DefaultSelector() as selector:
+                selector.register(process.stdout, selectors.EVENT_READ, stdout_capture)
+                selector.register(process.stderr, selectors.EVENT_READ, stderr_capture)
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        chunk = os.read(key.fd, CHUNK_SIZE)
+                        if not chunk:
+                            selector.unregister(key.fileobj)
+                            key.fileobj.close()
+                            continue
+                        key.data.write(chunk)
+            code = process.wait()
+            return stdout_capture.getvalue(), stderr_capture.getvalue(), (128 - code if code < 0 else code), (stdout_capture, stderr_capture)
+        finally:
+            with self.background_lock:
+                self.background_processes.discard(process)
+            stdout_capture.close()
+            stderr_capture.close()
+
+    def session_state(self):
+        # (cwd, exported environment) of the persistent shell, or (None, None)
+        if self.session is None or not self.session.alive:
+            return None, None
+        output = bytearray()
+        code, cwd = self.session.run("env -0", output.extend)
+        if code != 0 or cwd is None:
+            return None, None
+        env = {}
+        for entry in bytes(output).split(b"\0"):
+            name, sep, value = entry.partition(b"=")
+            if sep and name:
+                env[os.fsdecode(name)] = os.fsdecode(value)
+        return cwd, env
+
+    def _session(self):
+        if not self.persistent_shell:
+            return None
+        if self.session is None:
+            try:
+                self.session = BashSession(stdin=self.stdin)
+            except BashSessionError as e:
+                print(f"Persistent shell unavailable ({e}); running each command in a new shell", file=sys.stderr)
+                self.persistent_shell = False
+        return self.session
+
+    def _collect(self, capture, stream, chunk):
+        capture.write(chunk)
+        self._relay(stream, chunk)
+
+    def _relay(self, stream, chunk):
+        buffer = getattr(stream, 'buffer', None)
+        if buffer is not None:
+            stream.flush()
+            buffer.write(chunk)
+            buffer.flush()
+        else:
+            stream.write(chunk.decode('utf-8', errors='replace'))
+            stream.flush()
+
     def stop_current_command(self):
-        if self.current_process:
+        with self.background_lock:
+            for process in self.background_processes:
+                process.terminate()
+        if self.pty is not None:
+            self.pty.interrupt()
+        elif self.current_process:
             self.current_process.terminate()
+        elif self.session is not None:
+            self.session.interrupt()
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
 
     def set_limit(self, limit):
         self.limit = limit
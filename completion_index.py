@@ -0,0 +1,121 @@
+import bisect
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+
+# Directory listings kept; each is revalidated against the directory's mtime
+MAX_LISTINGS = 256
+# The PATH index is rebuilt in the background when older than this
+PATH_REFRESH_SECONDS = 30.0
+
+
+def entry_kind(path):
+    # (is_dir, is_executable), read when needed: a chmod does not change the
+    # directory's mtime, so permissions are never cached with a listing
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        # Dangling symlink
+        return False, False
+    is_dir = stat.S_ISDIR(mode)
+    return is_dir, not is_dir and os.access(path, os.X_OK)
+
+
+class DirectoryCache:
+    # Caches os.scandir listings as sorted names. A listing stays valid while
+    # the directory's mtime is unchanged, so a lookup costs one stat() instead
+    # of a scan; callers stat only the names that match (entry_kind).
+    def __init__(self, max_listings=MAX_LISTINGS):
+        self.max_listings = max_listings
+        self.listings = OrderedDict()
+        self.lock = threading.Lock()
+        self.scans = 0
+
+    def listing(self, dirname, block=True):
+        # Returns None when the directory can't be read, or when block is
+        # False and the listing would need a fresh scan
+        try:
+            mtime = os.stat(dirname).st_mtime_ns
+        except OSError:
+            return None
+        key = os.path.abspath(dirname)
+        with self.lock:
+            cached = self.listings.get(key)
+            if cached is not None and cached[0] == mtime:
+                self.listings.move_to_end(key)
+                return cached[1]
+        if not block:
+            return None
+        entries = self._scan(dirname)
+        if entries is None:
+            return None
+        with self.lock:
+            self.listings[key] = (mtime, entries)
+            self.listings.move_to_end(key)
+            while len(self.listings) > self.max_listings:
+                self.listings.popitem(last=False)
+        return entries
+
+    def _scan(self, dirname):
+        self.scans += 1
+        try:
+            with os.scandir(dirname) as it:
+                names = [entry.name for entry in it]
+        except OSError:
+            return None
+        names.sort()
+        return names
+
+
+class PathIndex:
+    # Sorted, de-duplicated names of the executables on $PATH, rebuilt in a
+    # background thread so command-name completion is a bisect. The refresh
+    # checks each entry's permissions, so a chmod shows up within
+    # refresh_seconds.
+    def __init__(self, directory_cache=None, refresh_seconds=PATH_REFRESH_SECONDS):
+        self.directory_cache = directory_cache or DirectoryCache()
+        self.refresh_seconds = refresh_seconds
+        self.names = []
+        self.path = None
+        self.built_at = None
+        self.lock = threading.Lock()
+        self.refreshing = False
+
+    def refresh(self):
+        path = os.environ.get("PATH", "")
+        names = set()
+        for dirname in path.split(os.pathsep):
+            dirname = dirname or "."
+            for name in self.directory_cache.listing(dirname) or ():
+                if name not in names and entry_kind(os.path.join(dirname, name))[1]:
+                    names.add(name)
+        with self.lock:
+            self.names = sorted(names)
+            self.path = path
+            self.built_at = time.monotonic()
+            self.refreshing = False
+
+    def refresh_async(self):
+        with self.lock:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        threading.Thread(target=self.refresh, name="path-index", daemon=True).start()
+
+    def matches(self, prefix):
+        # Never blocks: a missing or stale index is rebuilt in the background
+        # and the current (possibly empty) one is used meanwhile
+        with self.lock:
+            names = self.names
+            stale = (
+                self.built_at is None
+                or self.path != os.environ.get("PATH", "")
+                or time.monotonic() - self.built_at > self.refresh_seconds
+            )
+        if stale:
+            self.refresh_async()
+        start = bisect.bisect_left(names, prefix)
+        end = bisect.bisect_left(names, prefix + "\U0010ffff")
+        return names[start:end]
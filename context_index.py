@@ -0,0 +1,144 @@
+import json
+import math
+import re
+from collections import Counter
+
+# Chunks kept in the index; the first indexed are dropped beyond this
+MAX_CHUNKS = 20000
+# Command output is indexed in pieces of at most this many lines/characters,
+# so a question retrieves the relevant part of a long output, not all of it
+CHUNK_LINES = 40
+CHUNK_CHARS = 4000
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+TOKEN = re.compile(r'[a-z0-9_]+')
+
+
+def tokenize(text):
+    return TOKEN.findall(text.lower())
+
+
+# Incremental BM25 index over the session's messages for Ctrl-E a. Each
+# message is added once, as it is recorded: command entries are split into
+# chunks of their output (each a small command entry of its own, with the
+# input repeated and the line range it covers), other messages are indexed
+# whole. search() scores only the chunks that share a term with the query,
+# through per-term postings, and returns the best as context messages in
+# session order. Chunk keys are tuples that sort chronologically.
+class ContextIndex:
+    def __init__(self, max_chunks=MAX_CHUNKS, chunk_lines=CHUNK_LINES, chunk_chars=CHUNK_CHARS):
+        self.max_chunks = max_chunks
+        self.chunk_lines = chunk_lines
+        self.chunk_chars = chunk_chars
+        # key -> (message, term counts, length in terms)
+        self.chunks = {}
+        # term -> {key: term frequency}
+        self.postings = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add(self, key, role, content):
+        # key: a sortable tuple unique to the message, e.g. (1, seq)
+        if not content:
+            return
+        for part, (message, text) in enumerate(self._split(role, content)):
+            self._add_chunk(key + (part,), message, text)
+        while len(self.chunks) > self.max_chunks:
+            self._remove(next(iter(self.chunks)))
+
+    def _split(self, role, content):
+        # (message, searchable text) pairs for one recorded message
+        try:
+            entry = json.loads(content) if content.startswith("{") else None
+        except ValueError:
+            entry = None
+        if isinstance(entry, dict) and isinstance(entry.get("batch"), list):
+            results = [result for result in entry["batch"] if isinstance(result, dict)]
+        elif isinstance(entry, dict) and "input" in entry:
+            results = [entry]
+        else:
+            return [({"role": role, "content": content}, content)]
+        return [chunk for result in results for chunk in self._split_command(role, result)]
+
+    def _split_command(self, role, entry):
+        command = str(entry.get("input", ""))
+        extra = {key: value for key, value in entry.items() if key not in ("input", "stdout", "stderr") and not key.endswith("_info")}
+        pieces = []
+        for key in ("stdout", "stderr"):
+            text = entry.get(key)
+            if not isinstance(text, str) or not text:
+                continue
+            info = entry.get(f"{key}_info")
+            chunks = list(self._line_chunks(text))
+            for first, last, chunk in chunks:
+                piece = {"input": command, key: chunk}
+                if len(chunks) > 1:
+                    piece[f"{key}_lines"] = f"{first}-{last}"
+                if info:
+                    piece[f"{key}_info"] = info
+                pieces.append(piece)
+        if not pieces:
+            pieces.append({"input": command})
+        for piece in pieces:
+            piece.update(extra)
+        return [
+            ({"role": role, "content": json.dumps(piece)}, f"{command}\n{piece.get('stdout', '')}{piece.get('stderr', '')}")
+            for piece in pieces
+        ]
+
+    def _line_chunks(self, text):
+        # (first line, last line, text) for consecutive pieces of text; a
+        # single overlong line is cut at chunk_chars
+        lines = text.splitlines(keepends=True)
+        start = 0
+        while start < len(lines):
+            end = start
+            size = 0
+            while end < len(lines) and end - start < self.chunk_lines and (end == start or size + len(lines[end]) <= self.chunk_chars):
+                size += len(lines[end])
+                end += 1
+            yield start + 1, end, "".join(lines[start:end])[:self.chunk_chars]
+            start = end
+
+    def _add_chunk(self, key, message, text):
+        if key in self.chunks:
+            self._remove(key)
+        terms = Counter(tokenize(text))
+        length = sum(terms.values())
+        self.chunks[key] = (message, terms, length)
+        self.total_length += length
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[key] = count
+
+    def _remove(self, key):
+        _, terms, length = self.chunks.pop(key)
+        self.total_length -= length
+        for term in terms:
+            postings = self.postings[term]
+            del postings[key]
+            if not postings:
+                del self.postings[term]
+
+    def search(self, query, k, exclude_from=None):
+        # Up to k best chunks for the query as [(key, message)] in session
+        # order, ignoring chunks whose key is >= exclude_from
+        if not self.chunks or k <= 0:
+            return []
+        count = len(self.chunks)
+        average = self.total_length / count or 1
+        scores = Counter()
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for key, frequency in postings.items():
+                if exclude_from is not None and key >= exclude_from:
+                    continue
+                length = self.chunks[key][2]
+                scores[key] += idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average))
+        best = sorted(key for key, _ in scores.most_common(k))
+        return [(key, self.chunks[key][0]) for key in best]
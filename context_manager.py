@@ -1,62 +1,392 @@
 # context_manager.py
 import json
-from collections import deque
+from context_index import ContextIndex
+from context_store import ContextStore
+from context_summarizer import ContextSummarizer, MAX_DIGESTS
+from output_capture import OutputCapture
+from output_normalizer import OutputNormalizer
+from session_store import PAGE_SIZE
+from token_counter import TokenCounter, context_budget
+
+MAX_SPILLED_OUTPUTS = 32
+# Fraction of the budget that pruning evicts down to, see ContextStore
+PRUNE_LOW_WATER = 0.75
+# Share of the budget digests of evicted context may take up
+SUMMARY_SHARE = 0.25
+# A question is sent the best matching chunks of the session (ContextIndex)
+# plus the newest messages within this many tokens
+RETRIEVAL_CHUNKS = 8
+RECENT_TOKENS = 2000
+# Rows of earlier sessions indexed, once, when the first question is asked
+HISTORY_INDEX_ROWS = 5000
 
 class ContextManager:
-    def __init__(self, max_chars=300000):
-        self.context = deque()
-        self.max_chars = max_chars
-        self.char_count = 0
+    def __init__(self, max_tokens=None, model=None, token_counter=None, session_store=None, resume_tokens=None, summarizer=None, normalize_output=True,
+                 retrieval_chunks=RETRIEVAL_CHUNKS):
+        self.token_counter = token_counter or TokenCounter(model)
+        self.max_tokens = max_tokens or context_budget(model)
+        # Token counts are computed once per message and kept in the store
+        self.store = ContextStore(self.max_tokens, low_water=PRUNE_LOW_WATER)
         self.last_user_instruction = None
         self.saved_contexts = []
+        self.spilled_outputs = {}
+        self.next_spill_id = 1
+        # Command output is cleaned up (see OutputNormalizer) before it is
+        # stored; the raw text stays readable through a spill_id
+        self.normalize_output = normalize_output
+        self.normalize_stats = {"outputs": 0, "raw_bytes": 0, "saved_bytes": 0}
+        self.session_store = session_store
+        # Older persisted messages paged in for questions, as (message, tokens)
+        self.older_context = []
+        # Earlier sessions as (session, first row id), the one that wrote
+        # last first; paging walks back through them, one at a time, from
+        # oldest_loaded_id in earlier_sessions[paging_session]
+        self.earlier_sessions = []
+        self.paging_session = 0
+        self.oldest_loaded_id = None
+        self.history_exhausted = session_store is None
+        # Evicted spans are summarized in the background into pinned digests
+        self.summarizer = ContextSummarizer(summarizer) if summarizer is not None else None
+        self.summary_seqs = []
+        self.merging = set()
+        # With retrieval_chunks 0, questions get the whole history as before
+        self.retrieval_chunks = retrieval_chunks
+        self.index = ContextIndex() if retrieval_chunks else None
+        self.history_indexed = session_store is None
+        # session -> rows from this id on are already indexed as resumed messages
+        self.index_bounds = {}
+        self.last_retrieval = None
+        if session_store is not None:
+            self._resume(resume_tokens or self.max_tokens // 4)
+
+    def _resume(self, resume_tokens):
+        # Only the recent tail of the earlier sessions is loaded at startup;
+        # the rest is paged in on demand
+        self.earlier_sessions = self.session_store.sessions(self.session_store.first_new_id)
+        self.history_exhausted = not self.earlier_sessions
+        self.history_indexed = not self.earlier_sessions
+        rows = self._load_older(resume_tokens)
+        for _, role, content, tokens in rows:
+            seq, _ = self.store.append(role, content, tokens)
+            self._index(seq, role, content)
+        for i, (session, first_id) in enumerate(self.earlier_sessions):
+            if i < self.paging_session:
+                self.index_bounds[session] = first_id
+            elif i == self.paging_session and self.oldest_loaded_id is not None:
+                self.index_bounds[session] = self.oldest_loaded_id
+
+    def _load_older(self, max_tokens):
+        # Rows (oldest first) just before those already loaded that fit in
+        # max_tokens, continuing into earlier sessions as each one runs out
+        rows = []
+        while not self.history_exhausted:
+            session = self.earlier_sessions[self.paging_session][0]
+            before_id = self.oldest_loaded_id or self.session_store.first_new_id
+            page = self.session_store.tail(max_tokens, before_id=before_id, session=session)
+            if page:
+                rows[:0] = page
+                max_tokens -= sum(row[3] for row in page)
+                self.oldest_loaded_id = page[0][0]
+                before_id = self.oldest_loaded_id
+            if self.session_store.page(before_id=before_id, limit=1, session=session):
+                break  # the budget ran out within this session
+            self.paging_session += 1
+            self.oldest_loaded_id = None
+            self.history_exhausted = self.paging_session >= len(self.earlier_sessions)
+        return rows
+
+    @property
+    def context(self):
+        return self.store.messages()
+
+    @property
+    def token_count(self):
+        return self.store.total_tokens
 
     def add_message(self, role, content):
-        message = {"role": role, "content": content}
-        self.context.append(message)
-        self.char_count += len(str(message))
+        self._apply_summaries()
+        seq = self._append(role, content)
+        self._index(seq, role, content)
 
         if role == "user" and content.startswith("aishell command:"):
-            self.last_user_instruction = message
+            if self.last_user_instruction is not None:
+                self.store.unpin(self.last_user_instruction)
+            self.last_user_instruction = seq
+            self.store.pin(seq)
 
         self._prune()
 
-    def add_command(self, input_cmd, stdout, stderr, from_llm=False):
-        content = json.dumps({"input": input_cmd, "stdout": stdout, "stderr": stderr})
+    def _append(self, role, content, pinned=False, persist=True):
+        tokens = self.token_counter.count_message({"role": role, "content": content})
+        seq, _ = self.store.append(role, content, tokens, pinned=pinned)
+        if persist and self.session_store is not None:
+            self.session_store.append(role, content, tokens)
+        return seq
+
+    def add_command(self, input_cmd, stdout, stderr, from_llm=False, stdout_capture=None, stderr_capture=None):
+        # Returns how many bytes normalization kept out of the context
+        entry = {"input": input_cmd}
+        saved = self._add_output(entry, "stdout", stdout, stdout_capture)
+        saved += self._add_output(entry, "stderr", stderr, stderr_capture)
+        content = json.dumps(entry)
         self.add_message("user", content if not from_llm else "")
         self.add_message("assistant", content if from_llm else "")
-        #self.add_message("user" if not from_llm else "assistant", content)
-        #self.add_message("assistant" if not from_llm else "user", "")
+        return saved
+
+    def add_batch(self, entries, from_llm=True):
+        # All results of a command batch as one message, in batch order
+        results = []
+        for entry in entries:
+            result = {"id": entry["id"], "input": entry["bash"]}
+            if entry["status"] == "skipped":
+                result["skipped"] = entry["reason"]
+            else:
+                for key, capture in zip(("stdout", "stderr"), entry["captures"]):
+                    self._add_output(result, key, entry[key], capture)
+                result["return_code"] = entry["return_code"]
+            results.append(result)
+        content = json.dumps({"batch": results})
+        self.add_message("user", content if not from_llm else "")
+        self.add_message("assistant", content if from_llm else "")
+
+    def _add_output(self, entry, key, text, capture):
+        # Sets entry[key] (normalized) and entry[key + "_info"] if there is
+        # anything to say about it; returns the bytes normalization saved
+        info = self._describe_capture(capture)
+        normalized = text
+        normalizer = OutputNormalizer()
+        if self.normalize_output and text:
+            normalized = normalizer.normalize(text)
+        raw_bytes = len(text.encode("utf-8", errors="replace")) if text else 0
+        saved = raw_bytes - len(normalized.encode("utf-8", errors="replace")) if text else 0
+        if saved <= 0:
+            # A fold marker can be longer than the few lines it replaces
+            normalized = text
+            saved = 0
+        elif normalizer.folded_lines:
+            # Whole lines were dropped, so the raw text is kept readable; the
+            # info saying so is paid for out of the saving
+            kept = dict(info) if info is not None else self._keep_raw(text)
+            kept["normalized_saved_bytes"] = saved
+            cost = len(json.dumps(kept)) - len(json.dumps(info)) if info is not None else len(json.dumps({f"{key}_info": kept})) - 1
+            if saved > cost:
+                saved -= cost
+                kept["normalized_saved_bytes"] = saved
+                info = kept
+            else:
+                if info is None:
+                    self._drop_spill(kept["spill_id"])
+                normalized = text
+                saved = 0
+        self.normalize_stats["outputs"] += 1
+        self.normalize_stats["raw_bytes"] += raw_bytes
+        if saved > 0:
+            self.normalize_stats["saved_bytes"] += saved
+        entry[key] = normalized
+        if info:
+            entry[f"{key}_info"] = info
+        return max(saved, 0)
+
+    def _keep_raw(self, text):
+        # Output that was only normalized (not truncated or spilled) is
+        # written to a spill file so its raw lines can still be read
+        capture = OutputCapture(0, spill=True)
+        capture.write(text.encode("utf-8", errors="replace"))
+        capture.close()
+        info = capture.describe()
+        info.pop("spilled", None)
+        info["spill_id"] = self._register_spill(capture)
+        return info
+
+    def _register_spill(self, capture):
+        spill_id = self.next_spill_id
+        self.next_spill_id += 1
+        self.spilled_outputs[spill_id] = capture
+        while len(self.spilled_outputs) > MAX_SPILLED_OUTPUTS:
+            oldest = next(iter(self.spilled_outputs))
+            self.spilled_outputs.pop(oldest).discard()
+        return spill_id
+
+    def _drop_spill(self, spill_id):
+        capture = self.spilled_outputs.pop(spill_id, None)
+        if capture is not None:
+            capture.discard()
+
+    def _describe_capture(self, capture):
+        # Only large or binary output needs more than the text already in context
+        if capture is None or not (capture.truncated or capture.binary):
+            return None
+        info = capture.describe()
+        if capture.spill_path:
+            info["spill_id"] = self._register_spill(capture)
+        return info
+
+    def read_spilled_output(self, spill_id, start_line, end_line):
+        capture = self.spilled_outputs.get(int(spill_id))
+        if capture is None:
+            return f"[no spilled output with id {spill_id}]"
+        try:
+            return capture.read_lines(start_line, end_line)
+        except (OSError, ValueError) as e:
+            return f"[could not read spilled output {spill_id}: {e}]"
+
+    def close(self):
+        for capture in self.spilled_outputs.values():
+            capture.discard()
+        self.spilled_outputs.clear()
+        if self.session_store is not None:
+            self.session_store.close()
+            self.session_store = None
+            self.history_exhausted = True
 
     def save_context(self, context):
-        self.saved_contexts.append({"role": "user", "content": f"{{\"savedcontext\": \"{context}\"}}"})
-        self.saved_contexts.append({"role": "assistant", "content": ""})
+        # Saved contexts are pinned so pruning never drops them
+        self.saved_contexts.append(self._append("user", f"{{\"savedcontext\": \"{context}\"}}", pinned=True))
+        self.saved_contexts.append(self._append("assistant", "", pinned=True))
+        self._prune()
 
-    def get_context(self, for_question=False):
+    def fork(self, summarizer=None):
+        # An independent copy of the current window for a background job;
+        # nothing it adds reaches this context or the session log
+        fork = ContextManager(max_tokens=self.max_tokens, token_counter=self.token_counter, summarizer=summarizer)
+        for message in self.store.window():
+            if message["content"]:
+                fork.add_message(message["role"], message["content"])
+        return fork
+
+    def get_context(self, for_question=False, question=None):
+        self._apply_summaries()
+        self.last_retrieval = None
+        if for_question and question and self.index is not None:
+            return self._retrieval_window(question)
         if for_question:
-            return list(self.context)[-self.max_chars:]
-        
-        relevant_context = []
-        char_count = 0
-        for message in reversed(self.context):
-            if message == self.last_user_instruction:
-                relevant_context.append(message)
+            return self._older_window() + self.store.window()
+        return self.store.window(start_seq=self.last_user_instruction)
+
+    def _index(self, seq, role, content):
+        if self.index is not None:
+            self.index.add((1, seq), role, content)
+
+    def _retrieval_window(self, question):
+        # The newest turns, preceded by the chunks of everything older that
+        # best match the question, in session order
+        recent_tokens = min(RECENT_TOKENS, self.max_tokens // 4)
+        recent = self.store.window(max_tokens=recent_tokens)
+        start_seq = self.store.window_start(max_tokens=recent_tokens)
+        self._index_history()
+        room = self.max_tokens - sum(self.token_counter.count_message(message) for message in recent)
+        retrieved = []
+        for _, message in self.index.search(question, self.retrieval_chunks, exclude_from=(1, start_seq)):
+            tokens = self.token_counter.count_message(message)
+            if tokens > room:
+                continue
+            retrieved.append(message)
+            room -= tokens
+        self.last_retrieval = {"chunks": len(retrieved), "recent": len(recent), "indexed": len(self.index)}
+        return retrieved + recent
+
+    def _index_history(self):
+        # Earlier sessions' rows from the session log, the most recent
+        # sessions first. Keys group each session's rows, in the order the
+        # sessions started, before everything recorded in memory
+        if self.history_indexed:
+            return
+        self.history_indexed = True
+        store = self.session_store
+        indexed = 0
+        for session, first_id in self.earlier_sessions:
+            # Resumed rows are already indexed
+            before_id = self.index_bounds.get(session, store.first_new_id)
+            while indexed < HISTORY_INDEX_ROWS:
+                rows = store.page(before_id=before_id, session=session)
+                for row_id, role, content, _ in rows:
+                    self.index.add((0, first_id, row_id), role, content)
+                indexed += len(rows)
+                if len(rows) < PAGE_SIZE:
+                    break
+                before_id = rows[-1][0]
+            if indexed >= HISTORY_INDEX_ROWS:
                 break
-            if char_count + len(str(message)) <= self.max_chars:
-                relevant_context.append(message)
-                char_count += len(str(message))
+
+    def recent_context(self, max_tokens):
+        # Newest non-empty messages within max_tokens, e.g. for inline suggestions
+        return [message for message in self.store.window(max_tokens=max_tokens) if message["content"]]
+
+    def _older_window(self):
+        room = self.max_tokens - self.store.total_tokens
+        if room <= 0:
+            return []
+        loaded_tokens = sum(tokens for _, tokens in self.older_context)
+        if loaded_tokens < room and not self.history_exhausted:
+            rows = self._load_older(room - loaded_tokens)
+            if rows:
+                self.older_context[:0] = [({"role": role, "content": content}, tokens) for _, role, content, tokens in rows]
             else:
+                self.history_exhausted = True
+
+        window = []
+        for message, tokens in reversed(self.older_context):
+            if tokens > room:
                 break
-        
-        return list(reversed(relevant_context))
+            window.append(message)
+            room -= tokens
+        return list(reversed(window))
 
     def _prune(self):
-        while self.char_count > self.max_chars:
-            if len(self.context) > 1 and self.context[0] != self.last_user_instruction and self.context[0] not in self.saved_contexts:
-                removed = self.context.popleft()
-                self.char_count -= len(str(removed))
+        removed_tokens, removed_messages = self.store.prune()
+
+        if removed_tokens:
+            # Older history would no longer be contiguous with what is left in memory
+            self.older_context = []
+            self.history_exhausted = True
+            if self.summarizer is not None:
+                self.summarizer.submit(("evict", ()), removed_messages)
+            else:
+                # Appended directly so that the note itself cannot trigger another prune
+                self._append("user", f"[approximately {removed_tokens} tokens of earlier content have been removed for brevity in this conversation]", persist=False)
+
+    def _apply_summaries(self):
+        # Digests are produced on the summarizer thread but only ever applied here
+        if self.summarizer is None:
+            return
+        finished = self.summarizer.drain()
+        if not finished:
+            return
+        for (kind, replaced), content in finished:
+            for seq in replaced:
+                self.store.unpin(seq)
+                self.summary_seqs.remove(seq)
+                self.merging.discard(seq)
+            tokens = self.token_counter.count_message({"role": "user", "content": content})
+            seq = self.store.retain("user", content, tokens, first=kind == "merge")
+            if kind == "merge":
+                self.summary_seqs.insert(0, seq)
             else:
+                self.summary_seqs.append(seq)
+
+        summary_tokens = sum(self.token_counter.count_message(self.store.retained_message(seq)) for seq in self.summary_seqs)
+        while len(self.summary_seqs) > 1 and summary_tokens > self.max_tokens * SUMMARY_SHARE:
+            # Over their share: drop the oldest digest rather than crowd out live context
+            oldest = next((seq for seq in self.summary_seqs if seq not in self.merging), None)
+            if oldest is None:
                 break
+            summary_tokens -= self.token_counter.count_message(self.store.retained_message(oldest))
+            self.store.unpin(oldest)
+            self.summary_seqs.remove(oldest)
+
+        mergeable = [seq for seq in self.summary_seqs if seq not in self.merging]
+        if len(self.summary_seqs) > MAX_DIGESTS and len(mergeable) >= 2:
+            oldest = tuple(mergeable[:2])
+            self.merging.update(oldest)
+            self.summarizer.submit(("merge", oldest), [self.store.retained_message(seq) for seq in oldest])
+        self._prune()
+
+    def summaries(self):
+        return [self.store.retained_message(seq)["content"] for seq in self.summary_seqs]
 
-        if self.char_count > self.max_chars:
-            truncated_chars = self.char_count - self.max_chars
-            self.add_message("user", f"[approximately {truncated_chars} bytes of content has been removed for brevity in this conversation]")
\ No newline at end of file
+    def wait_for_summaries(self, timeout=None):
+        if self.summarizer is None:
+            return True
+        done = self.summarizer.wait(timeout)
+        self._apply_summaries()
+        return done
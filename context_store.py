@@ -0,0 +1,174 @@
+import sys
+from array import array
+from bisect import bisect_left
+
+# Compact the backing arrays once this many evicted entries sit in front of the head
+COMPACT_THRESHOLD = 4096
+
+# Append-only message store backing ContextManager.
+#
+# Messages live in parallel arrays addressed by a monotonically increasing
+# sequence number: the message dicts (built once, roles interned), their token
+# counts and a running prefix sum of those counts. Eviction just advances a
+# head index, windows ending at the newest message are found by bisecting the
+# prefix sums, and pinned messages are tracked by sequence number rather than
+# by comparing dicts. Pinned messages that age out of the live window are moved
+# to a small retained list that always leads the context.
+class ContextStore:
+    __slots__ = (
+        "max_tokens", "low_water", "_messages", "_tokens", "_prefix", "_head", "_offset",
+        "_pinned", "_retained", "_retained_tokens", "_retained_seq", "_cache_key", "_cache",
+    )
+
+    def __init__(self, max_tokens, low_water=1.0):
+        self.max_tokens = max_tokens
+        # Once over budget, evict down to this fraction of it. Evicting in larger,
+        # rarer steps keeps the start of the history (the prompt prefix) stable.
+        self.low_water = low_water
+        self._messages = []
+        self._tokens = array('q')
+        self._prefix = array('q', [0])
+        self._head = 0
+        self._offset = 0
+        self._pinned = set()
+        self._retained = []
+        self._retained_tokens = 0
+        # Messages retained directly (never live) get negative sequence numbers
+        self._retained_seq = 0
+        self._cache_key = None
+        self._cache = []
+
+    def __len__(self):
+        return len(self._retained) + len(self._messages) - self._head
+
+    def __iter__(self):
+        yield from (message for _, message, _ in self._retained)
+        yield from self._messages[self._head:]
+
+    def __getitem__(self, index):
+        return self.messages()[index]
+
+    @property
+    def live_tokens(self):
+        return self._prefix[-1] - self._prefix[self._head]
+
+    @property
+    def total_tokens(self):
+        return self._retained_tokens + self.live_tokens
+
+    @property
+    def next_seq(self):
+        return self._offset + len(self._messages)
+
+    def messages(self):
+        return list(self)
+
+    def token_counts(self):
+        return [tokens for _, _, tokens in self._retained] + list(self._tokens[self._head:])
+
+    def append(self, role, content, tokens, pinned=False):
+        seq = self.next_seq
+        message = {"role": sys.intern(role), "content": content}
+        self._messages.append(message)
+        self._tokens.append(tokens)
+        self._prefix.append(self._prefix[-1] + tokens)
+        if pinned:
+            self._pinned.add(seq)
+        return seq, message
+
+    def pin(self, seq):
+        self._pinned.add(seq)
+
+    def unpin(self, seq):
+        self._pinned.discard(seq)
+        for i, (retained_seq, _, tokens) in enumerate(self._retained):
+            if retained_seq == seq:
+                del self._retained[i]
+                self._retained_tokens -= tokens
+                self._cache_key = None
+                break
+
+    def retain(self, role, content, tokens, first=False):
+        # Adds a pinned message straight to the retained tier that leads the context
+        self._retained_seq -= 1
+        seq = self._retained_seq
+        entry = (seq, {"role": sys.intern(role), "content": content}, tokens)
+        if first:
+            self._retained.insert(0, entry)
+        else:
+            self._retained.append(entry)
+        self._retained_tokens += tokens
+        self._pinned.add(seq)
+        self._cache_key = None
+        return seq
+
+    def retained_message(self, seq):
+        for retained_seq, message, _ in self._retained:
+            if retained_seq == seq:
+                return message
+        return None
+
+    def is_live(self, seq):
+        return self._offset + self._head <= seq < self.next_seq
+
+    def prune(self):
+        # Evict from the head until the budget fits, keeping at least one live message
+        removed_tokens = 0
+        removed_messages = []
+        if self.total_tokens <= self.max_tokens:
+            return removed_tokens, removed_messages
+        target = int(self.max_tokens * self.low_water)
+        end = len(self._messages)
+        while self.total_tokens > target and end - self._head > 1:
+            seq = self._offset + self._head
+            message = self._messages[self._head]
+            tokens = self._tokens[self._head]
+            if seq in self._pinned:
+                self._retained.append((seq, message, tokens))
+                self._retained_tokens += tokens
+            else:
+                removed_tokens += tokens
+                removed_messages.append(message)
+            self._messages[self._head] = None
+            self._head += 1
+
+        if self._head >= COMPACT_THRESHOLD and self._head * 2 >= end:
+            self._compact()
+        return removed_tokens, removed_messages
+
+    def _compact(self):
+        head = self._head
+        self._messages = self._messages[head:]
+        self._tokens = self._tokens[head:]
+        self._prefix = self._prefix[head:]
+        self._offset += head
+        self._head = 0
+
+    def window_start(self, max_tokens=None, start_seq=None):
+        # Sequence number of the first live message window() would return
+        return self._offset + self._window_start(max_tokens, start_seq)
+
+    def _window_start(self, max_tokens, start_seq):
+        budget = (self.max_tokens if max_tokens is None else max_tokens) - self._retained_tokens
+        end = len(self._messages)
+        start = min(bisect_left(self._prefix, self._prefix[end] - budget, self._head, end + 1), end)
+        if start_seq is not None and self.is_live(start_seq):
+            start = max(start, start_seq - self._offset)
+        return start
+
+    def window(self, max_tokens=None, start_seq=None):
+        # Newest messages fitting the budget, optionally not reaching back past start_seq
+        end = len(self._messages)
+        start = self._window_start(max_tokens, start_seq)
+
+        key = (self._offset + start, self._offset + end, len(self._retained))
+        cached_key = self._cache_key
+        if cached_key == key:
+            return list(self._cache)
+        if cached_key is not None and cached_key[0] == key[0] and cached_key[2] == key[2] and cached_key[1] <= key[1]:
+            # Same start, more messages: extend the cached window instead of rebuilding it
+            self._cache.extend(self._messages[cached_key[1] - self._offset:end])
+        else:
+            self._cache = [message for _, message, _ in self._retained] + self._messages[start:end]
+        self._cache_key = key
+        return list(self._cache)
@@ -0,0 +1,118 @@
+import json
+import queue
+import threading
+
+# Characters of each evicted message passed to the summarizer
+MAX_MESSAGE_CHARS = 2000
+# Digests kept before the oldest two are merged into one
+MAX_DIGESTS = 6
+# Local digests keep their most recent lines up to this size
+MAX_LOCAL_DIGEST_CHARS = 2000
+SUMMARY_PREFIX = "[Summary of earlier session activity]"
+
+
+def local_digest(messages):
+    # Cheap fallback digest: the commands that ran and the size of their output
+    lines = []
+    for message in messages:
+        content = message["content"]
+        if not content:
+            continue
+        if content.startswith(SUMMARY_PREFIX):
+            lines.append(content[len(SUMMARY_PREFIX):].strip())
+            continue
+        try:
+            entry = json.loads(content)
+        except json.JSONDecodeError:
+            entry = None
+        if isinstance(entry, dict) and "input" in entry:
+            stdout = entry.get("stdout") or ""
+            stderr = entry.get("stderr") or ""
+            first_line = stdout.strip().splitlines()[0][:120] if stdout.strip() else ""
+            detail = f"{len(stdout.splitlines())} lines of output"
+            if first_line:
+                detail += f", starting {first_line!r}"
+            if stderr.strip():
+                detail += f", stderr {stderr.strip().splitlines()[-1][:120]!r}"
+            lines.append(f"- `{entry['input']}` ({message['role']}): {detail}")
+        else:
+            lines.append(f"- {message['role']}: {content[:200]}")
+
+    kept = []
+    size = 0
+    for line in reversed(lines):
+        size += len(line) + 1
+        if size > MAX_LOCAL_DIGEST_CHARS:
+            kept.append(f"- ({len(lines) - len(kept)} earlier entries omitted)")
+            break
+        kept.append(line)
+    return "\n".join(reversed(kept))
+
+
+def clip_messages(messages):
+    clipped = []
+    for message in messages:
+        content = message["content"]
+        if not content:
+            continue
+        if len(content) > MAX_MESSAGE_CHARS:
+            half = MAX_MESSAGE_CHARS // 2
+            content = f"{content[:half]}\n[...]\n{content[-half:]}"
+        clipped.append({"role": message["role"], "content": content})
+    return clipped
+
+
+# Summarizes spans of context evicted by ContextManager in a worker thread, so
+# pruning never waits on the LLM. Finished digests are queued for the owner to
+# collect (on its own thread) with drain().
+class ContextSummarizer:
+    def __init__(self, summarize=None):
+        # summarize(messages) -> Optional[str]; falls back to local_digest
+        self.summarize = summarize
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.thread = None
+
+    def submit(self, job_id, messages):
+        messages = clip_messages(messages)
+        if not messages:
+            return
+        with self.lock:
+            self.pending += 1
+            self.idle.clear()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="context-summarizer", daemon=True)
+                self.thread.start()
+        self.jobs.put((job_id, messages))
+
+    def _run(self):
+        while True:
+            job_id, messages = self.jobs.get()
+            digest = None
+            if self.summarize is not None:
+                try:
+                    digest = self.summarize(messages)
+                except Exception:
+                    digest = None
+            if not digest:
+                digest = local_digest(messages)
+            self.results.put((job_id, f"{SUMMARY_PREFIX}\n{digest.strip()}"))
+            with self.lock:
+                self.pending -= 1
+                if self.pending == 0:
+                    self.idle.set()
+
+    def drain(self):
+        finished = []
+        while True:
+            try:
+                finished.append(self.results.get_nowait())
+            except queue.Empty:
+                return finished
+
+    def wait(self, timeout=None):
+        return self.idle.wait(timeout)
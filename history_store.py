@@ -0,0 +1,286 @@
+import os
+import sqlite3
+import threading
+import time
+from prompt_toolkit.auto_suggest import AutoSuggest, Suggestion
+from prompt_toolkit.completion import Completer, Completion
+from prompt_toolkit.history import History
+
+DEFAULT_HISTORY_DB = "~/.aishell/history.db"
+# prompt_toolkit's FileHistory, imported into the store once
+LEGACY_HISTORY_FILE = "~/.aishell_history"
+# Distinct commands kept; the least recently used are deleted by trim()
+MAX_ENTRIES = 1000000
+# Newest commands handed to prompt_toolkit for Up/Down; older ones are
+# reached through suggestions and Ctrl-R
+LOAD_RECENT = 1000
+# A prefix matching at most this many commands is answered from the command
+# index alone; a more common one is looked up newest-first
+PREFIX_SCAN_ROWS = 256
+# Search terms too short for the trigram index are only looked for among
+# this many of the most recently used commands
+RECENT_SCAN_ROWS = 5000
+SEARCH_RESULTS = 20
+IMPORT_BATCH = 1000
+
+
+def read_file_history(path):
+    # Entries of a prompt_toolkit FileHistory file, oldest first
+    entries = []
+    lines = []
+    with open(path, "rb") as f:
+        for raw in f:
+            line = raw.decode("utf-8", errors="replace")
+            if line.startswith("+"):
+                lines.append(line[1:])
+            elif lines:
+                entries.append("".join(lines)[:-1])
+                lines = []
+    if lines:
+        entries.append("".join(lines)[:-1])
+    return entries
+
+
+# Deduplicated shell history in SQLite. Each distinct command is one row
+# whose id is renumbered every time it is used, so the newest commands are
+# the highest ids: recency is a walk down the primary key, and the FTS5
+# trigram index (when the SQLite build has one) can return the newest matches
+# of a search without ranking all of them. Prefix suggestions use the unique
+# command index, or that newest-first walk for very common prefixes. Nothing
+# is loaded into memory up front; prompt_toolkit only gets the newest
+# LOAD_RECENT commands.
+class HistoryStore:
+    def __init__(self, path=DEFAULT_HISTORY_DB, max_entries=MAX_ENTRIES):
+        self.path = os.path.expanduser(path)
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS history ("
+            "id INTEGER PRIMARY KEY, command TEXT NOT NULL UNIQUE, uses INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.fts = self._create_fts()
+        # (prefix, newest command with it) of the last suggestion
+        self.last_suggestion = None
+        # (terms, results, whether those are all matches, limit) of the last search
+        self.last_search = None
+
+    def _create_fts(self):
+        try:
+            self.conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS history_fts "
+                "USING fts5(command, content='history', content_rowid='id', tokenize='trigram', detail='none')"
+            )
+        except sqlite3.OperationalError:
+            return False  # no FTS5 or no trigram tokenizer (SQLite < 3.34)
+        self.conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS history_fts_insert AFTER INSERT ON history BEGIN "
+            "INSERT INTO history_fts (rowid, command) VALUES (new.id, new.command); END"
+        )
+        self.conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS history_fts_delete AFTER DELETE ON history BEGIN "
+            "INSERT INTO history_fts (history_fts, rowid, command) VALUES ('delete', old.id, old.command); END"
+        )
+        self.conn.execute(
+            "CREATE TRIGGER IF NOT EXISTS history_fts_update AFTER UPDATE OF id ON history BEGIN "
+            "INSERT INTO history_fts (history_fts, rowid, command) VALUES ('delete', old.id, old.command); "
+            "INSERT INTO history_fts (rowid, command) VALUES (new.id, new.command); END"
+        )
+        return True
+
+    def newest_id(self):
+        # 0 when empty
+        with self.lock:
+            return self._newest_id()
+
+    def _newest_id(self):
+        # Ids are assigned inside each write transaction, not counted in this
+        # process, since other shells may share the file
+        return self.conn.execute("SELECT MAX(id) FROM history").fetchone()[0] or 0
+
+    def trim(self):
+        # Drops the least recently used commands beyond max_entries; ids only
+        # grow, so when their span is small enough there is nothing to count
+        with self.lock:
+            oldest = self.conn.execute("SELECT MIN(id) FROM history").fetchone()[0]
+            if oldest is None or self._newest_id() - oldest < self.max_entries:
+                return
+            row = self.conn.execute("SELECT id FROM history ORDER BY id DESC LIMIT 1 OFFSET ?", (self.max_entries,)).fetchone()
+            if row is not None:
+                self.conn.execute("DELETE FROM history WHERE id <= ?", (row[0],))
+
+    def __len__(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    def add(self, command):
+        self.add_many([command])
+
+    def add_many(self, commands):
+        # commands oldest first; a command already stored just becomes the newest
+        now = time.time()
+        commands = [command for command in commands if command.strip()]
+        if not commands:
+            return
+        with self.lock:
+            with self.conn:
+                # IMMEDIATE takes the write lock before reading the newest id,
+                # so a shell sharing the file cannot hand out the same ones
+                self.conn.execute("BEGIN IMMEDIATE")
+                newest = self._newest_id()
+                rows = [(newest + i + 1, command, now) for i, command in enumerate(commands)]
+                self.conn.executemany(
+                    "INSERT INTO history (id, command, uses, last_used) VALUES (?, ?, 1, ?) "
+                    "ON CONFLICT (command) DO UPDATE SET id = excluded.id, uses = uses + 1, last_used = excluded.last_used",
+                    rows
+                )
+            self.last_suggestion = None
+            self.last_search = None
+
+    def recent(self, limit=LOAD_RECENT):
+        # Newest first
+        with self.lock:
+            rows = self.conn.execute("SELECT command FROM history ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [row[0] for row in rows]
+
+    def suggest(self, prefix):
+        # The most recently used command that starts with prefix (and is longer)
+        if not prefix.strip():
+            return None
+        # Called on the UI thread: rather than wait for a write, skip this keystroke
+        if not self.lock.acquire(blocking=False):
+            return None
+        try:
+            last = self.last_suggestion
+            if last is not None and prefix.startswith(last[0]) and (last[1] is None or last[1].startswith(prefix)):
+                # The newest command with a shorter prefix is also the newest
+                # with this one if it still matches; none then means none now
+                newest = last[1]
+            else:
+                newest = self._newest_with_prefix(prefix)
+            self.last_suggestion = (prefix, newest)
+        finally:
+            self.lock.release()
+        return newest if newest is not None and len(newest) > len(prefix) else None
+
+    def _newest_with_prefix(self, prefix):
+        bounds = (prefix, prefix + "\U0010ffff")
+        rows = self.conn.execute(
+            "SELECT MAX(id), COUNT(*) FROM (SELECT id FROM history WHERE command >= ? AND command < ? LIMIT ?)",
+            bounds + (PREFIX_SCAN_ROWS + 1,)
+        ).fetchone()
+        if rows[1] <= PREFIX_SCAN_ROWS:
+            query = "SELECT command FROM history WHERE id = ?"
+            row = self.conn.execute(query, (rows[0],)).fetchone() if rows[1] else None
+        else:
+            # A common prefix: walking back from the newest command finds it soon
+            query = "SELECT command FROM history NOT INDEXED WHERE command >= ? AND command < ? ORDER BY id DESC LIMIT 1"
+            row = self.conn.execute(query, bounds).fetchone()
+        return row[0] if row is not None else None
+
+    def search(self, query, limit=SEARCH_RESULTS):
+        # Newest commands containing every space-separated term of query,
+        # case-insensitively and in any order
+        terms = [term.lower() for term in query.split()]
+        if not terms:
+            return self.recent(limit)
+        with self.lock:
+            last = self.last_search
+            if last is not None and last[2] and limit <= last[3] and all(any(old in term for term in terms) for old in last[0]):
+                # Each earlier term is part of a current one, so the matches
+                # are a subset of the last search's, which found all of its
+                results = [command for command in last[1] if all(term in command.lower() for term in terms)][:limit]
+                complete = True
+            else:
+                results, complete = self._search(terms, limit)
+            self.last_search = (terms, results, complete, limit)
+        return results
+
+    def _search(self, terms, limit):
+        # (results, whether every match was considered)
+        where = " AND ".join(["instr(lower(history.command), ?) > 0"] * len(terms))
+        indexed = [term for term in terms if len(term) >= 3]
+        if self.fts and indexed:
+            # Without positions (detail=none) a term is matched as all of its
+            # trigrams; instr() then checks they are contiguous
+            trigrams = {term[i:i + 3] for term in indexed for i in range(len(term) - 2)}
+            match = " AND ".join('"' + trigram.replace('"', '""') + '"' for trigram in sorted(trigrams))
+            rows = self.conn.execute(
+                f"SELECT history.command FROM history_fts JOIN history ON history.id = history_fts.rowid "
+                f"WHERE history_fts MATCH ? AND {where} ORDER BY history_fts.rowid DESC LIMIT ?",
+                [match] + terms + [limit]
+            ).fetchall()
+            return [row[0] for row in rows], len(rows) < limit
+        # Terms too short for the trigram index are common enough to show up
+        # among the recent commands; without FTS5 every command is scanned
+        since = self._newest_id() - RECENT_SCAN_ROWS if not indexed else 0
+        rows = self.conn.execute(
+            f"SELECT command FROM history WHERE id > ? AND {where} ORDER BY id DESC LIMIT ?",
+            [since] + terms + [limit]
+        ).fetchall()
+        return [row[0] for row in rows], len(rows) < limit and since <= 0
+
+    def import_file(self, path):
+        # One-off import of a FileHistory file; returns the number of entries
+        # read. Written in batches so suggestions aren't held up meanwhile
+        try:
+            entries = read_file_history(path)
+        except OSError:
+            return 0
+        for start in range(0, len(entries), IMPORT_BATCH):
+            self.add_many(entries[start:start + IMPORT_BATCH])
+        return len(entries)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# prompt_toolkit History over a HistoryStore: Up/Down walk the newest
+# commands, and accepted lines are written to the store. The legacy history
+# file is imported on the first load when the store is still empty; wrap in
+# ThreadedHistory so that happens off the UI thread.
+class StoreHistory(History):
+    def __init__(self, store, legacy_file=LEGACY_HISTORY_FILE, load_recent=LOAD_RECENT):
+        super().__init__()
+        self.store = store
+        self.legacy_file = os.path.expanduser(legacy_file) if legacy_file else None
+        self.load_recent = load_recent
+
+    def load_history_strings(self):
+        if self.legacy_file and os.path.exists(self.legacy_file) and not self.store.newest_id():
+            self.store.import_file(self.legacy_file)
+        yield from self.store.recent(self.load_recent)
+        self.store.trim()
+
+    def store_string(self, string):
+        self.store.add(string)
+
+
+# Ghost-text suggestion: the most recent history command extending the text
+class StoreAutoSuggest(AutoSuggest):
+    def __init__(self, store):
+        self.store = store
+
+    def get_suggestion(self, buffer, document):
+        text = document.text
+        if "\n" in text:
+            return None
+        command = self.store.suggest(text)
+        return Suggestion(command[len(text):]) if command else None
+
+
+# Ctrl-R: completions are history commands matching the whole input line,
+# newest first; choosing one replaces the line
+class HistorySearchCompleter(Completer):
+    def __init__(self, store, limit=SEARCH_RESULTS):
+        self.store = store
+        self.limit = limit
+
+    def get_completions(self, document, complete_event):
+        for command in self.store.search(document.text, self.limit):
+            yield Completion(command, start_position=-len(document.text_before_cursor), display=command.replace("\n", " "))
@@ -0,0 +1,223 @@
+import sys
+import threading
+import time
+from output_capture import OutputCapture
+
+MAX_LOG_BYTES = 256 * 1024
+MAX_FINISHED_JOBS = 20
+
+
+# A job's output: a bounded head/tail capture that print(), text streams and
+# CommandExecutor's byte relay (via .buffer) can all write to, plus the
+# (also bounded) part that `fg` has not shown yet.
+class JobLog:
+    def __init__(self, max_bytes=MAX_LOG_BYTES):
+        self.capture = OutputCapture(max_bytes)
+        self.max_unread = max_bytes
+        self.unread = bytearray()
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    @property
+    def buffer(self):
+        return self
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8", errors="replace")
+        with self.lock:
+            self.capture.write(bytes(data))
+            self.unread += data
+            excess = len(self.unread) - self.max_unread
+            if excess > 0:
+                del self.unread[:excess]
+                self.dropped += excess
+        return len(data)
+
+    def read_new(self):
+        # (bytes dropped unseen, text written since the last call)
+        with self.lock:
+            data, dropped = bytes(self.unread), self.dropped
+            self.unread.clear()
+            self.dropped = 0
+        return dropped, data.decode("utf-8", errors="replace")
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+    def getvalue(self):
+        with self.lock:
+            return self.capture.getvalue()
+
+    def tail(self, lines):
+        return "\n".join(self.getvalue().splitlines()[-lines:])
+
+
+# Stands in for sys.stdout/sys.stderr once jobs exist: writes from a job's
+# thread go to that job's log, everything else to the real stream.
+class JobOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.routes = {}
+
+    def _target(self):
+        return self.routes.get(threading.get_ident(), self.stream)
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    @property
+    def buffer(self):
+        return self._target().buffer
+
+    def isatty(self):
+        return self._target().isatty()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+# One background AI run or command. target(job) runs in the job's thread and
+# its return value is the job's return code. A job that needs a decision
+# from the user (e.g. confirming a command) calls ask() and waits until it
+# is brought to the foreground.
+class Job:
+    def __init__(self, job_id, kind, title):
+        self.id = job_id
+        self.kind = kind
+        self.title = title
+        self.status = "running"
+        self.log = JobLog()
+        self.return_code = None
+        # (stdout, stderr) of a command job, for the session context
+        self.output = None
+        self.started = time.time()
+        self.finished = None
+        self.cancelled = threading.Event()
+        self.on_cancel = None
+        self.question = None
+        self.answer = None
+        self.answered = threading.Event()
+        self.reported = True
+        self.thread = None
+
+    def ask(self, question):
+        # Blocks the job until the user answers from `fg`; None if cancelled
+        self.answer = None
+        self.answered.clear()
+        self.question = question
+        self.status = "waiting"
+        self.reported = False
+        while not self.answered.wait(0.2):
+            if self.cancelled.is_set():
+                self.question = None
+                return None
+        self.question = None
+        self.status = "running"
+        return self.answer
+
+    def confirm_execution(self):
+        # Stands in for UserInterface.confirm_execution inside an AI job
+        return (self.ask("Execute command? (y/n): ") or "").lower() == 'y'
+
+    def reply(self, answer):
+        self.answer = answer
+        self.answered.set()
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.on_cancel is not None:
+            self.on_cancel()
+
+    @property
+    def runtime(self):
+        return (self.finished or time.time()) - self.started
+
+    def describe(self):
+        return f"[{self.id}] {self.status:<8} {self.runtime:>7.1f}s  {self.kind:<7} {self.title}"
+
+
+class JobManager:
+    def __init__(self, max_finished=MAX_FINISHED_JOBS):
+        self.jobs = {}
+        self.next_id = 1
+        self.max_finished = max_finished
+        self.lock = threading.Lock()
+        self.stdout = None
+        self.stderr = None
+
+    def start(self, kind, title, target):
+        self._install_output()
+        with self.lock:
+            job = Job(self.next_id, kind, title)
+            self.next_id += 1
+            self.jobs[job.id] = job
+            self._forget_finished()
+
+        def run():
+            ident = threading.get_ident()
+            self.stdout.routes[ident] = job.log
+            self.stderr.routes[ident] = job.log
+            try:
+                job.return_code = target(job)
+                job.status = "stopped" if job.cancelled.is_set() else "done" if not job.return_code else "failed"
+            except Exception as e:
+                print(f"Job failed: {e}", file=job.log)
+                job.status = "failed"
+            finally:
+                job.finished = time.time()
+                self.stdout.routes.pop(ident, None)
+                self.stderr.routes.pop(ident, None)
+                job.reported = False
+
+        job.thread = threading.Thread(target=run, name=f"job-{job.id}", daemon=True)
+        job.thread.start()
+        return job
+
+    def _install_output(self):
+        if self.stdout is None:
+            self.stdout = sys.stdout = JobOutput(sys.stdout)
+            self.stderr = sys.stderr = JobOutput(sys.stderr)
+
+    def _forget_finished(self):
+        finished = [job for job in self.jobs.values() if job.finished is not None and job.reported]
+        for job in finished[:max(0, len(finished) - self.max_finished)]:
+            del self.jobs[job.id]
+
+    def get(self, job_id=None):
+        # The given job, or the most recent one waiting for the user, else running, else any
+        with self.lock:
+            jobs = list(self.jobs.values())
+        if job_id is not None:
+            return next((job for job in jobs if job.id == job_id), None)
+        for wanted in ("waiting", "running"):
+            matching = [job for job in jobs if job.status == wanted]
+            if matching:
+                return matching[-1]
+        return jobs[-1] if jobs else None
+
+    def list(self):
+        with self.lock:
+            return list(self.jobs.values())
+
+    def active(self):
+        return [job for job in self.list() if job.finished is None]
+
+    def notices(self):
+        # Jobs that finished or started waiting since the last call
+        jobs = []
+        for job in self.list():
+            if not job.reported:
+                job.reported = True
+                jobs.append(job)
+        return jobs
+
+    def stop_all(self):
+        for job in self.active():
+            job.cancel()
@@ -0,0 +1,108 @@
+import json
+import re
+
+_SPECIAL = re.compile(r'[{}"\\]')
+
+# Incremental, brace- and string-aware scanner that finds the first JSON
+# object carrying required_key (or any of a tuple of keys) in text that
+# arrives in pieces (for example a streamed completion with reasoning before
+# the JSON). Every balanced {...} span is tried as soon as its closing brace
+# arrives, so the result is available the moment the object closes. A match
+# nested inside another JSON object (a command inside a batch) waits for the
+# enclosing object, which wins if it matches too.
+class JsonObjectScanner:
+    def __init__(self, required_key="bash"):
+        self.required_key = required_key
+        self.text = ""
+        self.result = None
+        self.end = None
+        self._pos = 0
+        self._stack = []
+        self._in_string = False
+        self._skip = -1
+        self._nested = None
+
+    def feed(self, chunk):
+        if self.result is not None:
+            return self.result
+        self.text += chunk
+        text = self.text
+        for match in _SPECIAL.finditer(text, self._pos):
+            i = match.start()
+            if i == self._skip:
+                continue
+            c = text[i]
+            if self._in_string:
+                if c == '\\':
+                    self._skip = i + 1
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                # Quotes only matter inside braces; prose apostrophes and quotes are ignored
+                if self._stack:
+                    self._in_string = True
+            elif c == '{':
+                self._stack.append(i)
+            elif c == '}' and self._stack:
+                start = self._stack.pop()
+                obj = self._parse(text[start:i + 1])
+                if obj is not None and any(self._opens_object(outer) for outer in self._stack):
+                    if self._nested is None:
+                        self._nested = (obj, i + 1)
+                    continue
+                if obj is None and self._nested is not None and not self._stack:
+                    obj, end = self._nested
+                    self._nested = None
+                    self.result = obj
+                    self.end = end
+                    return obj
+                if obj is not None:
+                    self.result = obj
+                    self.end = i + 1
+                    return obj
+        self._pos = len(text)
+        return None
+
+    def finish(self):
+        # Last resort for text the incremental pass could not balance (e.g. a
+        # stray quote or brace in the prose): try decoding at every brace.
+        if self.result is not None:
+            return self.result
+        decoder = json.JSONDecoder()
+        start = self.text.find('{')
+        while start >= 0:
+            try:
+                obj, end = decoder.raw_decode(self.text, start)
+            except json.JSONDecodeError:
+                obj = None
+            if self._accept(obj):
+                self.result = obj
+                self.end = end
+                return obj
+            start = self.text.find('{', start + 1)
+        return None
+
+    def _opens_object(self, start):
+        # A brace followed by a key, as opposed to one in prose or ${VAR}
+        return self.text[start + 1:start + 64].lstrip().startswith('"')
+
+    def _parse(self, candidate):
+        try:
+            obj = json.loads(candidate)
+        except json.JSONDecodeError:
+            return None
+        return obj if self._accept(obj) else None
+
+    def _accept(self, obj):
+        if not isinstance(obj, dict):
+            return False
+        if self.required_key is None:
+            return True
+        if isinstance(self.required_key, tuple):
+            return any(key in obj for key in self.required_key)
+        return self.required_key in obj
+
+
+def extract_json_object(text, required_key="bash"):
+    scanner = JsonObjectScanner(required_key)
+    return scanner.feed(text) or scanner.finish()
@@ -0,0 +1,56 @@
+import math
+import threading
+
+# Log-spaced latency histogram: constant memory, percentiles accurate to one
+# bucket (about 10%), cheap enough to update on every request.
+class LatencyHistogram:
+    def __init__(self, min_seconds=0.001, max_seconds=600.0, growth=1.1):
+        self.min_seconds = min_seconds
+        self.growth = growth
+        self.log_growth = math.log(growth)
+        self.buckets = [0] * (self._bucket(max_seconds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def _bucket(self, seconds):
+        if seconds <= self.min_seconds:
+            return 0
+        return int(math.log(seconds / self.min_seconds) / self.log_growth) + 1
+
+    def _upper_bound(self, bucket):
+        return self.min_seconds * self.growth ** bucket
+
+    def record(self, seconds):
+        bucket = min(self._bucket(seconds), len(self.buckets) - 1)
+        with self.lock:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def percentile(self, fraction):
+        with self.lock:
+            if not self.count:
+                return None
+            rank = max(1, math.ceil(fraction * self.count))
+            seen = 0
+            for bucket, count in enumerate(self.buckets):
+                seen += count
+                if seen >= rank:
+                    return min(self._upper_bound(bucket), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": self.max if self.count else None,
+        }
@@ -0,0 +1,159 @@
+import os
+import threading
+from collections import Counter
+from latency_histogram import LatencyHistogram
+
+BACKENDS = ("azure", "openai", "local")
+DEFAULT_API_VERSION = "2023-12-01-preview"
+DEFAULT_OPENAI_MODEL = "gpt-4o"
+# llama.cpp's llama-server and vLLM both serve the OpenAI API under /v1;
+# llama-server ignores the model name, vLLM wants the served model's
+DEFAULT_LOCAL_URL = "http://localhost:8080/v1"
+DEFAULT_LOCAL_MODEL = "local"
+TIERS = ("small", "large")
+# Longer instructions are sent to the large model from the first step
+SIMPLE_INSTRUCTION_CHARS = 200
+
+
+def default_backend():
+    # Azure unless only OpenAI is configured, as before backends were pluggable
+    if os.getenv("OPENAI_API_KEY") and not os.getenv("AZURE_OPENAI_ENDPOINT"):
+        return "openai"
+    return "azure"
+
+
+def backend_settings(tier="large"):
+    # Where a tier's requests go, from the environment; None when the small
+    # tier is not configured. Reading it does not import the OpenAI client.
+    large = (os.getenv("AISHELL_LLM_BACKEND") or default_backend()).lower()
+    if tier == "large":
+        kind, model = large, None
+    else:
+        kind = (os.getenv("AISHELL_SMALL_BACKEND") or "").lower()
+        model = os.getenv("AISHELL_SMALL_MODEL")
+        if not kind and not model:
+            return None
+        kind = kind or large
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown LLM backend {kind!r}; expected one of {', '.join(BACKENDS)}")
+    if kind == "azure":
+        return {
+            "kind": kind,
+            "model": model or os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME"),
+            "api_key": os.getenv("AZURE_OPENAI_API_KEY"),
+            "endpoint": os.getenv("AZURE_OPENAI_ENDPOINT"),
+            "api_version": os.getenv("AZURE_OPENAI_API_VERSION", DEFAULT_API_VERSION),
+        }
+    if kind == "openai":
+        return {
+            "kind": kind,
+            "model": model or os.getenv("OPENAI_MODEL", DEFAULT_OPENAI_MODEL),
+            "api_key": os.getenv("OPENAI_API_KEY"),
+            "endpoint": os.getenv("OPENAI_API_BASE") or None,
+        }
+    return {
+        "kind": kind,
+        "model": model or os.getenv("AISHELL_LOCAL_LLM_MODEL", DEFAULT_LOCAL_MODEL),
+        # The client insists on a key; local servers ignore it
+        "api_key": os.getenv("AISHELL_LOCAL_LLM_API_KEY") or "none",
+        "endpoint": os.getenv("AISHELL_LOCAL_LLM_URL", DEFAULT_LOCAL_URL),
+    }
+
+
+# One chat completions endpoint and the model (or Azure deployment) used on
+# it. Every backend speaks the OpenAI API, so they differ only in how the
+# client is built. Each keeps its own latency histogram, which hedging and
+# the router stats read.
+class LLMBackend:
+    def __init__(self, settings, http_client, tier="large"):
+        import openai
+        self.tier = tier
+        self.kind = settings["kind"]
+        self.model = settings["model"]
+        self.latency = LatencyHistogram()
+        if self.kind == "azure":
+            self.client = openai.AzureOpenAI(
+                api_key=settings["api_key"],
+                api_version=settings["api_version"],
+                azure_endpoint=settings["endpoint"],
+                http_client=http_client,
+                # Retries happen in LLMInterface's own loops, inside the request deadline
+                max_retries=0
+            )
+        else:
+            self.client = openai.OpenAI(
+                api_key=settings["api_key"],
+                base_url=settings["endpoint"],
+                http_client=http_client,
+                max_retries=0
+            )
+
+    def describe(self):
+        return f"{self.kind}:{self.model}"
+
+
+# Picks the tier for each command generation. With a small tier configured,
+# the first step of a short instruction goes to it; the large model takes
+# continue chains, corrections after a failed command, and retries after the
+# small model's response failed or could not be parsed. Per-tier request,
+# command and outcome counts plus the escalation reasons are kept for tuning.
+class ModelRouter:
+    def __init__(self, large, small=None, simple_chars=SIMPLE_INSTRUCTION_CHARS):
+        self.backends = {"large": large, "small": small}
+        self.simple_chars = simple_chars
+        self.lock = threading.Lock()
+        self.stats = {tier: Counter() for tier in TIERS}
+        self.escalations = Counter()
+
+    @property
+    def enabled(self):
+        return self.backends["small"] is not None
+
+    def backend(self, tier):
+        return self.backends[tier] or self.backends["large"]
+
+    def choose(self, instruction, step=0, escalate=None):
+        # (tier, reason the large tier was chosen or None)
+        if not self.enabled:
+            return "large", None
+        if escalate:
+            reason = escalate
+        elif step > 0:
+            reason = "continue"
+        elif len(instruction) > self.simple_chars:
+            reason = "long_instruction"
+        else:
+            return "small", None
+        return "large", reason
+
+    def escalate(self, reason):
+        with self.lock:
+            self.escalations[reason] += 1
+
+    def record(self, tier, key):
+        # key: "requests", "commands" (a parseable command came back),
+        # "errors", "parse_failures", "succeeded" / "failed" (its exit status)
+        with self.lock:
+            self.stats[tier][key] += 1
+
+    def summary(self):
+        with self.lock:
+            tiers = {}
+            for tier in TIERS:
+                backend = self.backends[tier]
+                if backend is None:
+                    continue
+                stats = self.stats[tier]
+                ran = stats["succeeded"] + stats["failed"]
+                tiers[tier] = {
+                    "backend": backend.describe(),
+                    "requests": stats["requests"],
+                    "commands": stats["commands"],
+                    "errors": stats["errors"],
+                    "parse_failures": stats["parse_failures"],
+                    "succeeded": stats["succeeded"],
+                    "failed": stats["failed"],
+                    "success_rate": stats["succeeded"] / ran if ran else None,
+                    "latency": backend.latency.summary(),
+                }
+            return {"tiers": tiers, "escalations": dict(self.escalations)}
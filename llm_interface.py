@@ -1,86 +1,484 @@
 # llm_interface.py
 
+import contextlib
 import os
 import html
 import json
 import sys
 import re
-from openai import AzureOpenAI
+import queue
+import threading
+import time
+import httpx
+from openai import APITimeoutError, BadRequestError
 from llm_prompts import LLMPrompts
-from typing import List, Tuple, Optional
-from pydantic import BaseModel
+from json_extractor import JsonObjectScanner, extract_json_object
+from response_cache import ResponseCache
+from token_counter import TokenCounter
+from llm_backends import LLMBackend, ModelRouter, backend_settings
+from tracer import Tracer
+from scheduler import Scheduler
+from typing import Callable, List, Tuple, Optional
 from prompt_toolkit.formatted_text import HTML
 from prompt_toolkit.styles import Style
 from prompt_toolkit import print_formatted_text
 
+# Idle connections are kept this long; long enough to span the gap between
+# Ctrl-E invocations, short enough to give up on connections the server dropped.
+KEEPALIVE_EXPIRY = 120.0
+_http_client = None
+_http_client_lock = threading.Lock()
+DEFAULT_REQUEST_TIMEOUT = 120.0
+# Hedging needs a few observed latencies before its percentile means anything
+HEDGE_MIN_SAMPLES = 5
+HEDGE_MIN_DELAY = 0.25
+# Inline suggestions are worthless once the user has moved on
+SUGGEST_TIMEOUT = 5.0
+# Shown instead of a read_output request the model made after its last read
+UNANSWERED_READ_OUTPUT = "No answer: the model kept asking to read more spilled output. Try a narrower question."
+# Schema for AISHELL_RESPONSE_FORMAT=json_schema ("json_object" only asks for
+# any JSON object); the reasoning field comes first so the model can still
+# think before committing to a command.
+COMMAND_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "reasoning": {"type": "string"},
+        "bash": {"type": "string"},
+        "commands": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "id": {"type": "string"},
+                    "bash": {"type": "string"},
+                    "after": {"type": "array", "items": {"type": "string"}},
+                },
+                "required": ["bash"],
+            },
+        },
+        "continue": {"type": "boolean"},
+        "savecontext": {"type": "string"},
+    },
+    "anyOf": [{"required": ["bash"]}, {"required": ["commands"]}],
+}
+# A response is either one command or a batch of them
+COMMAND_KEYS = ("bash", "commands")
+
+
+class LLMDeadlineExceeded(Exception):
+    pass
+
+
+class RequestAttempt:
+    # One in-flight LLM request; cancel() closes its response from any thread
+    def __init__(self, deadline: float, index: int = 0, cancelled: Optional[threading.Event] = None, backend: Optional[LLMBackend] = None):
+        self.deadline = deadline
+        self.index = index
+        self.backend = backend
+        self.cancelled = cancelled or threading.Event()
+        self.response = None
+        self.usage = None
+        self.lock = threading.Lock()
+
+    def remaining(self) -> float:
+        return max(0.001, self.deadline - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() > self.deadline
+
+    def attach(self, response):
+        with self.lock:
+            self.response = response
+            cancelled = self.cancelled.is_set()
+        if cancelled:
+            self._close(response)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled.set()
+            response = self.response
+        if response is not None:
+            self._close(response)
+
+    @staticmethod
+    def _close(response):
+        try:
+            response.close()
+        except Exception:
+            pass
+
+
+def get_http_client() -> httpx.Client:
+    # One keep-alive connection pool shared by every LLMInterface in the process
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None or _http_client.is_closed:
+            _http_client = httpx.Client(
+                limits=httpx.Limits(max_connections=10, max_keepalive_connections=4, keepalive_expiry=KEEPALIVE_EXPIRY),
+                timeout=httpx.Timeout(600.0, connect=10.0)
+            )
+        return _http_client
+
+
 class LLMInterface:
-    def __init__(self, debug_mode: bool = False):
+    def __init__(self, debug_mode: bool = False, stream: bool = False, http_client: Optional[httpx.Client] = None, cache: Optional[ResponseCache] = None, tracer: Optional[Tracer] = None, scheduler: Optional[Scheduler] = None):
         self.max_retries = 3
-        self.client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),  
-            api_version="2023-12-01-preview",
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT")
-        )
-        self.deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_NAME")
+        self.tracer = tracer or Tracer()
+        # Shared with background jobs; caps concurrent requests
+        self.scheduler = scheduler
+        self.stream = stream
+        # Responses are always stored when a cache is set; replaying them is opt-in
+        self.cache = cache
+        self.cache_replay = False
+        self.http_client = http_client or get_http_client()
+        # Azure, an OpenAI-compatible base URL or a local server (AISHELL_LLM_BACKEND);
+        # command generation may route simple steps to a small tier
+        self.backend = LLMBackend(backend_settings("large"), self.http_client)
+        small = backend_settings("small")
+        self.router = ModelRouter(self.backend, LLMBackend(small, self.http_client, tier="small") if small else None)
+        self.client = self.backend.client
+        self.deployment_name = self.backend.model
+        self.prompt_stats = PromptCacheStats(TokenCounter(self.deployment_name))
+        # Every request is bounded by request_timeout; hedging is opt-in
+        self.request_timeout = float(os.getenv("AISHELL_LLM_TIMEOUT", DEFAULT_REQUEST_TIMEOUT))
+        hedge_percentile = os.getenv("AISHELL_HEDGE_PERCENTILE")
+        self.hedge_percentile = float(hedge_percentile) if hedge_percentile else None
+        self.hedge_min_samples = HEDGE_MIN_SAMPLES
+        self.hedge_min_delay = HEDGE_MIN_DELAY
+        # The large tier's; each backend keeps its own for hedging
+        self.latency = self.backend.latency
+        # Updated from hedged attempts and background jobs as well
+        self.stats_lock = threading.Lock()
+        self.request_stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "timeouts": 0, "failures": 0, "background_failures": 0, "parse_retries": 0, "parse_failures": 0}
+        # Structured output for command generation, when the backend supports it
+        self.response_format = os.getenv("AISHELL_RESPONSE_FORMAT") or None
+        # Ask for a usage report at the end of streams that are read to the
+        # end; turned off if the backend rejects stream_options
+        self.stream_usage = True
+        # Plain runtime flag; toggling it does not rebuild the client
         self.debug_mode = debug_mode
 
-    def call_llm(self, messages: List[dict], system_content: str) -> Optional[str]:
-        if self.debug_mode:
+    def preconnect(self) -> threading.Thread:
+        # Open (DNS, TCP, TLS) a pooled connection in the background so the first
+        # real request does not pay for it. Any HTTP response will do.
+        def warm():
+            urls = {str(backend.client.base_url) for backend in self.router.backends.values() if backend is not None}
+            for url in urls:
+                try:
+                    self.http_client.get(url, timeout=10.0)
+                except Exception as e:
+                    if self.debug_mode:
+                        self.print_debug(f"Pre-connect failed: {e}")
+
+        thread = threading.Thread(target=warm, name="llm-preconnect", daemon=True)
+        thread.start()
+        return thread
+
+    def hedge_delay(self, backend: Optional[LLMBackend] = None) -> Optional[float]:
+        # Send a duplicate request once the first has taken longer than this
+        latency = (backend or self.backend).latency
+        if self.hedge_percentile is None or latency.count < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min_delay, latency.percentile(self.hedge_percentile))
+
+    def _prepare(self, messages: List[dict], system_content: str, track_prompt: bool = True) -> List[dict]:
+        with self.tracer.span("prompt", messages=len(messages) + 1) as trace:
             full_messages = [{"role": "system", "content": system_content}] + messages
+            if track_prompt:
+                self.prompt_stats.record_request(full_messages)
+                trace["tokens"] = self.prompt_stats.last_prompt_tokens
+        if self.debug_mode:
             self.print_debug(f"Sending messages to LLM: {json.dumps(full_messages, indent=2)}")
+        return full_messages
+
+    def call_llm(self, messages: List[dict], system_content: str, track_prompt: bool = True, response_format: Optional[dict] = None, backend: Optional[LLMBackend] = None) -> Optional[str]:
+        full_messages = self._prepare(messages, system_content, track_prompt)
+        if self.hedge_percentile is not None and track_prompt:
+            # Hedged attempts are streamed so that the losing one can be cancelled
+            response = self._race(lambda attempt: self._stream_completion(full_messages, None, attempt, track_prompt, response_format, usage=track_prompt), backend=backend)
+        else:
+            response = self._race(lambda attempt: self._complete(full_messages, attempt, track_prompt, response_format), hedge=False, record=track_prompt, backend=backend)
+        if self.debug_mode and track_prompt and response is not None:
+            self.print_debug(self.prompt_stats.describe_last())
+        return response
 
+    def call_llm_stream(self, messages: List[dict], system_content: str, on_delta: Optional[Callable[[str], Optional[bool]]] = None) -> Optional[str]:
+        # Streams the completion; if on_delta returns True the rest of the generation is cancelled.
+        # Not hedged: on_delta may already have shown output from the first attempt.
+        full_messages = self._prepare(messages, system_content)
+        response = self._race(lambda attempt: self._stream_completion(full_messages, on_delta, attempt, usage=True), hedge=False)
+        if self.debug_mode and response is not None:
+            self.print_debug(self.prompt_stats.describe_last())
+        return response
+
+    def command_response_format(self) -> Optional[dict]:
+        if self.response_format == "json_schema":
+            return {"type": "json_schema", "json_schema": {"name": "shell_command", "schema": COMMAND_SCHEMA}}
+        if self.response_format == "json_object":
+            return {"type": "json_object"}
+        return None
+
+    def _create(self, full_messages: List[dict], attempt: "RequestAttempt", response_format: Optional[dict] = None, **kwargs):
+        backend = attempt.backend or self.backend
+        while True:
+            # Optional parameters the backend rejects are dropped for the
+            # rest of the session and the request is sent again
+            request = dict(kwargs)
+            if response_format is not None and self.response_format is not None:
+                request["response_format"] = response_format
+            if not self.stream_usage:
+                request.pop("stream_options", None)
+            try:
+                return backend.client.chat.completions.create(
+                    model=backend.model,
+                    messages=full_messages,
+                    timeout=attempt.remaining(),
+                    **request
+                )
+            except BadRequestError as e:
+                if "response_format" in request and ("response_format" in str(e) or "json_schema" in str(e)):
+                    print(f"The LLM backend rejected AISHELL_RESPONSE_FORMAT={self.response_format}; using plain responses.", file=sys.stderr)
+                    self.response_format = None
+                elif "stream_options" in request and "stream_options" in str(e):
+                    if self.debug_mode:
+                        self.print_debug("The LLM backend rejected stream_options; streamed requests will not report usage.")
+                    self.stream_usage = False
+                else:
+                    raise
+
+    def _complete(self, full_messages: List[dict], attempt: "RequestAttempt", track_prompt: bool = True, response_format: Optional[dict] = None) -> str:
+        response = self._create(full_messages, attempt, response_format)
+        attempt.usage = response.usage
+        if track_prompt:
+            self.prompt_stats.record_usage(response.usage)
+        if self.debug_mode:
+            self.print_debug(f"Raw response from LLM: {response}")
+        return response.choices[0].message.content.strip()
+
+    def _stream_completion(self, full_messages: List[dict], on_delta: Optional[Callable[[str], Optional[bool]]], attempt: "RequestAttempt", track_prompt: bool = True, response_format: Optional[dict] = None, usage: bool = False) -> Optional[str]:
+        # usage asks for the server's token report, which comes after the
+        # last delta; pointless for streams that are usually cut short
+        options = {"stream_options": {"include_usage": True}} if usage else {}
+        stream = self._create(full_messages, attempt, response_format, stream=True, **options)
+        attempt.attach(stream)
+        parts = []
         try:
-            response = self.client.chat.completions.create(
-                model=self.deployment_name,
-                messages=[{"role": "system", "content": system_content}] + messages
-            )
-            if self.debug_mode:
-                self.print_debug(f"Raw response from LLM: {response}")
-            return response.choices[0].message.content.strip()
+            for chunk in stream:
+                if attempt.cancelled.is_set():
+                    return None
+                if attempt.expired():
+                    raise LLMDeadlineExceeded(self.request_timeout)
+                if getattr(chunk, "usage", None):
+                    attempt.usage = chunk.usage
+                    if track_prompt:
+                        self.prompt_stats.record_usage(chunk.usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                if on_delta is not None and on_delta(delta):
+                    break
+        finally:
+            # Closing the response drops the connection's remaining tokens
+            stream.close()
+        if track_prompt and attempt.usage is None:
+            self.prompt_stats.record_unreported()
+        response = "".join(parts)
+        if self.debug_mode:
+            self.print_debug(f"Raw streamed response from LLM: {response}")
+        return response.strip()
+
+    def _race(self, run_attempt: Callable[["RequestAttempt"], object], is_valid: Optional[Callable[[object], bool]] = None, hedge: bool = True, record: bool = True, backend: Optional[LLMBackend] = None):
+        backend = backend or self.backend
+        with self._llm_slot(), self.tracer.span("llm" if record else "llm_background", tier=backend.tier) as trace:
+            attempts = []
+            result = self._race_attempts(run_attempt, attempts, is_valid, hedge, record, backend)
+            trace["attempts"] = len(attempts)
+            trace["ok"] = result is not None
+            usage = next((a.usage for a in attempts if a.usage is not None and not a.cancelled.is_set()), None)
+            for field in ("prompt_tokens", "completion_tokens"):
+                value = getattr(usage, field, None)
+                if isinstance(value, int):
+                    trace[field] = value
+        return result
+
+    def _count(self, key):
+        with self.stats_lock:
+            self.request_stats[key] += 1
+
+    def _llm_slot(self, block=True):
+        # A hedged request holds a single slot for all its attempts
+        if self.scheduler is None:
+            return contextlib.nullcontext(True)
+        return self.scheduler.llm_slot(block)
+
+    def _race_attempts(self, run_attempt: Callable[["RequestAttempt"], object], attempts: List["RequestAttempt"], is_valid: Optional[Callable[[object], bool]], hedge: bool, record: bool, backend: LLMBackend):
+        # Runs run_attempt under the request deadline. With hedging on, a
+        # duplicate attempt starts once the first has been running for the
+        # hedge delay (or has failed); the first valid result wins and the
+        # other attempt is cancelled.
+        is_valid = is_valid or (lambda result: result is not None)
+        started = time.monotonic()
+        deadline = started + self.request_timeout
+        self._count("requests")
+        delay = self.hedge_delay(backend) if hedge else None
+
+        if delay is None:
+            attempts.append(RequestAttempt(deadline, backend=backend))
+            result = self._run_attempt(run_attempt, attempts[0], record)
+            if record and is_valid(result):
+                backend.latency.record(time.monotonic() - started)
+            return result
+
+        results = queue.Queue()
+
+        def launch():
+            attempt = RequestAttempt(deadline, len(attempts), backend=backend)
+            attempts.append(attempt)
+            threading.Thread(
+                target=lambda: results.put((attempt, self._run_attempt(run_attempt, attempt, record))),
+                name=f"llm-attempt-{attempt.index}",
+                daemon=True
+            ).start()
+
+        launch()
+        winner = None
+        fallback = None
+        finished = 0
+        while finished < len(attempts):
+            wake_at = min(started + delay, deadline) if len(attempts) == 1 else deadline
+            try:
+                attempt, result = results.get(timeout=max(0.0, wake_at - time.monotonic()))
+            except queue.Empty:
+                if time.monotonic() >= deadline:
+                    self._count("timeouts")
+                    print(f"LLM request timed out after {self.request_timeout:.0f}s", file=sys.stderr)
+                    break
+                launch()
+                self._count("hedged")
+                continue
+            finished += 1
+            if is_valid(result):
+                winner = (attempt, result)
+                break
+            if result is not None:
+                fallback = result
+            if len(attempts) == 1 and time.monotonic() < deadline:
+                # The first attempt failed before the hedge was due; hedge right away
+                launch()
+                self._count("hedged")
+
+        for attempt in attempts:
+            if winner is None or attempt is not winner[0]:
+                attempt.cancel()
+        if winner is None:
+            return fallback
+        if record:
+            backend.latency.record(time.monotonic() - started)
+        if winner[0].index > 0:
+            self._count("hedge_wins")
+        return winner[1]
+
+    def _run_attempt(self, run_attempt: Callable[["RequestAttempt"], object], attempt: "RequestAttempt", report: bool = True):
+        # Background requests (report False, e.g. the summarizer) fail quietly
+        # rather than print over the prompt; they are counted all the same
+        try:
+            return run_attempt(attempt)
         except Exception as e:
-            print(f"Error calling LLM: {e}", file=sys.stderr)
+            if attempt.cancelled.is_set():
+                return None
+            if not report:
+                self._count("background_failures")
+            if isinstance(e, (APITimeoutError, LLMDeadlineExceeded)):
+                self._count("timeouts")
+                if report:
+                    print(f"LLM request timed out after {self.request_timeout:.0f}s", file=sys.stderr)
+            else:
+                self._count("failures")
+                if report:
+                    print(f"Error calling LLM: {e}", file=sys.stderr)
             return None
 
-    def generate_command(self, instruction: str, context: List[dict], interactive_mode: bool, remaining_commands: int, limit: int, system_info: str) -> Tuple[Optional[str], Optional[str]]:
+    def generate_command(self, instruction: str, context: List[dict], interactive_mode: bool, remaining_commands: int, limit: int, system_info: str, step: int = 0, escalate: Optional[str] = None) -> Tuple[Optional[str], Optional[str]]:
+        command, error, _, _ = self.generate_routed_command(instruction, context, interactive_mode, remaining_commands, limit, system_info, step, escalate)
+        return command, error
+
+    def generate_routed_command(self, instruction: str, context: List[dict], interactive_mode: bool, remaining_commands: int, limit: int, system_info: str, step: int = 0, escalate: Optional[str] = None) -> Tuple[Optional[str], Optional[str], Optional[str], bool]:
+        # (command, error, tier that generated it, whether it was replayed
+        # from the cache); the tier, None for replays, is handed back to
+        # record_outcome. step counts the generations so far for this
+        # instruction; escalate names why the large model must answer
+        # (e.g. "failed_command")
+        cache_key = None
+        if self.cache is not None:
+            # Keyed before generation, which appends retry messages to context
+            cache_key = self.cache.key("command", instruction, context, system_info, "interactive" if interactive_mode else "non-interactive")
+            if self.cache_replay:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    return cached, None, None, True
+
+        command, error, tier = self._generate_command(instruction, context, interactive_mode, remaining_commands, limit, system_info, step, escalate)
+        if command is not None and cache_key is not None:
+            self.cache.put(cache_key, "command", command)
+        return command, error, tier, False
+
+    def _generate_command(self, instruction: str, context: List[dict], interactive_mode: bool, remaining_commands: int, limit: int, system_info: str, step: int, escalate: Optional[str]) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+        tier, reason = self.router.choose(instruction, step, escalate)
+        if reason is not None:
+            self.router.escalate(reason)
         for attempt in range(self.max_retries):
+            # System prompt and history form a stable prefix; per-step fields go last
             messages = context + [
-                {"role": "user", "content": f"aishell command: {instruction}"}
+                {"role": "user", "content": LLMPrompts.COMMAND_STEP.format(
+                    instruction=instruction,
+                    mode="interactive" if interactive_mode else "non-interactive",
+                    verification="your commands will be verified by the user" if interactive_mode else "your commands will execute without review",
+                    remaining=remaining_commands,
+                    limit=limit
+                )}
             ]
 
-            system_content = LLMPrompts.COMMAND_GENERATION.format(
-                mode="interactive" if interactive_mode else "non-interactive",
-                verification="your commands will be verified by the user" if interactive_mode else "your commands will execute without review",
-                remaining=remaining_commands,
-                system_info=system_info,
-                limit=limit
-            )
+            system_content = LLMPrompts.COMMAND_GENERATION.format(system_info=system_info)
+            response_format = self.command_response_format()
+
+            while True:
+                self.router.record(tier, "requests")
+                response, command_json = self._request_command(messages, system_content, response_format, self.router.backend(tier))
+                if response is not None or tier == "large":
+                    break
+                # The small model's endpoint failed; the large one gets the same request
+                self.router.record(tier, "errors")
+                self.router.escalate("error")
+                tier = "large"
 
-            response = self.call_llm(messages, system_content)
-            
             if response is None:
-                return None, "Failed to generate a command. There might be an issue with the LLM service."
+                self.router.record(tier, "errors")
+                return None, "Failed to generate a command. There might be an issue with the LLM service.", None
 
-            # Strip markdown code block if present
-            json_match = re.search(r'```(?:json)?\s*({\s*"bash":\s*.*?})\s*```', response, re.DOTALL)
-            if json_match:
-                response = json_match.group(1)
+            if command_json is None:
+                # Brace- and string-aware, so commands containing } (awk, ${VAR},
+                # heredocs) and JSON inside code fences or prose still parse
+                with self.tracer.span("parse", retry=attempt, chars=len(response)) as trace:
+                    command_json = extract_json_object(response, COMMAND_KEYS)
+                    trace["ok"] = command_json is not None
+            if command_json is not None:
+                self.router.record(tier, "commands")
+                return json.dumps(command_json), None, tier
+            self.router.record(tier, "parse_failures")
+            if extract_json_object(response, None) is not None:
+                error_message = f"Invalid response format from LLM: {response}"
             else:
-                # If no code block, try to find JSON object directly
-                json_match = re.search(r'({.*?"bash".*?})', response, re.DOTALL)
-                if json_match:
-                    response = json_match.group(1)
-
-            try:
-                command_json = json.loads(response)
-                if "bash" in command_json:
-                    return json.dumps(command_json), None
-                else:
-                    error_message = f"Invalid response format from LLM: {response}"
-            except json.JSONDecodeError:
                 error_message = f"Failed to parse LLM response as JSON: {response}"
 
             # If we reach here, the response was invalid. Prepare for retry.
             if attempt < self.max_retries - 1:
+                self._count("parse_retries")
+                if tier == "small":
+                    self.router.escalate("parse")
+                    tier = "large"
                 retry_message = (
                     f"Your previous response could not be parsed as valid JSON. "
                     f"Please provide a response in the correct JSON format: {{'bash': 'your_command_here'}}. "
@@ -89,25 +487,247 @@ class LLMInterface:
                 )
                 context.append({"role": "system", "content": retry_message})
             else:
-                return None, error_message
+                self._count("parse_failures")
+                return None, error_message, None
+
+        return None, "Maximum retries reached. Failed to generate a valid command.", None
+
+    def _request_command(self, messages: List[dict], system_content: str, response_format: Optional[dict], backend: LLMBackend) -> Tuple[Optional[str], Optional[dict]]:
+        # (response text, command object when streaming already parsed it)
+        if not self.stream:
+            return self.call_llm(messages, system_content, response_format=response_format, backend=backend), None
+        full_messages = self._prepare(messages, system_content)
 
-        return None, "Maximum retries reached. Failed to generate a valid command."
+        def run(attempt):
+            # Each (possibly hedged) attempt scans its own stream and stops
+            # generating as soon as the {"bash": ...} or batch object closes
+            scanner = JsonObjectScanner(COMMAND_KEYS)
+            text = self._stream_completion(full_messages, lambda delta: scanner.feed(delta) is not None, attempt, True, response_format)
+            return None if text is None else (text, scanner.result)
 
-    def answer_question(self, question: str, context: List[dict]) -> str:
+        outcome = self._race(run, is_valid=lambda result: result is not None and result[1] is not None, backend=backend)
+        if self.debug_mode and outcome is not None:
+            self.print_debug(self.prompt_stats.describe_last())
+        return (None, None) if outcome is None else outcome
+
+    def record_outcome(self, tier: Optional[str], succeeded: bool):
+        # Exit status of a generated command, credited to the tier that
+        # generate_routed_command returned for it
+        if tier is not None:
+            self.router.record(tier, "succeeded" if succeeded else "failed")
+
+    def answer_question(self, question: str, context: List[dict], read_output: Optional[Callable[[int, int, int], str]] = None, on_delta: Optional[Callable[[str], None]] = None) -> str:
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.key("answer", question, context)
+            if self.cache_replay:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    if self.stream and on_delta is not None:
+                        on_delta(cached)
+                    return cached
+
+        answer = self._answer_question(question, context, read_output, on_delta)
+        if answer is None:
+            return "Failed to generate an answer. There might be an issue with the LLM service."
+        if cache_key is not None and answer != UNANSWERED_READ_OUTPUT:
+            self.cache.put(cache_key, "answer", answer)
+        return answer
+
+    def _answer_question(self, question: str, context: List[dict], read_output: Optional[Callable[[int, int, int], str]], on_delta: Optional[Callable[[str], None]]) -> Optional[str]:
         messages = context + [
             {"role": "user", "content": f"[USERQUESTION] All previous messages were context from an ongoing shell session. The user would like you to answer, in plain text, this question:\n\n{question}"}
         ]
 
         system_content = LLMPrompts.QUESTION_ANSWERING
 
-        response = self.call_llm(messages, system_content)
-        if response is None:
-            return "Failed to generate an answer. There might be an issue with the LLM service."
+        for attempt in range(self.max_retries):
+            if self.stream and on_delta is not None:
+                relay = AnswerRelay(on_delta)
+                response = self.call_llm_stream(messages, system_content, on_delta=relay.feed)
+                if response is not None:
+                    relay.flush()
+            else:
+                response = self.call_llm(messages, system_content)
+            if response is None:
+                return None
+
+            request = self.parse_read_output_request(response)
+            if request is None:
+                return response
+            if read_output is None or attempt == self.max_retries - 1:
+                # The request itself is never shown as the answer
+                return UNANSWERED_READ_OUTPUT
+
+            lines = read_output(request["spill_id"], request["start_line"], request["end_line"])
+            content = f"Lines {request['start_line']}-{request['end_line']} of spilled output {request['spill_id']}:\n{lines}"
+            if attempt == self.max_retries - 2:
+                content += "\n\nNo more output can be read; answer the question in plain text now."
+            messages = messages + [
+                {"role": "assistant", "content": response},
+                {"role": "user", "content": content}
+            ]
+
         return response
 
+    def summarize(self, messages: List[dict]) -> Optional[str]:
+        # Runs on the context summarizer thread; kept out of the prompt-prefix stats
+        request = messages + [{"role": "user", "content": "Summarize the session history above as instructed."}]
+        return self.call_llm(request, LLMPrompts.CONTEXT_SUMMARY, track_prompt=False)
+
+    def suggest_command(self, prefix: str, context: List[dict], cancelled: Optional[threading.Event] = None) -> Optional[str]:
+        # Ghost-text completion for the prompt; stops at the first line and fails quietly
+        full_messages = [{"role": "system", "content": LLMPrompts.COMMAND_SUGGESTION}] + context + [{"role": "user", "content": prefix}]
+        attempt = RequestAttempt(time.monotonic() + SUGGEST_TIMEOUT, cancelled=cancelled)
+        with self._llm_slot(block=False) as acquired, self.tracer.span("suggest") as trace:
+            # Suggestions never queue behind instructions and jobs
+            response = None
+            if acquired:
+                try:
+                    response = self._stream_completion(full_messages, lambda delta: "\n" in delta, attempt, track_prompt=False)
+                except Exception:
+                    pass
+            trace["ok"] = bool(response)
+        command = (response or "").strip().strip("`").strip()
+        return command.splitlines()[0] if command else None
+
+    def parse_read_output_request(self, response: str) -> Optional[dict]:
+        if '"read_output"' not in response:
+            return None
+        request_json = extract_json_object(response, "read_output")
+        if request_json is None:
+            return None
+        try:
+            request = request_json["read_output"]
+            return {
+                "spill_id": int(request["spill_id"]),
+                "start_line": int(request["start_line"]),
+                "end_line": int(request["end_line"]),
+            }
+        except (KeyError, TypeError, ValueError):
+            return None
+
     def print_debug(self, message: str):
         style = Style.from_dict({
             'debug': '#FFFF00 bold',
         })
         escaped_message = html.escape(str(message))
         print_formatted_text(HTML(f"<debug>{escaped_message}</debug>"), style=style, file=sys.stderr)
+
+
+class PromptCacheStats:
+    # Tracks how much of each prompt repeats the previous one byte for byte
+    # (what provider-side prefix caching can reuse), next to the cached token
+    # counts the server reports when its usage data includes them.
+    MAX_COUNTED = 4096
+
+    def __init__(self, token_counter: Optional[TokenCounter] = None):
+        self.token_counter = token_counter or TokenCounter()
+        self.previous: List[dict] = []
+        self.counted = {}
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.prefix_tokens = 0
+        self.last_prompt_tokens = 0
+        self.last_prefix_tokens = 0
+        self.server_prompt_tokens = 0
+        self.server_cached_tokens = 0
+        self.last_server_usage = None
+        # Streamed requests that ended without a usage report (command
+        # streams stop as soon as the command is complete)
+        self.unreported = 0
+        self.last_unreported = False
+
+    def _tokens(self, message: dict) -> int:
+        key = (message["role"], message["content"])
+        tokens = self.counted.get(key)
+        if tokens is None:
+            if len(self.counted) >= self.MAX_COUNTED:
+                self.counted.clear()
+            tokens = self.counted[key] = self.token_counter.count_message(message)
+        return tokens
+
+    def record_request(self, messages: List[dict]):
+        shared = 0
+        for previous, message in zip(self.previous, messages):
+            if previous["role"] != message["role"] or previous["content"] != message["content"]:
+                break
+            shared += 1
+        tokens = [self._tokens(m) for m in messages]
+        self.previous = list(messages)
+        self.requests += 1
+        self.last_prompt_tokens = sum(tokens)
+        self.last_prefix_tokens = sum(tokens[:shared])
+        self.prompt_tokens += self.last_prompt_tokens
+        self.prefix_tokens += self.last_prefix_tokens
+        self.last_server_usage = None
+        self.last_unreported = False
+
+    def record_usage(self, usage):
+        if usage is None:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            cached = details.get("cached_tokens") or 0
+        else:
+            cached = getattr(details, "cached_tokens", 0) or 0
+        prompt = getattr(usage, "prompt_tokens", None)
+        if not isinstance(prompt, int) or not isinstance(cached, int):
+            return
+        self.server_prompt_tokens += prompt
+        self.server_cached_tokens += cached
+        self.last_server_usage = (prompt, cached)
+
+    def record_unreported(self):
+        self.unreported += 1
+        self.last_unreported = True
+
+    def describe_last(self) -> str:
+        text = f"Prompt ~{self.last_prompt_tokens} tokens, ~{self.last_prefix_tokens} repeated from the previous request"
+        if self.last_server_usage is not None:
+            prompt, cached = self.last_server_usage
+            text += f"; server: {cached} of {prompt} prompt tokens cached"
+        elif self.last_unreported:
+            text += "; server figures unavailable (the stream ended without a usage report)"
+        return text
+
+    def summary(self) -> dict:
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "prefix_tokens": self.prefix_tokens,
+            "prefix_ratio": self.prefix_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+            "server_prompt_tokens": self.server_prompt_tokens,
+            "server_cached_tokens": self.server_cached_tokens,
+            "server_cached_ratio": self.server_cached_tokens / self.server_prompt_tokens if self.server_prompt_tokens else 0.0,
+            "unreported": self.unreported,
+        }
+
+
+class AnswerRelay:
+    # Passes streamed answer text through, except for a read_output request,
+    # which is held back until it is clear the response is not plain text.
+    def __init__(self, on_delta: Callable[[str], None]):
+        self.on_delta = on_delta
+        self.pending = ""
+        self.passing = False
+
+    def feed(self, delta: str) -> bool:
+        if self.passing:
+            self.on_delta(delta)
+            return False
+        self.pending += delta
+        head = re.sub(r'\s+', '', self.pending)
+        marker = '{"read_output"'
+        if head.startswith(marker) or (head and marker.startswith(head)):
+            return False
+        self.passing = True
+        self.on_delta(self.pending)
+        self.pending = ""
+        return False
+
+    def flush(self):
+        # A response that looked like a request but is not one is still an answer
+        if not self.passing and self.pending and '"read_output"' not in self.pending:
+            self.on_delta(self.pending)
+        self.pending = ""
@@ -0,0 +1,183 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for an OpenAI / Azure OpenAI chat completions endpoint, used by
+# the tests and benchmarks. Responses are taken from a script (falling back to
+# a default), every request body is recorded, and TCP connections are counted
+# so connection reuse can be checked. delays scripts how long each request
+# waits before answering, to simulate slow or stalled responses.
+# tokens_per_second paces generation (roughly four characters per token), and
+# request_bytes / service_times record each request's size and how long the
+# server took to answer it, so benchmarks can separate model time from ours.
+# structured_output=False makes it reject response_format like older backends,
+# and stream_usage=False stream_options. Streams end with a usage chunk when
+# stream_options asks for one.
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, responses=None, default_response='{"bash": "echo ok"}', host="127.0.0.1", port=0, delays=None, tokens_per_second=None, structured_output=True, stream_usage=True):
+        super().__init__((host, port), MockLLMHandler)
+        self.responses = list(responses or [])
+        self.default_response = default_response
+        self.delays = list(delays or [])
+        self.tokens_per_second = tokens_per_second
+        self.structured_output = structured_output
+        self.stream_usage = stream_usage
+        self.request_bytes = []
+        self.service_times = []
+        self.requests = []
+        self.previous_prompt = ""
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def process_request(self, request, client_address):
+        with self.lock:
+            self.connections += 1
+        super().process_request(request, client_address)
+
+    def handle_error(self, request, client_address):
+        # Clients cancel streams by dropping the connection
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+    def next_response(self, body):
+        with self.lock:
+            self.requests.append(body)
+            delay = self.delays.pop(0) if self.delays else 0
+            content = self.responses.pop(0) if self.responses else self.default_response
+        if delay:
+            time.sleep(delay)
+        return content
+
+    def generation_time(self, content):
+        if not self.tokens_per_second:
+            return 0.0
+        return len(content) / 4 / self.tokens_per_second
+
+    def record_service(self, started, length):
+        with self.lock:
+            self.request_bytes.append(length)
+            self.service_times.append((started, time.perf_counter()))
+
+    def prompt_usage(self, body):
+        # Simulates provider prefix caching: whatever the prompt shares with the
+        # previous request, byte for byte from the start, counts as cached.
+        prompt = json.dumps(body.get("messages", []))
+        with self.lock:
+            previous, self.previous_prompt = self.previous_prompt, prompt
+        shared = len(os.path.commonprefix([previous, prompt]))
+        return {"prompt_tokens": len(prompt) // 4, "prompt_tokens_details": {"cached_tokens": shared // 4}}
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._send_json(200, {"object": "list", "data": []})
+
+    def do_POST(self):
+        started = time.perf_counter()
+        length = int(self.headers.get("Content-Length", 0))
+        body = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.split("?")[0].endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"unknown path {self.path}"}})
+            return
+        if "response_format" in body and not self.server.structured_output:
+            self._send_json(400, {"error": {"message": "Unrecognized request argument supplied: response_format", "code": "invalid_request"}})
+            return
+        if "stream_options" in body and not self.server.stream_usage:
+            self._send_json(400, {"error": {"message": "Unrecognized request argument supplied: stream_options", "code": "invalid_request"}})
+            return
+
+        content = self.server.next_response(body)
+        usage = self.server.prompt_usage(body)
+        if body.get("stream"):
+            self._send_stream(content, body, usage)
+        else:
+            time.sleep(self.server.generation_time(content))
+            self._send_json(200, self._completion(content, body, usage))
+        self.server.record_service(started, length)
+
+    def _completion(self, content, body, usage):
+        return {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "mock"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": dict(usage, completion_tokens=len(content) // 4, total_tokens=usage["prompt_tokens"] + len(content) // 4),
+        }
+
+    def _send_stream(self, content, body, usage, chunk_size=8):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i in range(0, len(content), chunk_size):
+                time.sleep(self.server.generation_time(content[i:i + chunk_size]))
+                self._send_event({
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", "mock"),
+                    "choices": [{"index": 0, "delta": {"content": content[i:i + chunk_size]}, "finish_reason": None}],
+                })
+            if (body.get("stream_options") or {}).get("include_usage"):
+                self._send_event({
+                    "id": "chatcmpl-mock",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", "mock"),
+                    "choices": [],
+                    "usage": dict(usage, completion_tokens=len(content) // 4, total_tokens=usage["prompt_tokens"] + len(content) // 4),
+                })
+            self._send_chunk(b"data: [DONE]\n\n")
+            self._send_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client cancelled the stream
+            self.close_connection = True
+
+    def _send_event(self, payload):
+        self._send_chunk(b"data: " + json.dumps(payload).encode() + b"\n\n")
+
+    def _send_chunk(self, data):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,154 @@
+import mmap
+import os
+import tempfile
+
+BINARY_SNIFF_BYTES = 8192
+LINE_INDEX_STRIDE = 1024
+
+# Keeps the first and last max_bytes // 2 bytes of a stream and only counts
+# what falls in between, so huge output never sits in memory. Once the output
+# outgrows max_bytes (and spilling is enabled) the complete stream is written
+# to a temp file that can be read back by line range through mmap.
+class OutputCapture:
+    def __init__(self, max_bytes=64 * 1024, spill=False, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.head_limit = max_bytes // 2
+        self.tail_limit = max_bytes - self.head_limit
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total_bytes = 0
+        self.line_count = 0
+        self.last_byte = None
+        self.binary = False
+        self._sniff = bytearray()
+        self.spill = spill
+        self.spill_dir = spill_dir
+        self.spill_path = None
+        self._spill_file = None
+        self._line_index = None
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        if not self.binary and len(self._sniff) < BINARY_SNIFF_BYTES:
+            self._sniff += chunk[:BINARY_SNIFF_BYTES - len(self._sniff)]
+            self.binary = self._looks_binary(bytes(self._sniff))
+        self.total_bytes += len(chunk)
+        self.line_count += chunk.count(b'\n')
+        self.last_byte = chunk[-1:]
+
+        if self._spill_file is not None:
+            self._spill_file.write(chunk)
+        elif self.spill and self.total_bytes > self.max_bytes:
+            # Head and tail still hold everything seen so far; move it all to disk
+            self._open_spill()
+            self._spill_file.write(self.head)
+            self._spill_file.write(self.tail)
+            self._spill_file.write(chunk)
+
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += chunk[:room]
+            chunk = chunk[room:]
+        if chunk:
+            self.tail += chunk
+            overflow = len(self.tail) - self.tail_limit
+            if overflow > 0:
+                del self.tail[:overflow]
+
+    def close(self):
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def discard(self):
+        self.close()
+        if self.spill_path and os.path.exists(self.spill_path):
+            os.unlink(self.spill_path)
+        self.spill_path = None
+
+    def _open_spill(self):
+        fd, self.spill_path = tempfile.mkstemp(prefix='aishell-output-', suffix='.log', dir=self.spill_dir)
+        self._spill_file = os.fdopen(fd, 'wb')
+
+    @staticmethod
+    def _looks_binary(sample):
+        if b'\0' in sample:
+            return True
+        try:
+            sample.decode('utf-8')
+        except UnicodeDecodeError as e:
+            # A multi-byte character cut off by the sample boundary is still text
+            return e.start < len(sample) - 3
+        return False
+
+    @property
+    def omitted_bytes(self):
+        return self.total_bytes - len(self.head) - len(self.tail)
+
+    @property
+    def truncated(self):
+        return self.omitted_bytes > 0
+
+    @property
+    def lines(self):
+        # A trailing line without a newline still counts as a line
+        if self.total_bytes and self.last_byte != b'\n':
+            return self.line_count + 1
+        return self.line_count
+
+    def getvalue(self):
+        if self.binary:
+            return f"[binary output: {self.total_bytes} bytes not decoded]"
+        head = self.head.decode('utf-8', errors='replace')
+        tail = self.tail.decode('utf-8', errors='replace')
+        if not self.truncated:
+            return head + tail
+        return f"{head}\n[... {self.omitted_bytes} bytes omitted ...]\n{tail}"
+
+    def describe(self):
+        info = {"bytes": self.total_bytes, "lines": self.lines}
+        if self.binary:
+            info["binary"] = True
+        if self.spill_path:
+            info["spilled"] = True
+        return info
+
+    def read_lines(self, start_line, end_line, max_bytes=16 * 1024):
+        # Lines are 1-based and inclusive, as a person reading `nl` output expects
+        if not self.spill_path:
+            raise ValueError("output was not spilled to disk")
+        if self.binary:
+            raise ValueError("output is binary")
+        self.close()
+        start_line = max(1, int(start_line))
+        end_line = max(start_line, int(end_line))
+        with open(self.spill_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = self._line_offset(mm, start_line)
+            end = self._line_offset(mm, end_line + 1)
+            data = mm[start:min(end, start + max_bytes)]
+        return data.decode('utf-8', errors='replace')
+
+    def _line_offset(self, mm, line):
+        # Sparse index of every LINE_INDEX_STRIDE-th line start, built on first use
+        if self._line_index is None:
+            index = [0]
+            pos, seen = 0, 0
+            while True:
+                pos = mm.find(b'\n', pos)
+                if pos < 0:
+                    break
+                pos += 1
+                seen += 1
+                if seen % LINE_INDEX_STRIDE == 0:
+                    index.append(pos)
+            self._line_index = index
+
+        block = min((line - 1) // LINE_INDEX_STRIDE, len(self._line_index) - 1)
+        pos = self._line_index[block]
+        for _ in range(line - 1 - block * LINE_INDEX_STRIDE):
+            pos = mm.find(b'\n', pos)
+            if pos < 0:
+                return len(mm)
+            pos += 1
+        return pos
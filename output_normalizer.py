@@ -0,0 +1,140 @@
+import re
+from collections import deque
+
+# CSI (colors, cursor movement, erase), OSC (titles, hyperlinks) and other
+# two-byte escapes
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-?]*[ -/]*[@-~]|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)|\x1b[@-Z\\-_]')
+# Erase in line; a redraw that starts with it replaces the whole line
+ERASE_LINE = re.compile(r'\x1b\[[012]?K')
+# Overstrike (man pages: "_\bx", "x\bx") and stray control characters
+OVERSTRIKE = re.compile(r'[^\n]\x08')
+CONTROL = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1a\x1c-\x1f\x7f]')
+# Lines whose words and numbers differ but whose punctuation and word count
+# match have the same shape: ls/find listings, seq, per-item log lines.
+# Column padding doesn't count, so runs of spaces are one separator
+WORD = re.compile(r'[A-Za-z0-9_.\-+]+')
+# Identical consecutive lines beyond this many are folded into a count
+MAX_REPEATS = 2
+# A run of more than ELIDE_HEAD + ELIDE_TAIL + ELIDE_MIN same-shaped lines
+# keeps only its first and last lines
+ELIDE_HEAD = 20
+ELIDE_TAIL = 10
+ELIDE_MIN = 30
+# A progress bar that never prints a newline is collapsed once this long
+MAX_PENDING = 4096
+
+
+# Streaming cleanup of command output for the session context. feed() takes
+# text in arbitrary chunks and returns the normalized text that is final so
+# far; finish() flushes the rest. Escape codes are stripped, \r redraws are
+# collapsed to their final state, repeated lines are folded into a count and
+# long runs of same-shaped lines lose their middle; folded_lines counts the
+# lines those two dropped. Each line is handled once, so the cost is linear
+# in the output.
+class OutputNormalizer:
+    def __init__(self, max_repeats=MAX_REPEATS, elide_head=ELIDE_HEAD, elide_tail=ELIDE_TAIL, elide_min=ELIDE_MIN):
+        self.max_repeats = max_repeats
+        self.elide_head = elide_head
+        self.elide_tail = elide_tail
+        self.elide_min = elide_min
+        self.pending = ""
+        self.out = []
+        self.folded_lines = 0
+        # Repeat folding
+        self.last_line = None
+        self.repeats = 0
+        # Shape run
+        self.shape = None
+        self.run_length = 0
+        self.held = deque()
+
+    def feed(self, text):
+        self.pending += text
+        if "\n" in self.pending:
+            *lines, self.pending = self.pending.split("\n")
+            for line in lines:
+                self._line(self._clean(line))
+        if len(self.pending) > MAX_PENDING and "\r" in self.pending:
+            done, _, rest = self.pending.rpartition("\r")
+            self.pending = self._clean(done) + "\r" + rest
+        return self._take()
+
+    def finish(self):
+        if self.pending:
+            self._line(self._clean(self.pending), newline=False)
+            self.pending = ""
+        self._end_repeats()
+        self._end_run()
+        return self._take()
+
+    def normalize(self, text):
+        return self.feed(text) + self.finish()
+
+    def _strip(self, line):
+        if "\x1b" in line:
+            line = ANSI_ESCAPE.sub("", line)
+        if "\x08" in line:
+            while OVERSTRIKE.search(line):
+                line = OVERSTRIKE.sub("", line)
+        return CONTROL.sub("", line)
+
+    def _clean(self, line):
+        if "\r" not in line:
+            return self._strip(line)
+        # What a terminal shows after the \r redraws: each segment overwrites
+        # the start of the previous state, or all of it after an erase
+        state = ""
+        for segment in line.rstrip("\r").split("\r"):
+            erase = "\x1b" in segment and ERASE_LINE.search(segment) is not None
+            segment = self._strip(segment)
+            state = segment if erase else segment + state[len(segment):]
+        return state
+
+    def _line(self, line, newline=True):
+        if line == self.last_line:
+            self.repeats += 1
+            if self.repeats <= self.max_repeats:
+                self._shaped(line, newline)
+            return
+        self._end_repeats()
+        self.last_line = line
+        self.repeats = 1
+        self._shaped(line, newline)
+
+    def _end_repeats(self):
+        if self.repeats > self.max_repeats:
+            self.folded_lines += self.repeats - self.max_repeats
+            self._shaped(f"[previous line repeated {self.repeats - self.max_repeats} more times]")
+        self.repeats = 0
+        self.last_line = None
+
+    def _shaped(self, line, newline=True):
+        text = line + "\n" if newline else line
+        shape = " ".join(WORD.sub("w", line).split()) or None
+        if shape is None or shape != self.shape:
+            self._end_run()
+            self.shape = shape
+        self.run_length += 1
+        if self.run_length <= self.elide_head:
+            self.out.append(text)
+            return
+        # Past the head, lines are held until the run is known to be long
+        # enough to elide; from then on only the last elide_tail are kept
+        self.held.append(text)
+        if self.held.maxlen is None and len(self.held) > self.elide_tail + self.elide_min:
+            self.held = deque(self.held, maxlen=self.elide_tail)
+
+    def _end_run(self):
+        if self.held.maxlen is not None:
+            elided = self.run_length - self.elide_head - len(self.held)
+            self.folded_lines += elided
+            self.out.append(f"[... {elided} similar lines elided ...]\n")
+        self.out.extend(self.held)
+        self.held = deque()
+        self.run_length = 0
+        self.shape = None
+
+    def _take(self):
+        text = "".join(self.out)
+        self.out = []
+        return text
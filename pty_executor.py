@@ -0,0 +1,187 @@
+import fcntl
+import os
+import select
+import selectors
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import termios
+import threading
+import tty
+
+CHUNK_SIZE = 64 * 1024
+# How long to keep reading after the command exits, for output still in the pty
+DRAIN_SECONDS = 0.1
+# Full-screen and prompting programs that need a terminal to work
+PTY_PROGRAMS = {
+    "vi", "vim", "nvim", "view", "nano", "emacs", "micro", "less", "more", "man",
+    "top", "htop", "btop", "watch", "ssh", "sftp", "ftp", "telnet", "sudo", "su",
+    "passwd", "tmux", "screen", "mc", "fzf",
+}
+
+
+def wants_pty(command):
+    # True when the command's program (after any VAR=value prefixes) is one
+    # that only works on a terminal
+    for word in command.strip().split():
+        if "=" in word and not word.startswith("="):
+            continue
+        return os.path.basename(word) in PTY_PROGRAMS
+    return False
+
+
+def _window_size(fd):
+    try:
+        return fcntl.ioctl(fd, termios.TIOCGWINSZ, b"\0" * 8)
+    except (OSError, ValueError):
+        columns, lines = shutil.get_terminal_size()
+        return struct.pack("HHHH", lines, columns, 0, 0)
+
+
+def _make_controlling_terminal():
+    # Runs in the child after setsid(): the pty on stdin becomes its terminal,
+    # so ^C, ^Z and window-size changes reach it as signals
+    fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+
+
+# Runs one command on a pseudo-terminal so that editors, pagers, password
+# prompts and progress bars see a real terminal. Output is read from the pty
+# in CHUNK_SIZE blocks and relayed as bytes; every chunk is also handed to
+# on_output (the bounded context capture). When stdin is a terminal it is put
+# in raw mode and forwarded to the command, and SIGWINCH copies our window
+# size onto the pty. stdout and stderr arrive merged, as on a terminal.
+class PtyExecutor:
+    def __init__(self, stdin_fd=None, stdout_stream=None):
+        if stdin_fd is None:
+            try:
+                stdin_fd = sys.stdin.fileno()
+            except (AttributeError, ValueError, OSError):
+                stdin_fd = -1  # replaced stdin (tests, embedding): nothing to forward
+        self.stdin_fd = stdin_fd
+        self.stdout_stream = stdout_stream or sys.stdout
+        self.process = None
+        self.master = None
+
+    def run(self, command, on_output=None, cwd=None, env=None):
+        master, slave = os.openpty()
+        os.set_blocking(master, False)
+        self.master = master
+        forward_stdin = self.stdin_fd >= 0 and os.isatty(self.stdin_fd)
+        self._resize()
+        try:
+            self.process = subprocess.Popen(
+                command,
+                shell=True,
+                stdin=slave,
+                stdout=slave,
+                stderr=slave,
+                cwd=cwd,
+                env=env,
+                start_new_session=True,
+                preexec_fn=_make_controlling_terminal
+            )
+        except BaseException:
+            os.close(master)
+            self.master = None
+            raise
+        finally:
+            os.close(slave)
+
+        old_winch = None
+        if threading.current_thread() is threading.main_thread():
+            old_winch = signal.signal(signal.SIGWINCH, lambda signum, frame: self._resize())
+        old_settings = termios.tcgetattr(self.stdin_fd) if forward_stdin else None
+        try:
+            if forward_stdin:
+                tty.setraw(self.stdin_fd)
+            self._relay(master, forward_stdin, on_output)
+            code = self.process.wait()
+            return 128 - code if code < 0 else code
+        finally:
+            if old_settings is not None:
+                termios.tcsetattr(self.stdin_fd, termios.TCSADRAIN, old_settings)
+            if old_winch is not None:
+                signal.signal(signal.SIGWINCH, old_winch)
+            os.close(master)
+            self.master = None
+            self.process = None
+
+    def _relay(self, master, forward_stdin, on_output):
+        buffer = getattr(self.stdout_stream, "buffer", None)
+        self.stdout_stream.flush()
+        with selectors.DefaultSelector() as selector:
+            selector.register(master, selectors.EVENT_READ)
+            if forward_stdin:
+                selector.register(self.stdin_fd, selectors.EVENT_READ)
+            while True:
+                # Blocks until there is output or input; the timeout only
+                # notices a command that exited while a background job it
+                # started still holds the pty open
+                events = selector.select(DRAIN_SECONDS)
+                if not events and self.process.poll() is not None:
+                    return
+                for key, _ in events:
+                    if key.fd == master:
+                        chunk, done = self._read_available(master)
+                        if chunk and on_output is not None:
+                            on_output(chunk)
+                        if chunk and buffer is not None:
+                            buffer.write(chunk)
+                            buffer.flush()
+                        elif chunk:
+                            self.stdout_stream.write(chunk.decode("utf-8", errors="replace"))
+                            self.stdout_stream.flush()
+                        if done:
+                            return
+                    else:
+                        data = os.read(self.stdin_fd, CHUNK_SIZE)
+                        if data:
+                            self._write_all(master, data)
+                        else:
+                            selector.unregister(self.stdin_fd)
+
+    def _read_available(self, master):
+        # The pty hands out at most a few KiB per read; gather what is
+        # already there into one chunk so each relay is a single write.
+        # Returns (chunk, True once the slave side is closed).
+        chunk = bytearray()
+        while len(chunk) < CHUNK_SIZE:
+            try:
+                data = os.read(master, CHUNK_SIZE - len(chunk))
+            except BlockingIOError:
+                return chunk, False
+            except OSError:
+                return chunk, True  # EIO: every copy of the slave side is closed
+            if not data:
+                return chunk, True
+            chunk += data
+        return chunk, False
+
+    def _write_all(self, master, data):
+        # The master is non-blocking; wait for room when the command isn't
+        # reading its input fast enough
+        view = memoryview(data)
+        while view:
+            try:
+                view = view[os.write(master, view):]
+            except BlockingIOError:
+                select.select([], [master], [])
+
+    def _resize(self):
+        if self.master is None:
+            return
+        try:
+            fcntl.ioctl(self.master, termios.TIOCSWINSZ, _window_size(self.stdin_fd))
+        except OSError:
+            pass
+
+    def interrupt(self):
+        # SIGINT the command's whole process group, as ^C on its terminal would
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGINT)
+        except ProcessLookupError:
+            pass
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_DB = "~/.aishell/cache.db"
+DEFAULT_TTL = 7 * 24 * 3600
+MAX_ENTRIES = 1000
+# Trailing context messages that are part of the key (the last command and its output)
+CONTEXT_MESSAGES = 2
+# Environment that changes what a command means or does
+FINGERPRINT_VARS = ("PATH", "HOME", "USER", "SHELL", "VIRTUAL_ENV", "CONDA_PREFIX", "KUBECONFIG", "DOCKER_HOST")
+
+
+def environment_fingerprint():
+    env = {name: os.environ.get(name, "") for name in FINGERPRINT_VARS}
+    payload = json.dumps({"cwd": os.getcwd(), "host": socket.gethostname(), "env": env}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def normalize_instruction(text):
+    return re.sub(r'\s+', ' ', text.strip().lower())
+
+
+# On-disk LRU + TTL cache of LLM responses, keyed by a hash of the normalized
+# instruction, the trailing context window, system info and mode. Each entry
+# also records the cwd/environment fingerprint it was produced under; a lookup
+# from a different fingerprint invalidates the entry.
+class ResponseCache:
+    def __init__(self, path=DEFAULT_CACHE_DB, ttl=DEFAULT_TTL, max_entries=MAX_ENTRIES, context_messages=CONTEXT_MESSAGES):
+        self.path = os.path.expanduser(path)
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.context_messages = context_messages
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.stores = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, kind TEXT NOT NULL, value TEXT NOT NULL, fingerprint TEXT NOT NULL, "
+            "created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+
+    def key(self, kind, instruction, context, system_info="", mode=""):
+        window = context[-self.context_messages:] if self.context_messages else []
+        payload = json.dumps({
+            "kind": kind,
+            "instruction": normalize_instruction(instruction),
+            "context": [[m["role"], m["content"]] for m in window],
+            "system_info": system_info,
+            "mode": mode,
+        })
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key, fingerprint=None):
+        fingerprint = fingerprint or environment_fingerprint()
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, fingerprint, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            value, entry_fingerprint, created = row
+            if entry_fingerprint != fingerprint or now - created > self.ttl:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return value
+
+    def put(self, key, kind, value, fingerprint=None):
+        fingerprint = fingerprint or environment_fingerprint()
+        now = time.time()
+        with self.lock:
+            with self.conn:
+                self.conn.execute("BEGIN")
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO responses (key, kind, value, fingerprint, created, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                    (key, kind, value, fingerprint, now, now)
+                )
+                # Evict the least recently used entries beyond the size limit
+                self.conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            self.stores += 1
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "stores": self.stores,
+            "entries": entries,
+        }
+
+    def clear(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM responses")
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,69 @@
+import threading
+import time
+from contextlib import contextmanager
+
+MAX_LLM_CALLS = 4
+MAX_PROCESSES = 4
+
+
+# Caps how many LLM requests and background processes run at once, across
+# the foreground shell and every background job. A caller past the cap waits
+# for a slot (or, with block=False, is told there is none) and the time spent
+# waiting is counted, so Ctrl-E j can show whether the limits are too tight.
+class Scheduler:
+    def __init__(self, max_llm_calls=MAX_LLM_CALLS, max_processes=MAX_PROCESSES):
+        self.max_llm_calls = max_llm_calls
+        self.max_processes = max_processes
+        self.slots = {
+            "llm": threading.BoundedSemaphore(max_llm_calls),
+            "process": threading.BoundedSemaphore(max_processes),
+        }
+        self.lock = threading.Lock()
+        self.stats = {
+            name: {"active": 0, "peak": 0, "waits": 0, "wait_seconds": 0.0, "rejected": 0}
+            for name in self.slots
+        }
+
+    def llm_slot(self, block=True):
+        return self._slot("llm", block)
+
+    def process_slot(self, block=True):
+        return self._slot("process", block)
+
+    @contextmanager
+    def _slot(self, name, block):
+        # Yields False when block is False and no slot is free
+        semaphore = self.slots[name]
+        stats = self.stats[name]
+        acquired = semaphore.acquire(blocking=False)
+        if not acquired and block:
+            started = time.monotonic()
+            semaphore.acquire()
+            acquired = True
+            with self.lock:
+                stats["waits"] += 1
+                stats["wait_seconds"] += time.monotonic() - started
+        if not acquired:
+            with self.lock:
+                stats["rejected"] += 1
+            yield False
+            return
+        with self.lock:
+            stats["active"] += 1
+            stats["peak"] = max(stats["peak"], stats["active"])
+        try:
+            yield True
+        finally:
+            with self.lock:
+                stats["active"] -= 1
+            semaphore.release()
+
+    def describe(self):
+        lines = []
+        for name, limit in (("llm", self.max_llm_calls), ("process", self.max_processes)):
+            stats = self.stats[name]
+            lines.append(
+                f"{name} slots: {stats['active']}/{limit} in use, peak {stats['peak']}, "
+                f"{stats['waits']} waits ({stats['wait_seconds']:.1f}s), {stats['rejected']} skipped"
+            )
+        return "\n".join(lines)
@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import time
+import uuid
+
+DEFAULT_SESSION_DB = "~/.aishell/session.db"
+# Rows kept on disk; older ones are deleted when the store is opened
+MAX_ROWS = 200000
+PAGE_SIZE = 256
+
+# Append-only session log in SQLite (WAL mode), so the context that Ctrl-E n
+# and Ctrl-E a rely on survives crashes and restarts. Each write is a single
+# short transaction; reads page backwards from the newest row, within one
+# session when given one, so terminals writing at the same time never see
+# each other's commands interleaved.
+class SessionStore:
+    def __init__(self, path=DEFAULT_SESSION_DB, max_rows=MAX_ROWS):
+        self.path = os.path.expanduser(path)
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self.session_id = uuid.uuid4().hex
+        self.conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT NOT NULL, created REAL NOT NULL, "
+            "role TEXT NOT NULL, content TEXT NOT NULL, tokens INTEGER NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session, id)")
+        self._trim(max_rows)
+        newest = self.conn.execute("SELECT MAX(id) FROM messages").fetchone()[0]
+        # Rows from here on were written after opening, by this or a concurrent session
+        self.first_new_id = newest + 1 if newest else 1
+
+    def _trim(self, max_rows):
+        row = self.conn.execute("SELECT MAX(id) FROM messages").fetchone()
+        if row[0] is not None and row[0] > max_rows:
+            self.conn.execute("DELETE FROM messages WHERE id <= ?", (row[0] - max_rows,))
+
+    def append_many(self, messages):
+        # messages: iterable of (role, content, tokens); written in one transaction
+        now = time.time()
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT INTO messages (session, created, role, content, tokens) VALUES (?, ?, ?, ?, ?)",
+                [(self.session_id, now, role, content, tokens) for role, content, tokens in messages]
+            )
+
+    def append(self, role, content, tokens):
+        self.append_many([(role, content, tokens)])
+
+    def page(self, before_id=None, limit=PAGE_SIZE, session=None):
+        # Rows older than before_id (of session, if given), newest first, as
+        # (id, role, content, tokens)
+        where = []
+        params = []
+        if session is not None:
+            where.append("session = ?")
+            params.append(session)
+        if before_id is not None:
+            where.append("id < ?")
+            params.append(before_id)
+        condition = f"WHERE {' AND '.join(where)} " if where else ""
+        query = f"SELECT id, role, content, tokens FROM messages {condition}ORDER BY id DESC LIMIT ?"
+        return self.conn.execute(query, params + [limit]).fetchall()
+
+    def sessions(self, before_id):
+        # (session, first row id) of the sessions with rows before before_id,
+        # the one that wrote last first
+        query = "SELECT session, MIN(id) FROM messages WHERE id < ? GROUP BY session ORDER BY MAX(id) DESC"
+        return self.conn.execute(query, (before_id,)).fetchall()
+
+    def tail(self, max_tokens, before_id=None, session=None):
+        # Newest rows (oldest first in the result) whose tokens fit in max_tokens
+        rows = []
+        total = 0
+        while True:
+            page = self.page(before_id, PAGE_SIZE, session)
+            for row in page:
+                if total + row[3] > max_tokens:
+                    return list(reversed(rows))
+                rows.append(row)
+                total += row[3]
+            if len(page) < PAGE_SIZE:
+                return list(reversed(rows))
+            before_id = page[-1][0]
+
+    def close(self):
+        self.conn.close()
@@ -5,9 +5,12 @@ import tty
 import select
 import subprocess
 
+CHUNK_SIZE = 64 * 1024
+
 class TerminalController:
     def __init__(self):
-        self.old_settings = termios.tcgetattr(sys.stdin)
+        # None when stdin is not a terminal (scripted or benchmark runs)
+        self.old_settings = termios.tcgetattr(sys.stdin) if sys.stdin.isatty() else None
         self.ctrl_e_active = False
 
     def __enter__(self):
@@ -40,36 +43,34 @@ class TerminalController:
             command,
             shell=True,
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
+            stderr=subprocess.PIPE
         )
 
-        stdout_data = []
-        stderr_data = []
-
-        while True:
-            reads = [process.stdout.fileno(), process.stderr.fileno()]
-            ret = select.select(reads, [], [])
-
-            for fd in ret[0]:
-                if fd == process.stdout.fileno():
-                    data = process.stdout.read(1)
-                    if data:
-                        sys.stdout.write(data)
-                        sys.stdout.flush()
-                        stdout_data.append(data)
-                if fd == process.stderr.fileno():
-                    data = process.stderr.read(1)
-                    if data:
-                        sys.stderr.write(data)
-                        sys.stderr.flush()
-                        stderr_data.append(data)
-
-            if process.poll() is not None:
-                break
+        # Read whatever is available in large chunks and relay it as bytes
+        stdout_data = bytearray()
+        stderr_data = bytearray()
+        streams = {
+            process.stdout.fileno(): (sys.stdout, stdout_data),
+            process.stderr.fileno(): (sys.stderr, stderr_data),
+        }
+        while streams:
+            ready, _, _ = select.select(list(streams), [], [])
+            for fd in ready:
+                data = os.read(fd, CHUNK_SIZE)
+                stream, collected = streams[fd]
+                if not data:
+                    del streams[fd]
+                    continue
+                stream.flush()
+                stream.buffer.write(data)
+                stream.buffer.flush()
+                collected += data
+        process.wait()
+        process.stdout.close()
+        process.stderr.close()
 
-        stdout = ''.join(stdout_data)
-        stderr = ''.join(stderr_data)
+        stdout = stdout_data.decode('utf-8', errors='replace')
+        stderr = stderr_data.decode('utf-8', errors='replace')
 
         return stdout, stderr
 
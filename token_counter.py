@@ -0,0 +1,88 @@
+import math
+import os
+
+# Context window sizes by model family; Azure deployment names usually start
+# with the model name, so lookups match on prefix (longest first).
+MODEL_CONTEXT_TOKENS = {
+    "gpt-4o-mini": 128000,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4-32k": 32768,
+    "gpt-4": 8192,
+    "gpt-35-turbo-16k": 16385,
+    "gpt-35-turbo": 16385,
+    "gpt-3.5-turbo": 16385,
+}
+DEFAULT_CONTEXT_TOKENS = 128000
+# Share of the window given to session history; the rest is left for the
+# system prompt, the instruction and the completion.
+HISTORY_FRACTION = 0.6
+CHARS_PER_TOKEN = 4
+# Fixed per-message cost of the chat format (role markers and separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def context_window(model):
+    if model:
+        name = model.lower()
+        for prefix in sorted(MODEL_CONTEXT_TOKENS, key=len, reverse=True):
+            if name.startswith(prefix):
+                return MODEL_CONTEXT_TOKENS[prefix]
+    return DEFAULT_CONTEXT_TOKENS
+
+
+def context_budget(model=None):
+    override = os.getenv("AISHELL_CONTEXT_TOKENS")
+    if override:
+        return int(override)
+    return int(context_window(model) * HISTORY_FRACTION)
+
+
+class TokenCounter:
+    def __init__(self, model=None, encoding=None):
+        self.model = model
+        # tiktoken and its encoding are loaded on the first count, not at startup
+        self._encoding = encoding
+        self._loaded = encoding is not None
+
+    @property
+    def encoding(self):
+        if not self._loaded:
+            self._encoding = self._load_encoding(self.model)
+            self._loaded = True
+        return self._encoding
+
+    @encoding.setter
+    def encoding(self, encoding):
+        self._encoding = encoding
+        self._loaded = True
+
+    @staticmethod
+    def _load_encoding(model):
+        try:
+            import tiktoken
+        except ImportError:
+            return None
+        # Encodings are downloaded on first use; offline we fall back to counting chars
+        try:
+            return tiktoken.encoding_for_model(model)
+        except Exception:
+            try:
+                return tiktoken.get_encoding("o200k_base")
+            except Exception:
+                return None
+
+    @property
+    def exact(self):
+        return self.encoding is not None
+
+    def count(self, text):
+        if not text:
+            return 0
+        encoding = self.encoding
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+    def count_message(self, message):
+        return MESSAGE_OVERHEAD_TOKENS + self.count(message["role"]) + self.count(message["content"])
@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from latency_histogram import LatencyHistogram
+
+# Lines buffered before the trace file is written
+FLUSH_EVERY = 32
+
+
+# Per-phase timing for the hot path (context build, prompt render, LLM
+# request, parse, command execution). Every span feeds a per-phase latency
+# histogram for the session; when a path is given, each span is also appended
+# to it as one JSON line.
+class Tracer:
+    def __init__(self, path=None):
+        self.path = os.path.expanduser(path) if path else None
+        self.histograms = {}
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.file = None
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.file = open(self.path, "a", encoding="utf-8")
+
+    @contextmanager
+    def span(self, phase, **fields):
+        # Callers may add fields (token counts, bytes) to the yielded dict
+        started = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.record(phase, time.perf_counter() - started, **fields)
+
+    def record(self, phase, seconds, **fields):
+        with self.lock:
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = self.histograms[phase] = LatencyHistogram(min_seconds=0.00001)
+        histogram.record(seconds)
+        if self.file is None:
+            return
+        line = json.dumps(dict(fields, ts=round(time.time(), 6), phase=phase, ms=round(seconds * 1000, 3)), default=str)
+        with self.lock:
+            self.buffer.append(line)
+            if len(self.buffer) >= FLUSH_EVERY:
+                self._flush()
+
+    def summary(self):
+        with self.lock:
+            phases = list(self.histograms.items())
+        return {phase: histogram.summary() for phase, histogram in phases}
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.file is not None and self.buffer:
+            self.file.write("\n".join(self.buffer) + "\n")
+            self.file.flush()
+            self.buffer = []
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.file is not None:
+                self.file.close()
+                self.file = None